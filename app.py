@@ -1,36 +1,126 @@
+import os
 import streamlit as st
 import pandas as pd
-import plotly.express as px
+import numpy as np
+from instrumentation import stage, export_metrics
+from sku_index import SkuIndex
+from snapshot import SNAPSHOT_PATH, REORDERS_PATH_NAME
+
+FORECAST_CSV = "predictions/multi_month_demand_forecast.csv"
+# The snapshot's memory-mappable copy of the forecast file (see snapshot.py)
+SNAPSHOT_FORECAST = os.path.join(SNAPSHOT_PATH, REORDERS_PATH_NAME)
+PAGE_SIZES = [25, 50, 100, 500]
+# Most SKU lines ever sent to the browser; larger selections are charted as top-N or monthly totals
+MAX_CHART_SKUS = 25
+
+def forecast_path():
+    # The snapshot's forecast, unless predict.py has written a newer CSV since
+    paths = [path for path in (SNAPSHOT_FORECAST, FORECAST_CSV) if os.path.exists(path)]
+    return max(paths, key=os.path.getmtime)
+
+# Load forecast data (the file's modification time is part of the cache key, so a new run is picked up)
+@st.cache_data
+def load_data(file_path, mtime):
+    if file_path.endswith(".arrow"):
+        import pyarrow.feather as feather
+        with stage("snapshot_load") as span:
+            df = feather.read_table(file_path, memory_map=True).to_pandas()
+            span['rows'] = len(df)
+    else:
+        with stage("csv_load") as span:
+            df = pd.read_csv(file_path)
+            span['rows'] = len(df)
+    df['Month'] = df['Order Year'].astype(str) + "-" + df['Order Month'].astype(str).str.zfill(2)
+    return df
+
+@st.cache_resource
+def load_index(file_path, mtime):
+    with stage("sku_index"):
+        return SkuIndex(load_data(file_path, mtime)['SKU'])
+
+# Row positions matching the filters, cached per filter combination
+@st.cache_data
+def filter_rows(file_path, mtime, sku_filter, match_mode, reorder_filter):
+    df = load_data(file_path, mtime)
+    index = load_index(file_path, mtime)
+    with stage("filter"):
+        rows = index.rows(index.search(sku_filter.strip(), match_mode))
+        if reorder_filter != "All":
+            rows = rows[df['Reorder Needed'].to_numpy()[rows] == reorder_filter]
+    return rows
+
+@st.cache_data
+def top_skus(file_path, mtime, sku_filter, match_mode, reorder_filter, rank_by, n):
+    df = load_data(file_path, mtime)
+    rows = filter_rows(file_path, mtime, sku_filter, match_mode, reorder_filter)
+    with stage("top_n", rows=len(rows)):
+        return df.iloc[rows].groupby('SKU')[rank_by].sum().nlargest(n).index.to_numpy()
+
+@st.cache_data
+def monthly_totals(file_path, mtime, sku_filter, match_mode, reorder_filter):
+    df = load_data(file_path, mtime)
+    rows = filter_rows(file_path, mtime, sku_filter, match_mode, reorder_filter)
+    with stage("groupby", rows=len(rows)):
+        return df.iloc[rows].groupby('Month', as_index=False).agg(
+            **{'Predicted Demand': ('Predicted Demand', 'sum'), 'Stock Balance': ('Stock Balance', 'sum'),
+               'Reorder Quantity': ('Reorder Quantity', 'sum'), 'SKUs to Reorder': ('Reorder Needed', 'sum')}
+        )
+
+@st.cache_data
+def filtered_csv(file_path, mtime, sku_filter, match_mode, reorder_filter):
+    df = load_data(file_path, mtime)
+    rows = filter_rows(file_path, mtime, sku_filter, match_mode, reorder_filter)
+    with stage("csv_write", rows=len(rows)):
+        return df.iloc[rows].drop(columns='Month').to_csv(index=False)
 
-# Load forecast data
-def load_data():
-    file_path = "predictions/multi_month_demand_forecast.csv"
-    return pd.read_csv(file_path)
 # Streamlit App
 st.set_page_config(page_title="Demand Forecast Dashboard", layout="wide")
 st.title("📊 SKU Demand Forecast & Reorder Recommendations")
 
 # Load Data
-df = load_data()
+FORECAST_PATH = forecast_path()
+mtime = os.path.getmtime(FORECAST_PATH)
+df = load_data(FORECAST_PATH, mtime)
+index = load_index(FORECAST_PATH, mtime)
 
 # Sidebar Filters
 st.sidebar.header("Filter Options")
 sku_filter = st.sidebar.text_input("Search SKU:")
+match_mode = st.sidebar.radio("Match:", ["substring", "prefix"], horizontal=True)
 reorder_filter = st.sidebar.selectbox("Show Only Reorders:", ["All", True, False])
+filters = (FORECAST_PATH, mtime, sku_filter, match_mode, reorder_filter)
 
 # Apply Filters
-if sku_filter:
-    df = df[df['SKU'].astype(str).str.contains(sku_filter, case=False, na=False)]
-if reorder_filter != "All":
-    df = df[df['Reorder Needed'] == reorder_filter]
+rows = filter_rows(*filters)
+st.caption(f"{len(rows):,} forecast rows across {len(index.search(sku_filter.strip(), match_mode)):,} "
+           f"of {len(index):,} SKUs")
 
-# Display Data
-st.dataframe(df, use_container_width=True)
+# Display Data, one page at a time
+page_col, size_col = st.columns([3, 1])
+page_size = size_col.selectbox("Rows per page", PAGE_SIZES, index=1)
+n_pages = max(1, -(-len(rows) // page_size))
+page = page_col.number_input(f"Page (of {n_pages:,})", min_value=1, max_value=n_pages, value=1)
+page_rows = rows[(page - 1) * page_size:page * page_size]
+st.dataframe(df.iloc[page_rows].drop(columns='Month'), use_container_width=True)
 
-# Visualization: Demand Forecast vs Stock Balance
-fig = px.line(df, x='Order Month', y=['Predicted Demand', 'Stock Balance'], color='SKU',
-              title='Predicted Demand vs Stock Balance', markers=True)
-st.plotly_chart(fig, use_container_width=True)
+# Visualization: Demand Forecast vs Stock Balance (plotly is only imported once there is a chart to draw)
+if len(rows):
+    import plotly.express as px
+    chart = st.radio("Chart:", ["Top SKUs", "Monthly totals"], horizontal=True)
+    if chart == "Top SKUs":
+        rank_col, n_col = st.columns([3, 1])
+        rank_by = rank_col.selectbox("Rank SKUs by:", ["Reorder Quantity", "Predicted Demand"])
+        top_n = n_col.slider("SKUs shown", 1, MAX_CHART_SKUS, min(10, MAX_CHART_SKUS))
+        skus = top_skus(*filters, rank_by, top_n)
+        chart_rows = np.intersect1d(index.rows(np.searchsorted(index.skus, skus)), rows)
+        fig = px.line(df.iloc[chart_rows], x='Month', y=['Predicted Demand', 'Stock Balance'], color='SKU',
+                      title=f'Predicted Demand vs Stock Balance (top {len(skus)} SKUs by {rank_by})', markers=True)
+    else:
+        fig = px.line(monthly_totals(*filters), x='Month', y=['Predicted Demand', 'Stock Balance', 'Reorder Quantity'],
+                      title='Predicted Demand vs Stock Balance (all matching SKUs)', markers=True)
+    st.plotly_chart(fig, use_container_width=True)
 
 # Download Button
-st.sidebar.download_button("Download Forecast CSV", df.to_csv(index=False), "forecast_data.csv", "text/csv")
\ No newline at end of file
+st.sidebar.download_button("Download Forecast CSV", filtered_csv(*filters), "forecast_data.csv", "text/csv")
+
+export_metrics("app")
@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sklearn.ensemble import RandomForestRegressor
+from feature_store import FEATURE_STORE_PATH, MODEL_FEATURES, TARGET, TIME_COLUMN, load_features, rebase_as_of
+from forecaster import RecursiveForecaster
+from forecast_engine import reorder_table
+from preprocess import load_encoders, default_encoder_path
+from instrumentation import stage, export_metrics
+
+BACKTEST_PATH = "predictions/backtest_report.csv"
+RAW_PATH = "original_data/final_medicine_inventory_sales_data.csv"
+# The forest train_model fits, unless other parameters are given
+DEFAULT_PARAMS = {'n_estimators': 100, 'max_depth': 10}
+
+
+def month_index(times):
+    # Months as consecutive integers (year * 12 + month - 1)
+    months = pd.DatetimeIndex(times)
+    return months.year.to_numpy() * 12 + months.month.to_numpy() - 1
+
+
+def backtest_cutoffs(df, n_cutoffs=12, horizon=2, min_train_months=6):
+    # The last n_cutoffs month ends with at least min_train_months of history up to them and
+    # `horizon` complete months of actuals after them
+    months = np.unique(df[TIME_COLUMN].dropna().to_numpy().astype('datetime64[M]'))
+    eligible = months[min_train_months - 1:len(months) - horizon][-n_cutoffs:]
+    return [pd.Timestamp(month + np.timedelta64(1, 'M')) - pd.Timedelta(days=1) for month in eligible]
+
+
+def monthly_actuals(df):
+    # Observed target per SKU and month, the mean over the month's rows, as a (SKU, month) indexed Series
+    months = month_index(df[TIME_COLUMN])
+    return df[TARGET].groupby([df['SKU'].to_numpy(), months]).mean()
+
+
+def policy_cost(table, actual, unit_cost, stockout_cost, holding_rate=0.25, order_cost=50.0):
+    # Replays the reorder table against what was actually demanded: each month's order arrives,
+    # demand is served from stock (the rest is lost) and what is left is carried. `table` holds every
+    # SKU's steps in order and `actual` the matching demand, both (steps x SKUs)
+    quantity = table['Reorder Quantity'].to_numpy().reshape(actual.shape)
+    on_hand = table['Stock Balance'].to_numpy()[:actual.shape[1]].astype(np.float64)
+    holding = lost = 0.0
+    for step in range(actual.shape[0]):
+        on_hand = on_hand + quantity[step]
+        sold = np.minimum(on_hand, actual[step])
+        lost = lost + actual[step] - sold
+        on_hand = on_hand - sold
+        holding = holding + on_hand
+    costs = {
+        'Holding Cost': float((unit_cost * holding_rate / 12 * holding).sum()),
+        'Ordering Cost': float(order_cost * (quantity > 0).sum()),
+        'Stockout Cost': float((stockout_cost * lost).sum())
+    }
+    demand = actual.sum()
+    return {
+        **costs,
+        'Policy Cost': sum(costs.values()),
+        'Orders': int((quantity > 0).sum()),
+        'Fill Rate': float(1 - lost.sum() / demand) if demand > 0 else 1.0
+    }
+
+
+# Per-worker state, loaded once in each pool process instead of being pickled per task
+_worker_data = {}
+
+
+def _init_worker(store_path, attributes):
+    # Every cutoff reads the same preprocessed store and actuals; only the training rows and the
+    # as-of shift of Days_Until_Expiry differ between them
+    data = load_features(store_path, columns=MODEL_FEATURES + [TARGET, TIME_COLUMN])
+    _worker_data['store_path'] = store_path
+    _worker_data['data'] = data
+    _worker_data['actuals'] = monthly_actuals(data)
+    _worker_data['attributes'] = attributes
+
+
+def _run_cutoff(cutoff, horizon, params, threshold, service_level, holding_rate, order_cost):
+    data, actuals = _worker_data['data'], _worker_data['actuals']
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+
+    # History known on the cutoff, as it looked on that date
+    history, as_of = rebase_as_of(data[data[TIME_COLUMN] <= cutoff], _worker_data['store_path'], cutoff)
+    model = RandomForestRegressor(random_state=42, n_jobs=1, **params)
+    model.fit(history[MODEL_FEATURES], history[TARGET])
+
+    quantiles = (service_level,) if service_level else None
+    sku_forecast = RecursiveForecaster(model).forecast(history, horizon, start_date=as_of, quantiles=quantiles)
+    table = reorder_table(sku_forecast, threshold, service_level)
+
+    # Step k of a month-end cutoff forecasts the k-th following calendar month
+    months = month_index([as_of])[0] + sku_forecast['Step'].to_numpy()
+    actual = actuals.reindex(pd.MultiIndex.from_arrays([sku_forecast['SKU'].to_numpy(), months])).to_numpy()
+    observed = ~np.isnan(actual)
+    error = table['Predicted Demand'].to_numpy()[observed] - actual[observed]
+
+    # Policy cost over the SKUs observed in every month of the horizon
+    skus = sku_forecast['SKU'].to_numpy()[:len(sku_forecast) // horizon]
+    complete = observed.reshape(horizon, -1).all(axis=0)
+    attributes = _worker_data['attributes'].reindex(skus[complete])
+    costs = policy_cost(
+        table[np.tile(complete, horizon)], actual.reshape(horizon, -1)[:, complete],
+        attributes['unit_cost'].to_numpy(), attributes['stockout_cost'].to_numpy(), holding_rate, order_cost
+    )
+    return {
+        'Cutoff': as_of.strftime('%Y-%m-%d'),
+        'Train Rows': len(history),
+        'SKUs': len(skus),
+        'Scored Rows': int(observed.sum()),
+        'MAE': float(np.abs(error).mean()) if len(error) else np.nan,
+        'RMSE': float(np.sqrt((error ** 2).mean())) if len(error) else np.nan,
+        'Bias': float(error.mean()) if len(error) else np.nan,
+        **costs,
+        'Wall Seconds': time.perf_counter() - start_wall,
+        'CPU Seconds': time.process_time() - start_cpu
+    }
+
+
+def unit_economics(skus, raw_path=RAW_PATH, store_path=FEATURE_STORE_PATH, default_unit_cost=1.0):
+    # Unit cost and the cost of a lost sale (margin plus goodwill valued at cost) per SKU, priced
+    # as in policy_simulator.py
+    attributes = pd.DataFrame(np.nan, index=skus, columns=['unit_cost', 'price'])
+    if raw_path and os.path.exists(raw_path):
+        from policy_simulator import sku_attributes
+        attributes = sku_attributes(raw_path, load_encoders(default_encoder_path(store_path))).reindex(skus)
+    unit_cost = attributes['unit_cost'].fillna(default_unit_cost)
+    margin = (attributes['price'] - attributes['unit_cost']).clip(lower=0).fillna(unit_cost)
+    return pd.DataFrame({'unit_cost': unit_cost, 'stockout_cost': unit_cost + margin})
+
+
+def run_backtest(store_path=FEATURE_STORE_PATH, n_cutoffs=12, horizon=2, params=None, threshold=0.3,
+                 service_level=None, workers=None, raw_path=RAW_PATH, holding_rate=0.25, order_cost=50.0,
+                 min_train_months=6, output_path=BACKTEST_PATH):
+    # Replays the forecast at historical as-of dates: for each cutoff a model is fit on the history up
+    # to it, forecasts the following months recursively, and its errors and the cost of the reorders
+    # it recommends are scored against what happened. Cutoffs are independent single-core fits
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    with stage("load") as span:
+        columns = load_features(store_path, columns=['SKU', TIME_COLUMN])
+        span['rows'] = len(columns)
+    cutoffs = backtest_cutoffs(columns, n_cutoffs, horizon, min_train_months)
+    if not cutoffs:
+        raise ValueError(f"Not enough history for a {horizon}-month backtest after {min_train_months} months of training")
+    attributes = unit_economics(np.sort(columns['SKU'].unique()), raw_path, store_path)
+    workers = min(workers or os.cpu_count(), len(cutoffs))
+    print(f"Backtesting {len(cutoffs)} cutoffs ({cutoffs[0].date()} to {cutoffs[-1].date()}) "
+          f"x {horizon} months on {workers} workers")
+
+    args = (horizon, params, threshold, service_level, holding_rate, order_cost)
+    results = []
+    with stage("backtest", rows=len(cutoffs)):
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(store_path, attributes)) as pool:
+                futures = [pool.submit(_run_cutoff, cutoff, *args) for cutoff in cutoffs]
+                for future in as_completed(futures):
+                    results.append(future.result())
+        else:
+            _init_worker(store_path, attributes)
+            results = [_run_cutoff(cutoff, *args) for cutoff in cutoffs]
+
+    report = pd.DataFrame(results).sort_values('Cutoff', ignore_index=True)
+    if output_path:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        report.to_csv(output_path, index=False)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rolling-origin backtest of the forecast and its reorder policy")
+    parser.add_argument("--store", default=FEATURE_STORE_PATH)
+    parser.add_argument("--raw", default=RAW_PATH, help="Raw ERP export with unit costs and prices")
+    parser.add_argument("--output", default=BACKTEST_PATH)
+    parser.add_argument("--cutoffs", type=int, default=12, help="Month-end as-of dates to replay, most recent first")
+    parser.add_argument("--horizon", type=int, default=2, help="Months forecast from each cutoff")
+    parser.add_argument("--min-train-months", type=int, default=6)
+    parser.add_argument("--params", type=json.loads, default=None,
+                        help='Forest parameters as JSON, e.g. \'{"max_depth": 20, "min_samples_leaf": 5}\'')
+    parser.add_argument("--threshold", type=float, default=0.3, help="Reorder when stock is below this share of demand")
+    parser.add_argument("--service-level", type=float, default=None, help="Size orders to this demand quantile")
+    parser.add_argument("--holding-rate", type=float, default=0.25, help="Annual holding cost as a share of unit cost")
+    parser.add_argument("--order-cost", type=float, default=50.0, help="Fixed cost per purchase order")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: all cores)")
+    args = parser.parse_args()
+
+    report = run_backtest(args.store, args.cutoffs, args.horizon, args.params, args.threshold, args.service_level,
+                          args.workers, args.raw, args.holding_rate, args.order_cost, args.min_train_months,
+                          args.output)
+    print(report.to_string(index=False))
+    print(f"Mean MAE {report['MAE'].mean():.2f}, RMSE {report['RMSE'].mean():.2f}, "
+          f"policy cost {report['Policy Cost'].mean():,.0f} per cutoff. Report saved to {args.output}")
+    export_metrics("backtest")
@@ -0,0 +1,184 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import subprocess
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+from instrumentation import current_rss_mb, peak_rss_mb
+
+DEFAULT_SCALES = [(10_000, 100), (100_000, 1_000), (1_000_000, 10_000)]
+STAGES = ['preprocess', 'train', 'predict', 'generate_predictions']
+STAGE_OUTPUTS = {'preprocess': 'store', 'train': 'model'}
+
+
+def stage_preprocess(paths, chunksize):
+    from preprocess import preprocess_data
+    from feature_store import load_features
+    preprocess_data(paths['raw'], paths['store'], chunksize=chunksize)
+    return {'output_rows': len(load_features(paths['store'], columns=['SKU']))}
+
+
+def stage_train(paths, chunksize):
+    from train import train_model
+    train_model(paths['store'], paths['model'])
+    return {}
+
+
+def stage_predict(paths, chunksize):
+    from predict import predict
+    forecast = predict(paths['store'], paths['model'], paths['forecast'])
+    return {'output_rows': len(forecast)}
+
+
+def stage_generate_predictions(paths, chunksize):
+    # The forecast behind erp_dashboard.generate_predictions: one cold run, then a slider change
+    from model_backend import load_model
+    from feature_store import load_features, rebase_as_of, store_version
+    from forecast_engine import ForecastEngine
+    model = load_model(paths['model'])
+    data, as_of = rebase_as_of(load_features(paths['store']), paths['store'])
+    engine = ForecastEngine()
+    start = time.perf_counter()
+    forecast = engine.forecast(model, data, 2, 0.3, as_of=as_of, data_key=store_version(paths['store']))
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    engine.forecast(model, data, 2, 0.4, as_of=as_of, data_key=store_version(paths['store']))
+    warm = time.perf_counter() - start
+    return {'output_rows': len(forecast), 'cold_seconds': cold, 'slider_seconds': warm}
+
+
+STAGE_FUNCTIONS = {
+    'preprocess': stage_preprocess,
+    'train': stage_train,
+    'predict': stage_predict,
+    'generate_predictions': stage_generate_predictions
+}
+
+
+def _measure(stage, paths, chunksize):
+    # Runs inside a fresh worker process so peak RSS belongs to this stage alone
+    rss_before = current_rss_mb()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    result = STAGE_FUNCTIONS[stage](paths, chunksize)
+    result.update({
+        'wall_seconds': time.perf_counter() - start_wall,
+        'cpu_seconds': time.process_time() - start_cpu,
+        'rss_before_mb': rss_before,
+        'peak_rss_mb': peak_rss_mb()
+    })
+    return result
+
+
+def run_stage(stage, paths, chunksize):
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(_measure, stage, paths, chunksize).result()
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    versions = {}
+    for package in ['pandas', 'numpy', 'sklearn', 'pyarrow']:
+        try:
+            versions[package] = __import__(package).__version__
+        except ImportError:
+            versions[package] = None
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'packages': versions
+    }
+
+
+def run_benchmark(scales=DEFAULT_SCALES, stages=STAGES, workdir=None, chunksize=1_000_000, keep_data=False):
+    from synthetic_data import generate_dataset
+
+    workdir = workdir or tempfile.mkdtemp(prefix="demand_benchmark_")
+    results = []
+    for n_rows, n_skus in scales:
+        scale_dir = os.path.join(workdir, f"{n_rows}x{n_skus}")
+        paths = {
+            'raw': os.path.join(scale_dir, "raw.csv"),
+            'store': os.path.join(scale_dir, "features.arrow"),
+            'model': os.path.join(scale_dir, "model.pkl"),
+            'forecast': os.path.join(scale_dir, "forecast.csv")
+        }
+        if not os.path.exists(paths['raw']):
+            generate_dataset(n_rows, n_skus, paths['raw'])
+
+        last_stage = max(STAGES.index(stage) for stage in stages)
+        for stage in STAGES[:last_stage + 1]:
+            if stage not in stages:
+                # Upstream stages a requested stage depends on run untimed, unless already on disk
+                output = STAGE_OUTPUTS.get(stage)
+                if output and not os.path.exists(paths[output]):
+                    run_stage(stage, paths, chunksize)
+                continue
+            print(f"[{n_rows} rows x {n_skus} SKUs] {stage}...", flush=True)
+            measurement = run_stage(stage, paths, chunksize)
+            results.append({'rows': n_rows, 'skus': n_skus, 'stage': stage, **measurement})
+            print(f"  {measurement['wall_seconds']:.2f}s wall, {measurement['peak_rss_mb']:.0f} MB peak RSS")
+
+        if not keep_data:
+            shutil.rmtree(scale_dir, ignore_errors=True)
+    return {'environment': environment(), 'results': results}
+
+
+def find_regressions(report, baseline, tolerance=0.25):
+    # Stages whose wall time or peak memory grew by more than the tolerance against a baseline report
+    previous = {(r['rows'], r['skus'], r['stage']): r for r in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        before = previous.get((result['rows'], result['skus'], result['stage']))
+        if before is None:
+            continue
+        for metric in ['wall_seconds', 'peak_rss_mb']:
+            if before.get(metric) and result.get(metric) and result[metric] > before[metric] * (1 + tolerance):
+                regressions.append({
+                    'rows': result['rows'], 'skus': result['skus'], 'stage': result['stage'],
+                    'metric': metric, 'baseline': before[metric], 'current': result[metric]
+                })
+    return regressions
+
+
+def parse_scales(text):
+    return [tuple(int(part) for part in scale.split(":")) for scale in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time and memory-profile the pipeline on synthetic data")
+    parser.add_argument("--scales", type=parse_scales, default=DEFAULT_SCALES,
+                        help="Comma-separated rows:skus pairs, e.g. 10000:100,1000000:10000")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--workdir", default=None, help="Where generated data and artifacts are kept")
+    parser.add_argument("--chunksize", type=int, default=1_000_000, help="Preprocessing chunk size")
+    parser.add_argument("--keep-data", action="store_true")
+    parser.add_argument("--output", default="benchmark_report.json")
+    parser.add_argument("--baseline", default=None, help="Earlier report to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    report = run_benchmark(args.scales, args.stages, args.workdir, args.chunksize, args.keep_data)
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['regressions'] = find_regressions(report, json.load(f), args.tolerance)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark report saved to {args.output}")
+
+    for regression in report.get('regressions', []):
+        print(f"REGRESSION {regression['stage']} at {regression['rows']}x{regression['skus']}: "
+              f"{regression['metric']} {regression['baseline']:.2f} -> {regression['current']:.2f}")
+    sys.exit(1 if report.get('regressions') else 0)
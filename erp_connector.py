@@ -0,0 +1,278 @@
+import os
+import json
+import uuid
+import random
+import asyncio
+import argparse
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import httpx
+from feature_store import FEATURE_STORE_PATH
+from forecaster import latest_rows
+from preprocess import load_encoders, default_encoder_path
+from instrumentation import stage, export_metrics
+
+ERP_BASE_URL = os.environ.get("ERP_BASE_URL", "http://localhost:8001")
+# Watermark of the last inventory pull, and the live stock balances it produced (per encoded SKU)
+SYNC_STATE_PATH = "processed_data/erp_sync.json"
+STOCK_PATH = "processed_data/erp_stock.arrow"
+STOCK_SCHEMA = pa.schema([('SKU', pa.int32()), ('Stock Balance', pa.int32()), ('Updated At', pa.timestamp('us'))])
+# Responses worth retrying: throttling and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class ERPError(Exception):
+    pass
+
+
+class ERPClient:
+    # Async client for the ERP's inventory and order endpoints. One pooled httpx client is kept for
+    # the client's lifetime, so pulls and pushes reuse keep-alive connections instead of reconnecting
+    def __init__(self, base_url=ERP_BASE_URL, max_connections=8, timeout=30.0, max_retries=5, backoff=0.25,
+                 transport=None):
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.transport = transport  # e.g. httpx.ASGITransport(app) to talk to an in-process stub
+        self.client = None
+
+    async def __aenter__(self):
+        limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+        self.client = httpx.AsyncClient(base_url=self.base_url, limits=limits, timeout=self.timeout,
+                                        transport=self.transport)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.client.aclose()
+
+    def retry_delay(self, attempt, response=None):
+        # The server's Retry-After when it sends one, otherwise exponential backoff with full jitter
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+    async def request(self, method, path, **kwargs):
+        # Retries throttled, failed and unreachable requests; anything else is returned or raised as is
+        for attempt in range(self.max_retries + 1):
+            response = None
+            try:
+                response = await self.client.request(method, path, **kwargs)
+                if response.status_code not in RETRY_STATUSES:
+                    if response.is_error:
+                        raise ERPError(f"{method} {path} failed: HTTP {response.status_code} {response.text[:200]}")
+                    try:
+                        return response.json()
+                    except ValueError:
+                        # e.g. a proxy or login page answering 200 with HTML
+                        raise ERPError(f"{method} {path} returned a non-JSON response: {response.text[:200]}")
+                error = f"HTTP {response.status_code}"
+            except httpx.TransportError as exc:
+                error = f"{type(exc).__name__}: {exc}"
+            if attempt < self.max_retries:
+                await asyncio.sleep(self.retry_delay(attempt, response))
+        raise ERPError(f"{method} {path} failed after {self.max_retries + 1} attempts ({error})")
+
+    async def ping(self):
+        await self.request("GET", "/api/inventory", params={'limit': 1})
+        return True
+
+    async def pull_inventory(self, since=None, cursor=None, page_size=5000):
+        # Inventory records changed at or after `since` (every record when None), one page at a time,
+        # with the cursor to resume after each page. Pages are keyset-paginated on (updated_at, sku),
+        # so records changing mid-pull are not skipped, and a saved cursor resumes exactly where a pull ended
+        while True:
+            params = {'limit': page_size}
+            if since:
+                params['since'] = since
+            if cursor:
+                params['cursor'] = cursor
+            page = await self.request("GET", "/api/inventory", params=params)
+            if page['items']:
+                last = page['items'][-1]
+                yield page['items'], page.get('next_cursor') or f"{last['updated_at']}|{last['sku']}"
+            cursor = page.get('next_cursor')
+            if not cursor:
+                return
+
+    async def push_orders(self, orders, batch_size=500, concurrency=4):
+        # Purchase orders in batches of batch_size, at most `concurrency` in flight: batches wait in a
+        # bounded queue for a free worker, so a slow or throttling ERP slows the producer down instead
+        # of piling up requests. Each batch carries an idempotency key, so a retried batch is not booked twice
+        queue = asyncio.Queue(maxsize=concurrency * 2)
+        results = {'created': 0, 'batches': 0, 'failed': []}
+
+        async def worker():
+            while True:
+                batch = await queue.get()
+                try:
+                    response = await self.request("POST", "/api/orders", json=batch,
+                                                  headers={'Idempotency-Key': uuid.uuid4().hex})
+                    results['created'] += response.get('created', len(batch))
+                    results['batches'] += 1
+                except (ERPError, ValueError):
+                    results['failed'].extend(batch)
+                finally:
+                    queue.task_done()
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        try:
+            for start in range(0, len(orders), batch_size):
+                await queue.put(orders[start:start + batch_size])
+            await queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        return results
+
+
+def load_sync_state(state_path=SYNC_STATE_PATH):
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            return json.load(f)
+    return {'watermark': None, 'cursor': None, 'synced_at': None, 'skus': 0}
+
+
+def save_sync_state(state, state_path=SYNC_STATE_PATH):
+    os.makedirs(os.path.dirname(state_path) or ".", exist_ok=True)
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+
+def load_stock(stock_path=STOCK_PATH):
+    # Live stock balances by encoded SKU (empty before the first sync)
+    if not os.path.exists(stock_path):
+        return pd.Series(dtype=np.int32, name='Stock Balance')
+    stock = feather.read_table(stock_path, memory_map=True).to_pandas()
+    return stock.set_index('SKU')['Stock Balance']
+
+
+def upsert_stock(records, sku_codes, stock_path=STOCK_PATH):
+    # Merges pulled records into the stock table, newest record per SKU wins. Returns the number of
+    # records applied; SKUs the encoders have never seen are skipped, the model cannot forecast them
+    pulled = pd.DataFrame(records, columns=['sku', 'current_stock', 'updated_at'])
+    pulled['SKU'] = pulled['sku'].map(sku_codes)
+    pulled = pulled[pulled['SKU'].notna()]
+    fresh = pd.DataFrame({
+        'SKU': pulled['SKU'].astype(np.int32),
+        'Stock Balance': pulled['current_stock'].clip(lower=0).astype(np.int32),
+        'Updated At': pd.to_datetime(pulled['updated_at'], format='ISO8601')
+    })
+    if os.path.exists(stock_path):
+        fresh = pd.concat([feather.read_table(stock_path).to_pandas(), fresh], ignore_index=True)
+    fresh = fresh.sort_values('Updated At', kind='stable').drop_duplicates('SKU', keep='last').sort_values('SKU')
+
+    os.makedirs(os.path.dirname(stock_path) or ".", exist_ok=True)
+    tmp_path = stock_path + ".tmp"
+    feather.write_feather(pa.Table.from_pandas(fresh, schema=STOCK_SCHEMA, preserve_index=False), tmp_path,
+                          compression="uncompressed")
+    os.replace(tmp_path, stock_path)
+    return len(pulled)
+
+
+async def sync_inventory(client, store_path=FEATURE_STORE_PATH, state_path=SYNC_STATE_PATH, stock_path=STOCK_PATH,
+                         page_size=5000):
+    # Pulls the inventory changed since the last sync (resuming after the last record it saw) and merges
+    # it into the live stock table. The watermark only moves once the merge is on disk, so an
+    # interrupted sync is simply repeated
+    state = load_sync_state(state_path)
+    sku_codes = load_encoders(default_encoder_path(store_path))['SKU']
+    records, watermark, cursor = [], state['watermark'], state.get('cursor')
+    with stage("erp_pull") as span:
+        async for page, cursor in client.pull_inventory(state['watermark'], cursor, page_size):
+            records.extend(page)
+            watermark = max([watermark or ''] + [record['updated_at'] for record in page])
+        span['rows'] = len(records)
+    applied = upsert_stock(records, sku_codes, stock_path) if records else 0
+    state.update({'watermark': watermark, 'cursor': cursor, 'synced_at': datetime.now().isoformat(timespec='seconds'),
+                  'skus': len(load_stock(stock_path))})
+    save_sync_state(state, state_path)
+    print(f"Pulled {len(records)} inventory changes ({applied} applied) up to {watermark}")
+    return state
+
+
+def with_live_stock(data, stock):
+    # Feature rows with each SKU's latest Stock Balance replaced by its live ERP balance, so the
+    # forecast and the reorder decisions start from the stock on hand now
+    if stock.empty:
+        return data
+    latest = latest_rows(data)
+    fresh = stock.reindex(latest['SKU']).to_numpy()
+    known = ~np.isnan(fresh)
+    data = data.copy()
+    data.loc[latest.index[known], 'Stock Balance'] = fresh[known].astype(data['Stock Balance'].dtype)
+    return data
+
+
+def order_records(batch):
+    # PO rows (as written by the dashboard) in the ERP's order format
+    columns = [col for col in ['po_id', 'sku', 'quantity', 'order_date', 'expected_delivery'] if col in batch.columns]
+    records = batch[columns].astype({'sku': str, 'quantity': float}).to_dict(orient='records')
+    return [{key: value for key, value in record.items() if not pd.isna(value)} for record in records]
+
+
+async def _push(batch, base_url, batch_size, concurrency):
+    async with ERPClient(base_url, max_connections=concurrency) as client:
+        with stage("erp_push", rows=len(batch)):
+            return await client.push_orders(order_records(batch), batch_size, concurrency)
+
+
+def push_purchase_orders(batch, base_url=ERP_BASE_URL, batch_size=500, concurrency=4):
+    return asyncio.run(_push(batch, base_url, batch_size, concurrency))
+
+
+async def _sync(base_url, store_path, interval=None):
+    # One pull, or one every `interval` seconds on the same pooled client
+    async with ERPClient(base_url) as client:
+        while True:
+            state = await sync_inventory(client, store_path)
+            if not interval:
+                return state
+            await asyncio.sleep(interval)
+
+
+def sync(base_url=ERP_BASE_URL, store_path=FEATURE_STORE_PATH, interval=None):
+    return asyncio.run(_sync(base_url, store_path, interval))
+
+
+def check_connection(base_url=ERP_BASE_URL):
+    async def ping():
+        async with ERPClient(base_url, max_retries=0, timeout=5.0) as client:
+            return await client.ping()
+    # Anything an unreachable, misbehaving or mistyped ERP URL raises means "not connected"
+    try:
+        return asyncio.run(ping())
+    except (ERPError, ValueError, httpx.HTTPError, httpx.InvalidURL):
+        return False
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync stock balances from the ERP and push purchase orders to it")
+    parser.add_argument("command", choices=["sync", "push"])
+    parser.add_argument("batch", nargs="?", help="PO batch CSV to push (see predictions/purchase_orders)")
+    parser.add_argument("--url", default=ERP_BASE_URL)
+    parser.add_argument("--store", default=FEATURE_STORE_PATH)
+    parser.add_argument("--interval", type=float, default=None, help="Keep syncing every this many seconds")
+    parser.add_argument("--batch-size", type=int, default=500, help="Purchase orders per request")
+    parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight at once")
+    args = parser.parse_args()
+    if args.command == "sync":
+        sync(args.url, args.store, args.interval)
+    else:
+        if not args.batch:
+            parser.error("push needs a PO batch CSV")
+        result = push_purchase_orders(pd.read_csv(args.batch), args.url, args.batch_size, args.concurrency)
+        print(f"Pushed {result['created']} purchase orders in {result['batches']} batches, "
+              f"{len(result['failed'])} failed")
+    export_metrics("erp_connector")
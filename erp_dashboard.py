@@ -1,10 +1,16 @@
 import streamlit as st
 import pandas as pd
-import joblib
 import numpy as np
 import os
-from datetime import datetime, timedelta
-from dateutil.relativedelta import relativedelta
+import uuid
+from datetime import datetime
+from feature_store import FEATURE_STORE_PATH, load_features, store_version, default_as_of, rebase_as_of
+from forecast_engine import ForecastEngine, reorder_table, order_dates
+from preprocess import load_encoders, default_encoder_path
+from snapshot import SNAPSHOT_PATH, META_FILE, load_snapshot, FORECAST_PATH_NAME, SKUS_PATH_NAME
+from erp_connector import (ERP_BASE_URL, ERPError, load_sync_state, load_stock, with_live_stock, check_connection,
+                           sync as sync_erp, push_purchase_orders)
+from instrumentation import stage, export_metrics
 
 # Configure page
 st.set_page_config(
@@ -52,58 +58,121 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# Load data and model
+# The dashboard renders from the precomputed snapshot (see snapshot.py); the feature store and the
+# model are only loaded for a what-if forecast the snapshot does not cover
+def snapshot_mtime():
+    # Part of the snapshot caches' keys, so a rebuilt snapshot (written as a new directory) is picked up
+    meta_path = os.path.join(SNAPSHOT_PATH, META_FILE)
+    return os.path.getmtime(meta_path) if os.path.exists(meta_path) else None
+
+@st.cache_resource(max_entries=1)
+def load_snapshot_at(mtime):
+    return load_snapshot()
+
+def get_snapshot():
+    return load_snapshot_at(snapshot_mtime())
+
 @st.cache_data
-def load_data():
-    return pd.read_csv("processed_data/medicine_inventory_cleaned.csv")
+def snapshot_predictions(version, months_ahead=2, threshold=0.3, service_level=None, watermark=None):
+    # Reorder tables from the snapshot's forecast, without the model. With live ERP stock (synced up to
+    # `watermark`) the reorders start from the synced balances; the demand forecast stays the snapshot's
+    sku_forecast = get_snapshot().frame(FORECAST_PATH_NAME)
+    sku_forecast = sku_forecast[sku_forecast['Step'] <= months_ahead]
+    if watermark is not None:
+        fresh = load_stock().reindex(sku_forecast['SKU']).to_numpy()
+        stock = sku_forecast['Stock Balance'].to_numpy()
+        sku_forecast = sku_forecast.assign(**{'Stock Balance': np.where(np.isnan(fresh), stock, fresh)})
+    with stage("reorder_table", rows=len(sku_forecast)):
+        return reorder_table(sku_forecast, threshold, service_level)
+
+# Load data and model (the data as of the selected date; by default the date the store was built for)
+@st.cache_data
+def load_data(as_of=None):
+    with stage("load_data") as span:
+        data, _ = rebase_as_of(load_features(FEATURE_STORE_PATH), FEATURE_STORE_PATH, as_of)
+        span['rows'] = len(data)
+    return data
 
 @st.cache_resource
 def load_model():
-    return joblib.load("models/demand_forecasting_rf.pkl")
+    # Imported here: loading a pickled forest pulls in joblib and scikit-learn
+    from model_backend import load_model as load_forecast_model
+    return load_forecast_model()
 
-# Generate predictions
-def generate_predictions(model, data, months_ahead=2):
-    features = [
-        'SKU', 'Stock In', 'Stock Out', 'Stock Balance', 'Days_Until_Expiry', 'Lead_Time',
-        'Season', 'Holiday', 'Promotion', 'Lag_1', 'Lag_2', 'Lag_3', 
-        'Moving Average', 'Order_Day', 'Order_Month', 'Order_Weekday', 'Days_Since_Last_Order'
-    ]
-    
-    all_forecasts = []
-    
-    for month_offset in range(1, months_ahead + 1):
-        forecast_date = datetime.now() + relativedelta(months=month_offset)
-        forecast_month = forecast_date.month
-        
-        # Create prediction dataset
-        pred_data = data.copy()
-        pred_data['Order Month'] = forecast_month
-        pred_data['Order Year'] = forecast_date.year
-        
-        # Make predictions
-        pred_data['Predicted Demand'] = model.predict(pred_data[features])
-        
-        # Aggregate by SKU
-        monthly_forecast = pred_data.groupby(['SKU']).agg({
-            'Predicted Demand': 'sum',
-            'Stock Balance': 'last',
-            'Lead_Time': 'mean'
-        }).reset_index()
-        
-        # Calculate reorder logic
-        monthly_forecast['Reorder Threshold'] = monthly_forecast['Predicted Demand'] * 0.3  # 30% of predicted demand
-        monthly_forecast['Reorder Needed'] = monthly_forecast['Stock Balance'] < monthly_forecast['Reorder Threshold']
-        monthly_forecast['Reorder Quantity'] = np.where(
-            monthly_forecast['Reorder Needed'],
-            monthly_forecast['Predicted Demand'] - monthly_forecast['Stock Balance'],
-            0
-        )
-        monthly_forecast['Recommended Order Date'] = forecast_date.replace(day=1).strftime('%Y-%m-%d')
-        monthly_forecast['Month'] = forecast_date.strftime('%B %Y')
-        
-        all_forecasts.append(monthly_forecast)
-    
-    return pd.concat(all_forecasts, ignore_index=True)
+@st.cache_data
+def load_data_version(as_of):
+    return f"{store_version(FEATURE_STORE_PATH)}@{as_of:%Y-%m-%d}"
+
+@st.cache_data
+def load_live_data(as_of, watermark):
+    # Store rows with each SKU's latest stock replaced by the ERP balance synced up to `watermark`
+    return with_live_stock(load_data(as_of), load_stock())
+
+@st.cache_data
+def load_store_as_of(mtime):
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        return pd.Timestamp(snapshot.meta['as_of'])
+    return default_as_of(FEATURE_STORE_PATH)
+
+@st.cache_resource
+def get_forecast_engine():
+    return ForecastEngine()
+
+# Generate predictions (memoized per data/model version, see forecast_engine.py)
+def generate_predictions(model, data, months_ahead=2, threshold=0.3, data_key=None, service_level=None, as_of=None):
+    with stage("generate_predictions", rows=len(data)):
+        return get_forecast_engine().forecast(model, data, months_ahead, threshold, as_of=as_of, data_key=data_key,
+                                              service_level=service_level)
+
+# Order table columns, and the sorts offered on it (most urgent = latest order date soonest)
+ORDER_COLUMNS = ['SKU', 'Month', 'Order By', 'Days Left', 'Reorder Quantity', 'Stock Balance',
+                 'Predicted Demand', 'Lead_Time', 'Recommended Order Date']
+ORDER_SORTS = {
+    "Most urgent first": (['Order By', 'Reorder Quantity'], [True, False]),
+    "Largest quantity first": (['Reorder Quantity', 'Order By'], [False, True]),
+    "SKU": (['SKU', 'Order By'], [True, True])
+}
+PO_BATCH_DIR = "predictions/purchase_orders"
+
+@st.cache_data
+def load_sku_labels(mtime):
+    # ERP SKU labels by encoded SKU, for purchase orders
+    snapshot = get_snapshot()
+    if snapshot is not None:
+        skus = snapshot.table(SKUS_PATH_NAME)
+        return dict(zip(skus.column('SKU').to_pylist(), skus.column('SKU Label').to_pylist()))
+    encoders = load_encoders(default_encoder_path(FEATURE_STORE_PATH))
+    return {code: label for label, code in encoders['SKU'].items()}
+
+# Reorder rows with the latest order date (order-by date) computed as one column
+def order_recommendations(predictions, lead_time_buffer, as_of):
+    reorder_items = predictions[predictions['Reorder Needed']].copy()
+    reorder_items['Order By'] = order_dates(reorder_items, lead_time_buffer).dt.normalize()
+    reorder_items['Days Left'] = (reorder_items['Order By'] - as_of).dt.days
+    reorder_items['PO Key'] = reorder_items['SKU'].astype(str) + "|" + reorder_items['Recommended Order Date']
+    return reorder_items
+
+def purchase_orders(items):
+    # One purchase order per selected SKU and month, in the record format of the ERP service
+    labels = load_sku_labels(snapshot_mtime())
+    created_at = datetime.now().isoformat(timespec='seconds')
+    return pd.DataFrame({
+        'po_id': [uuid.uuid4().hex[:12] for _ in range(len(items))],
+        'created_at': created_at,
+        'sku': items['SKU'].map(lambda code: labels.get(code, str(code))).to_numpy(),
+        'quantity': np.ceil(items['Reorder Quantity']).astype(int).to_numpy(),
+        'order_date': items['Order By'].dt.strftime('%Y-%m-%d').to_numpy(),
+        'expected_delivery': items['Recommended Order Date'].to_numpy()
+    })
+
+def write_po_batch(batch, output_dir=PO_BATCH_DIR):
+    # The whole selection goes into a single file, written atomically
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, f"po_batch_{datetime.now():%Y%m%d_%H%M%S}_{uuid.uuid4().hex[:6]}.csv")
+    batch.to_csv(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+    return path
 
 # Main app
 def main():
@@ -112,34 +181,60 @@ def main():
     **AI-powered demand forecasting solution** for inventory optimization
     """)
     
-    # Load data and model
-    data = load_data()
-    model = load_model()
-    
-    # Sidebar - ERP integration demo
+    # Sidebar - ERP integration (connected once a stock sync has succeeded, see erp_connector.py)
+    sync_state = load_sync_state()
+    erp_connected = sync_state['synced_at'] is not None
     with st.sidebar:
         st.subheader("ERP Integration Settings")
-        erp_connected = st.checkbox("Simulate ERP Connection", value=True)
+        erp_url = st.text_input("ERP URL", ERP_BASE_URL)
+        use_live_stock = st.checkbox("Use Live ERP Stock", value=erp_connected, disabled=not erp_connected)
         auto_ordering = st.checkbox("Enable Automated Ordering", value=True)
+        push_to_erp = st.checkbox("Push POs to ERP", value=erp_connected, disabled=not auto_ordering)
         alert_threshold = st.slider("Low Stock Alert Threshold (%)", 20, 50, 30)
         
         st.markdown("---")
         st.subheader("Forecast Parameters")
+        as_of = pd.Timestamp(st.date_input("As-of Date", value=load_store_as_of(snapshot_mtime()).date()))
         forecast_months = st.slider("Months to Forecast", 1, 6, 2)
         lead_time_buffer = st.slider("Lead Time Buffer (days)", 1, 14, 7)
+        use_service_level = st.checkbox("Size Orders to a Service Level", value=False)
+        service_level = st.slider("Service Level (%)", 50, 99, 95, disabled=not use_service_level)
+        rerun_model = st.checkbox("What-if: Rerun the Forecast Model", value=False,
+                                  help="Re-forecast from the feature store (and live ERP stock) instead of the snapshot")
         
         st.markdown("---")
         st.markdown("**System Status**")
         if erp_connected:
-            st.success("✅ Connected to ERP System")
+            st.success(f"✅ ERP stock synced {sync_state['synced_at']}")
         else:
-            st.warning("⚠️ ERP Not Connected")
+            st.warning("⚠️ ERP Not Synced")
         
         if auto_ordering:
             st.info("🤖 Auto-Ordering Enabled")
     
-    # Generate predictions
-    predictions = generate_predictions(model, data, forecast_months)
+    # Generate predictions: from the snapshot when it covers the settings, otherwise as a what-if forecast
+    snapshot = get_snapshot()
+    order_level = service_level / 100 if use_service_level else None
+    watermark = sync_state['watermark'] if use_live_stock and erp_connected else None
+    if snapshot is not None and not rerun_model and snapshot.covers(as_of, forecast_months, order_level):
+        predictions = snapshot_predictions(snapshot.version, forecast_months, alert_threshold / 100, order_level,
+                                           watermark)
+        st.caption(f"Forecast snapshot of {snapshot.meta['created_at']}, as of {snapshot.meta['as_of']}")
+    else:
+        # Load data and model
+        data_key = load_data_version(as_of)
+        if watermark is not None:
+            data = load_live_data(as_of, watermark)
+            data_key += f"|erp@{watermark}"
+        else:
+            data = load_data(as_of)
+        with st.spinner("Loading the model for a what-if forecast..."):
+            model = load_model()
+            predictions = generate_predictions(
+                model, data, forecast_months, threshold=alert_threshold / 100, data_key=data_key,
+                service_level=order_level, as_of=as_of
+            )
+        st.caption(f"What-if forecast as of {as_of:%Y-%m-%d}")
     
     # Main dashboard
     tab1, tab2, tab3 = st.tabs(["📋 Inventory Overview", "📅 Order Recommendations", "⚙️ ERP Integration"])
@@ -152,7 +247,7 @@ def main():
         with col1:
             selected_sku = st.selectbox(
                 "Select SKU",
-                options=data['SKU'].unique(),
+                options=predictions['SKU'].unique(),
                 format_func=lambda x: f"SKU-{x}"
             )
         with col2:
@@ -233,51 +328,94 @@ def main():
         st.markdown('<div class="header-style">Order Recommendations</div>', unsafe_allow_html=True)
         
         # Filter for items needing reorder
-        reorder_items = predictions[predictions['Reorder Needed']].copy()
+        reorder_items = order_recommendations(predictions, lead_time_buffer, as_of)
         
         if not reorder_items.empty:
-            # Group by month
-            for month in reorder_items['Month'].unique():
-                month_data = reorder_items[reorder_items['Month'] == month]
-                
+            # One summary banner per forecast month
+            for month, count in reorder_items.groupby('Month', sort=False).size().items():
                 st.markdown(f'<div class="reorder-alert">'
                            f'<h3>📅 {month} Reorders</h3>'
-                           f'<p>{len(month_data)} products require replenishment</p>'
+                           f'<p>{count} products require replenishment</p>'
                            '</div>', unsafe_allow_html=True)
-                
-                # Display order recommendations
-                for _, row in month_data.iterrows():
-                    order_date = (datetime.strptime(row['Recommended Order Date'], '%Y-%m-%d') - 
-                                timedelta(days=row['Lead_Time'] + lead_time_buffer))
-                    
-                    with st.expander(f"SKU-{row['SKU']} - {int(row['Reorder Quantity'])} units"):
-                        col1, col2 = st.columns(2)
-                        with col1:
-                            st.markdown(f"""
-                            **Order Details**
-                            - Current Stock: {int(row['Stock Balance'])}
-                            - Predicted Demand: {int(row['Predicted Demand'])}
-                            - Reorder Quantity: **{int(row['Reorder Quantity'])}**
-                            - Lead Time: {int(row['Lead_Time'])} days
-                            """)
-                        
-                        with col2:
-                            st.markdown(f"""
-                            **Timing**
-                            - Forecast Month: {month}
-                            - Recommended Order Date: {order_date.strftime('%Y-%m-%d')}
-                            - Expected Delivery: {row['Recommended Order Date']}
-                            """)
-                        
-                        if auto_ordering:
-                            if st.button(f"📝 Generate PO for SKU-{row['SKU']}", key=f"po_{row['SKU']}_{month}"):
-                                st.success(f"""
-                                **Purchase Order Generated**
-                                - SKU: {row['SKU']}
-                                - Quantity: {int(row['Reorder Quantity'])}
-                                - Order Date: {order_date.strftime('%Y-%m-%d')}
-                                - Expected Delivery: {row['Recommended Order Date']}
-                                """)
+            
+            # Filters and sorting
+            col1, col2, col3 = st.columns([2, 2, 1])
+            with col1:
+                months = st.multiselect("Forecast Month", reorder_items['Month'].unique())
+            with col2:
+                sort_by = st.selectbox("Sort by", list(ORDER_SORTS))
+            with col3:
+                page_size = st.selectbox("Rows per page", [25, 50, 100, 250], index=1)
+            
+            visible = reorder_items[reorder_items['Month'].isin(months)] if months else reorder_items
+            sort_columns, ascending = ORDER_SORTS[sort_by]
+            visible = visible.sort_values(sort_columns, ascending=ascending, kind='stable')
+            
+            # Selected orders survive paging, filtering and reruns
+            selection = st.session_state.setdefault('po_selection', set())
+            # Bumped whenever the selection changes outside the table, so the editor redraws from it
+            version = st.session_state.setdefault('po_version', 0)
+            
+            n_pages = max(1, -(-len(visible) // page_size))
+            col1, col2 = st.columns([1, 3])
+            with col1:
+                page = st.number_input(f"Page (of {n_pages})", min_value=1, max_value=n_pages, value=1)
+            with col2:
+                st.markdown(f"**{len(visible)}** orders shown, **{len(selection)}** selected")
+            
+            page_items = visible.iloc[(page - 1) * page_size:page * page_size]
+            columns = ORDER_COLUMNS + (['Safety Stock'] if 'Safety Stock' in visible.columns else [])
+            table = page_items[columns].copy()
+            table.insert(0, 'Select', page_items['PO Key'].isin(selection).to_numpy())
+            edited = st.data_editor(
+                table,
+                column_config={
+                    'Select': st.column_config.CheckboxColumn("Select"),
+                    'SKU': st.column_config.NumberColumn("SKU", format="SKU-%d"),
+                    'Order By': st.column_config.DateColumn("Order By"),
+                    'Reorder Quantity': st.column_config.NumberColumn("Reorder Quantity", format="%d"),
+                    'Predicted Demand': st.column_config.NumberColumn("Predicted Demand", format="%d"),
+                    'Lead_Time': st.column_config.NumberColumn("Lead Time (days)", format="%.0f")
+                },
+                disabled=columns,
+                hide_index=True,
+                use_container_width=True,
+                key=f"po_page_{version}_{sort_by}_{'|'.join(months)}_{page_size}_{page}"
+            )
+            checked = edited['Select'].to_numpy()
+            page_keys = page_items['PO Key'].to_numpy()
+            selection.difference_update(page_keys[~checked])
+            selection.update(page_keys[checked])
+            
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                if st.button(f"Select all {len(visible)} shown"):
+                    selection.update(visible['PO Key'])
+                    st.session_state['po_version'] += 1
+                    st.rerun()
+            with col2:
+                if st.button("Clear selection"):
+                    selection.clear()
+                    st.session_state['po_version'] += 1
+                    st.rerun()
+            with col3:
+                if auto_ordering and st.button(f"📝 Generate POs for {len(selection)} selected", type="primary",
+                                               disabled=not selection):
+                    batch = purchase_orders(reorder_items[reorder_items['PO Key'].isin(selection)])
+                    path = write_po_batch(batch)
+                    selection.clear()
+                    st.session_state['po_version'] += 1
+                    st.success(f"**Purchase Order batch generated**: {len(batch)} orders, "
+                               f"{int(batch['quantity'].sum())} units, saved to `{path}`")
+                    if push_to_erp:
+                        with st.spinner("Pushing purchase orders to the ERP..."):
+                            result = push_purchase_orders(batch, erp_url)
+                        if result['failed']:
+                            st.error(f"{len(result['failed'])} purchase orders were not accepted by the ERP; "
+                                     f"push them again with `python erp_connector.py push {path}`")
+                        else:
+                            st.success(f"Pushed {result['created']} purchase orders to the ERP")
+                    st.download_button("Download PO batch", batch.to_csv(index=False), os.path.basename(path), "text/csv")
         else:
             st.success("No reorder recommendations at this time")
     
@@ -295,31 +433,37 @@ def main():
                    '</ul>'
                    '</div>', unsafe_allow_html=True)
         
-        # ERP integration demo
-        st.subheader("Integration Demo")
+        # ERP integration status
+        st.subheader("Integration Status")
         
         col1, col2 = st.columns(2)
         with col1:
             st.markdown("**Current Integration Status**")
             if erp_connected:
-                st.success("✅ Successfully connected to ERP API")
-                st.metric("Last Sync", datetime.now().strftime("%Y-%m-%d %H:%M"))
-                st.metric("SKUs Synced", len(data))
+                st.success("✅ Stock balances synced from the ERP API")
+                st.metric("Last Sync", sync_state['synced_at'])
+                st.metric("SKUs Synced", sync_state['skus'])
+                st.caption(f"Changes pulled up to {sync_state['watermark']}")
             else:
-                st.warning("ERP connection not configured")
+                st.warning("No ERP sync yet - run `python erp_connector.py sync` or sync now")
         
         with col2:
-            st.markdown("**Available ERP Systems**")
-            erp_system = st.selectbox(
-                "Select your ERP",
-                ["SAP", "Oracle", "Microsoft Dynamics", "Infor", "Other"]
-            )
+            st.markdown("**ERP Connection**")
+            st.caption(f"`{erp_url}`")
             
             if st.button("Test Connection"):
-                if erp_connected:
-                    st.success(f"Successfully connected to {erp_system} ERP system")
+                if check_connection(erp_url):
+                    st.success(f"Successfully connected to the ERP at {erp_url}")
                 else:
-                    st.error("Connection failed - check credentials")
+                    st.error("Connection failed - check the ERP URL")
+            
+            if st.button("Sync Stock Now"):
+                try:
+                    with st.spinner("Pulling inventory changes..."):
+                        sync_erp(erp_url)
+                    st.rerun()
+                except ERPError as exc:
+                    st.error(f"Sync failed: {exc}")
         
         # API documentation
         with st.expander("🛠️ Integration Technical Details"):
@@ -344,4 +488,6 @@ def main():
             """)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
+    # Metrics of each rerun are appended to the log and replace the dashboard's textfile
+    export_metrics("erp_dashboard")
\ No newline at end of file
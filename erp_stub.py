@@ -0,0 +1,129 @@
+import os
+import asyncio
+import argparse
+import random
+from datetime import datetime
+from typing import List, Optional
+import numpy as np
+from fastapi import FastAPI, Header, HTTPException, Query
+from fastapi.responses import JSONResponse
+from feature_store import FEATURE_STORE_PATH, load_features, TIME_COLUMN
+from forecaster import latest_rows
+from preprocess import load_encoders, default_encoder_path
+
+# Local stand-in for the ERP's inventory and order endpoints, for exercising erp_connector.py without
+# a real ERP. Stock moves only when /stub/activity is called; latency, failures and throttling are injectable
+
+
+def seed_inventory(store_path=FEATURE_STORE_PATH, n_skus=None):
+    # The latest Stock Balance of every SKU in the feature store, under its ERP label, or n_skus
+    # synthetic SKUs when there is no store (or a size is asked for)
+    if n_skus is None and os.path.exists(store_path):
+        latest = latest_rows(load_features(store_path, columns=['SKU', 'Stock Balance', TIME_COLUMN]))
+        labels = {code: label for label, code in load_encoders(default_encoder_path(store_path))['SKU'].items()}
+        skus = latest['SKU'].map(lambda code: labels.get(code, str(code)))
+        return dict(zip(skus, latest['Stock Balance'].astype(int)))
+    rng = np.random.default_rng(0)
+    return {f"SKU_{i}": int(stock) for i, stock in enumerate(rng.integers(0, 500, n_skus or 1000))}
+
+
+class StubERP:
+    def __init__(self, inventory, latency_ms=0, failure_rate=0.0, max_inflight=None):
+        now = datetime.now().isoformat(timespec='microseconds')
+        self.stock = dict(inventory)
+        self.updated = {sku: now for sku in self.stock}
+        self.orders = []
+        self.idempotency_keys = {}
+        self.latency = latency_ms / 1000
+        self.failure_rate = failure_rate
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.rng = random.Random(0)
+
+    def changes(self, since, cursor, limit):
+        # Records updated at or after `since`, ordered by (updated_at, sku) and resumed after the cursor
+        keys = sorted((updated, sku) for sku, updated in self.updated.items() if not since or updated >= since)
+        if cursor:
+            after = tuple(cursor.split('|', 1))
+            keys = [key for key in keys if key > after]
+        page = keys[:limit]
+        items = [{'sku': sku, 'current_stock': self.stock[sku], 'updated_at': updated} for updated, sku in page]
+        next_cursor = "|".join(page[-1]) if len(keys) > limit else None
+        return {'items': items, 'next_cursor': next_cursor}
+
+    def activity(self, n):
+        # Moves the stock of n random SKUs, as sales and receipts would
+        now = datetime.now().isoformat(timespec='microseconds')
+        for sku in self.rng.sample(sorted(self.stock), min(n, len(self.stock))):
+            self.stock[sku] = max(0, self.stock[sku] + self.rng.randint(-50, 50))
+            self.updated[sku] = now
+        return now
+
+
+def create_app(inventory, latency_ms=0, failure_rate=0.0, max_inflight=None):
+    erp = StubERP(inventory, latency_ms, failure_rate, max_inflight)
+    app = FastAPI(title="ERP stand-in")
+    app.state.erp = erp
+
+    async def simulate():
+        # Returns the error response to send instead, if this request is throttled or fails
+        if erp.max_inflight and erp.inflight >= erp.max_inflight:
+            return JSONResponse({'detail': "Too many requests"}, status_code=429, headers={'Retry-After': "0.05"})
+        if erp.latency:
+            await asyncio.sleep(erp.latency)
+        if erp.failure_rate and erp.rng.random() < erp.failure_rate:
+            return JSONResponse({'detail': "Transient failure"}, status_code=503)
+        return None
+
+    @app.get("/api/inventory")
+    async def get_inventory(since: Optional[str] = None, cursor: Optional[str] = None,
+                            limit: int = Query(5000, ge=1, le=100000)):
+        error = await simulate()
+        return error or erp.changes(since, cursor, limit)
+
+    @app.post("/api/orders", status_code=201)
+    async def create_orders(orders: List[dict], idempotency_key: Optional[str] = Header(None)):
+        error = await simulate()
+        if error:
+            return error
+        erp.inflight += 1
+        try:
+            # A repeated key (a retry of a batch that was booked) returns the first response
+            if idempotency_key in erp.idempotency_keys:
+                return erp.idempotency_keys[idempotency_key]
+            for order in orders:
+                if order.get('sku') not in erp.stock:
+                    raise HTTPException(status_code=422, detail=f"Unknown SKU {order.get('sku')}")
+            if erp.latency:
+                await asyncio.sleep(erp.latency)
+            erp.orders.extend(orders)
+            response = {'created': len(orders)}
+            if idempotency_key:
+                erp.idempotency_keys[idempotency_key] = response
+            return response
+        finally:
+            erp.inflight -= 1
+
+    @app.post("/stub/activity")
+    async def stub_activity(n: int = Query(100, ge=1)):
+        return {'updated': n, 'updated_at': erp.activity(n)}
+
+    @app.get("/stub/orders")
+    async def stub_orders():
+        return {'orders': len(erp.orders)}
+
+    return app
+
+
+if __name__ == "__main__":
+    import uvicorn
+    parser = argparse.ArgumentParser(description="Run a local stand-in ERP for erp_connector.py")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--store", default=FEATURE_STORE_PATH, help="Seed stock balances from this feature store")
+    parser.add_argument("--skus", type=int, default=None, help="Seed this many synthetic SKUs instead")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Added to every request")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Share of requests answered with a 503")
+    parser.add_argument("--max-inflight", type=int, default=None, help="Concurrent order posts before a 429")
+    args = parser.parse_args()
+    app = create_app(seed_inventory(args.store, args.skus), args.latency_ms, args.failure_rate, args.max_inflight)
+    uvicorn.run(app, host="127.0.0.1", port=args.port)
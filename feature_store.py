@@ -0,0 +1,308 @@
+import os
+import shutil
+import json
+import hashlib
+import time
+import uuid
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+
+FEATURE_STORE_PATH = "processed_data/medicine_inventory_cleaned.arrow"
+
+# Model inputs, target and the time column used to order history
+MODEL_FEATURES = [
+    'SKU', 'Stock In', 'Stock Out', 'Stock Balance', 'Days_Until_Expiry', 'Lead_Time',
+    'Season', 'Holiday', 'Promotion', 'Lag_1', 'Lag_2', 'Lag_3',
+    'Moving Average', 'Order_Day', 'Order_Month', 'Order_Weekday', 'Days_Since_Last_Order'
+]
+TARGET = 'Demand Forecast'
+TIME_COLUMN = 'Order Date'
+# Planning hierarchy kept alongside the features (encoded like SKU), not used by the model
+HIERARCHY_COLUMNS = ['Country', 'Distributor ID', 'Distributor Type', 'Category']
+# Schema metadata key holding the as-of date calendar features (Days_Until_Expiry) were computed against
+AS_OF_KEY = b'as_of'
+
+# Compact column types for the processed feature table (nullable in Arrow, so NaT-derived gaps survive)
+FEATURE_SCHEMA = pa.schema([
+    ('SKU', pa.int32()),
+    ('Stock In', pa.int32()),
+    ('Stock Out', pa.int32()),
+    ('Stock Balance', pa.int32()),
+    ('Days_Until_Expiry', pa.int32()),
+    ('Lead_Time', pa.int16()),
+    ('Season', pa.int8()),
+    ('Holiday', pa.int8()),
+    ('Promotion', pa.int8()),
+    ('Lag_1', pa.int32()),
+    ('Lag_2', pa.int32()),
+    ('Lag_3', pa.int32()),
+    ('Moving Average', pa.float32()),
+    ('Demand Forecast', pa.int32()),
+    ('Order_Day', pa.int8()),
+    ('Order_Month', pa.int8()),
+    ('Order_Weekday', pa.int8()),
+    ('Days_Since_Last_Order', pa.float32()),
+    ('Country', pa.int16()),
+    ('Distributor ID', pa.int16()),
+    ('Distributor Type', pa.int16()),
+    ('Category', pa.int16()),
+    ('Order Date', pa.timestamp('s')),
+])
+
+
+def restore_types(table):
+    # Known feature columns get their compact type, anything else keeps the type Arrow inferred
+    known = {field.name: field.type for field in FEATURE_SCHEMA}
+    return table.cast(pa.schema([
+        pa.field(name, known.get(name, field.type)) for name, field in zip(table.column_names, table.schema)
+    ]))
+
+
+def to_table(df, metadata=None):
+    table = restore_types(pa.Table.from_pandas(df, preserve_index=False))
+    return table.replace_schema_metadata(metadata) if metadata else table
+
+
+def as_of_date(value):
+    # A run's as-of date (midnight). There is no wall-clock default: a run is dated by its data
+    if value is None:
+        raise ValueError("No as-of date: pass one, or build the store with its as-of date recorded")
+    return pd.Timestamp(value).normalize()
+
+
+class FeatureStoreWriter:
+    # Incrementally writes DataFrame chunks either to a single uncompressed (memory-mappable)
+    # Arrow IPC file, or to a hive-partitioned directory of them, e.g. Order_Month=4/part-0-0.arrow.
+    # The as-of date the rows were computed against is recorded in the schema metadata
+    def __init__(self, path, partition_cols=None, as_of=None):
+        self.path = path
+        self.partition_cols = partition_cols
+        self.metadata = {AS_OF_KEY: as_of_date(as_of).strftime('%Y-%m-%d').encode()} if as_of is not None else None
+        self.writer = None
+        self.schema = None
+        self.parts = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def write(self, df):
+        table = to_table(df, self.metadata)
+        if self.parts == 0:
+            # Replaces the store whichever layout it had (appends turn a single file into a directory)
+            if os.path.isdir(self.path):
+                shutil.rmtree(self.path)
+            elif os.path.exists(self.path):
+                os.remove(self.path)
+        if self.partition_cols:
+            ds.write_dataset(
+                table, self.path, format="ipc", partitioning=self.partition_cols, partitioning_flavor="hive",
+                basename_template=f"part-{self.parts}-{{i}}.arrow", existing_data_behavior="overwrite_or_ignore"
+            )
+        else:
+            if self.writer is None:
+                self.schema = table.schema
+                self.writer = pa.ipc.new_file(self.path, self.schema)
+            self.writer.write_table(table.cast(self.schema))
+        self.parts += 1
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_feature_store(df, path, partition_cols=None, as_of=None):
+    with FeatureStoreWriter(path, partition_cols, as_of) as writer:
+        writer.write(df)
+
+
+def partition_columns(path):
+    # Partition keys of a hive-partitioned store, read off its directory names
+    columns = []
+    while True:
+        subdirs = [entry for entry in os.scandir(path) if entry.is_dir() and '=' in entry.name]
+        if not subdirs:
+            return columns
+        columns.append(subdirs[0].name.split('=', 1)[0])
+        path = subdirs[0].path
+
+
+def append_features(df, path=FEATURE_STORE_PATH):
+    # Appends only ever write the new rows, as one more part file (named so parts list in append
+    # order). A single-file store first becomes a directory holding that file as its first part,
+    # a rename rather than a rewrite
+    if not os.path.isdir(path):
+        parts_dir = path + ".parts"
+        os.makedirs(parts_dir, exist_ok=True)
+        os.replace(path, os.path.join(parts_dir, "part-0-0.arrow"))
+        os.replace(parts_dir, path)
+    schema = ds.dataset(path, format="ipc", partitioning="hive").schema
+    table = to_table(df).select(schema.names).cast(schema)
+    ds.write_dataset(
+        table, path, format="ipc", partitioning=partition_columns(path), partitioning_flavor="hive",
+        basename_template=f"part-{time.time_ns()}-{uuid.uuid4().hex[:6]}-{{i}}.arrow",
+        existing_data_behavior="overwrite_or_ignore"
+    )
+
+
+def read_csv_features(path, columns=None, **kwargs):
+    # Timestamps cannot be parsed through dtype=, so the date column goes through parse_dates
+    dtypes = {field.name: field.type.to_pandas_dtype() for field in FEATURE_SCHEMA if not pa.types.is_timestamp(field.type)}
+    dates = [field.name for field in FEATURE_SCHEMA
+             if pa.types.is_timestamp(field.type) and (columns is None or field.name in columns)]
+    return pd.read_csv(path, usecols=columns, dtype=dtypes, parse_dates=dates, **kwargs)
+
+
+def load_features(path=FEATURE_STORE_PATH, columns=None, filter=None):
+    # Legacy CSV outputs are still readable, parsed straight into the compact dtypes
+    if path.endswith(".csv"):
+        return read_csv_features(path, columns)
+
+    if os.path.isdir(path):
+        dataset = ds.dataset(path, format="ipc", partitioning="hive")
+        table = dataset.to_table(columns=columns, filter=filter)
+        # Partition keys come back with inferred types and at the end; restore type and order
+        if columns is None:
+            position = {name: i for i, name in enumerate(FEATURE_SCHEMA.names)}
+            columns = sorted(table.column_names, key=lambda col: position.get(col, len(position)))
+        table = restore_types(table.select(columns))
+    else:
+        table = feather.read_table(path, columns=columns, memory_map=True)
+        if filter is not None:
+            table = table.filter(filter)
+    return table.to_pandas()
+
+
+def iter_features(path=FEATURE_STORE_PATH, columns=None, batch_rows=1_000_000):
+    # The store as a stream of DataFrames of at most batch_rows rows, so it never has to fit in memory
+    if path.endswith(".csv"):
+        yield from read_csv_features(path, columns, chunksize=batch_rows)
+        return
+    if os.path.isdir(path):
+        dataset = ds.dataset(path, format="ipc", partitioning="hive")
+    else:
+        dataset = ds.dataset(path, format="ipc")
+    for batch in dataset.to_batches(columns=columns, batch_size=batch_rows):
+        if batch.num_rows:
+            yield restore_types(pa.Table.from_batches([batch])).to_pandas()
+
+
+def feature_columns(path=FEATURE_STORE_PATH):
+    # Column names of a store, read from its schema without loading any rows
+    if path.endswith(".csv"):
+        return list(pd.read_csv(path, nrows=0).columns)
+    return store_schema(path).names
+
+
+def store_schema(path=FEATURE_STORE_PATH):
+    if os.path.isdir(path):
+        return ds.dataset(path, format="ipc", partitioning="hive").schema
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).schema
+
+
+def store_as_of(path=FEATURE_STORE_PATH):
+    # The as-of date a store was built for, or None (CSV outputs and stores written before it was recorded)
+    if path.endswith(".csv") or not os.path.exists(path):
+        return None
+    value = (store_schema(path).metadata or {}).get(AS_OF_KEY)
+    return pd.Timestamp(value.decode()) if value else None
+
+
+def default_as_of(path=FEATURE_STORE_PATH):
+    # The date the store was built for, else (CSV outputs, older stores) its latest order date
+    built = store_as_of(path)
+    return built if built is not None else as_of_date(store_summary(path)['last_order_date'])
+
+
+def rebase_as_of(df, path=FEATURE_STORE_PATH, as_of=None):
+    # The rows as of `as_of` (default: the store's own date, see default_as_of) and that date.
+    # Only Days_Until_Expiry depends on the as-of date, so moving it is one shift of that column
+    built = store_as_of(path)
+    as_of = as_of_date(as_of) if as_of is not None else default_as_of(path)
+    if built is not None and as_of != built and 'Days_Until_Expiry' in df.columns:
+        df = df.assign(Days_Until_Expiry=df['Days_Until_Expiry'] - (as_of - built).days)
+    return df, as_of
+
+
+def store_version(path=FEATURE_STORE_PATH):
+    # Cheap content version of a store: file names, sizes and modification times
+    files = [path]
+    if os.path.isdir(path):
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    digest = hashlib.sha1()
+    for file in files:
+        stat = os.stat(file)
+        digest.update(f"{file}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()
+
+
+# State kept next to a store so appends and refreshes never rescan its history: each SKU's history
+# tail (the rows later lags and windows reach back to), the latest order date, and running sums
+# behind the whole-store column means. It is tied to the store_version it was saved against
+STATE_FILE = "history_state.arrow"
+STATE_KEY = b'summary'
+SUMMARY_COLUMNS = ['Moving Average', TARGET]
+
+
+def default_state_path(path=FEATURE_STORE_PATH):
+    return os.path.join(os.path.dirname(path), STATE_FILE)
+
+
+def empty_summary():
+    return {'last_order_date': None, 'sums': {col: [0.0, 0] for col in SUMMARY_COLUMNS}}
+
+
+def summarize(df, summary):
+    # Fold rows into a store summary
+    latest = df[TIME_COLUMN].max() if len(df) else pd.NaT
+    if pd.notna(latest):
+        previous = summary['last_order_date']
+        summary['last_order_date'] = str(max(latest, pd.Timestamp(previous)) if previous else latest)
+    for col in SUMMARY_COLUMNS:
+        values = df[col].dropna()
+        total, count = summary['sums'][col]
+        summary['sums'][col] = [total + float(values.to_numpy(dtype='float64').sum()), count + len(values)]
+    return summary
+
+
+def summary_means(summary):
+    return {col: total / count if count else float('nan') for col, (total, count) in summary['sums'].items()}
+
+
+def save_store_state(tail, summary, path=FEATURE_STORE_PATH, state_path=None):
+    state_path = state_path or default_state_path(path)
+    metadata = {STATE_KEY: json.dumps({**summary, 'store_version': store_version(path)}).encode()}
+    tmp_path = state_path + ".tmp"
+    feather.write_feather(pa.Table.from_pandas(tail, preserve_index=False).replace_schema_metadata(metadata),
+                          tmp_path, compression="uncompressed")
+    os.replace(tmp_path, state_path)
+
+
+def load_store_state(path=FEATURE_STORE_PATH, state_path=None):
+    # (history tail, summary), or None when no state was saved or the store changed since
+    state_path = state_path or default_state_path(path)
+    if not os.path.exists(state_path) or not os.path.exists(path):
+        return None
+    table = feather.read_table(state_path)
+    summary = json.loads(table.schema.metadata[STATE_KEY])
+    if summary.pop('store_version') != store_version(path):
+        return None
+    return table.to_pandas(), summary
+
+
+def store_summary(path=FEATURE_STORE_PATH):
+    # The saved summary, else one computed from the store's own rows
+    state = load_store_state(path)
+    if state is not None:
+        return state[1]
+    summary = empty_summary()
+    for batch in iter_features(path, columns=[TIME_COLUMN] + SUMMARY_COLUMNS):
+        summary = summarize(batch, summary)
+    return summary
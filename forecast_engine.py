@@ -0,0 +1,158 @@
+import pickle
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from forecaster import RecursiveForecaster
+from quantiles import quantile_label, has_tree_outputs
+from instrumentation import stage
+
+# Hashing a fitted forest means pickling it, so do it once per model object
+_model_versions = weakref.WeakKeyDictionary()
+
+
+def model_version(model):
+    # Compiled forests carry their own content hash
+    if getattr(model, 'version', None):
+        return model.version
+    try:
+        return _model_versions[model]
+    except (KeyError, TypeError):
+        pass
+    version = hashlib.sha1(pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()
+    try:
+        _model_versions[model] = version
+    except TypeError:
+        pass
+    return version
+
+
+def data_version(data):
+    hashed = pd.util.hash_pandas_object(data, index=False).to_numpy()
+    return hashlib.sha1(hashed.tobytes() + ",".join(map(str, data.columns)).encode()).hexdigest()
+
+
+class LRUCache:
+    # Small thread-safe LRU, shared across Streamlit sessions
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+def reorder_table(sku_forecast, threshold=0.3, service_level=None):
+    # Reorder logic for every SKU and month of a RecursiveForecaster output in one vectorized pass.
+    # With a service level, orders are sized to that quantile of the demand distribution (e.g. P95),
+    # so the extra over the point forecast is the safety stock
+    demand = sku_forecast['Predicted Demand'].to_numpy()
+    stock = sku_forecast['Stock Balance'].to_numpy()
+    reorder_threshold = demand * threshold
+    reorder_needed = stock < reorder_threshold
+    target = sku_forecast[quantile_label(service_level)].to_numpy() if service_level else demand
+    reorder_quantity = np.where(reorder_needed, np.maximum(target - stock, 0), 0)
+
+    # Format each month's date once and index by step rather than formatting every row
+    steps = sku_forecast['Step'].to_numpy() - 1
+    month_dates = pd.DatetimeIndex(sku_forecast['Forecast Date'].unique())
+    order_dates = np.asarray(month_dates.strftime('%Y-%m-01'), dtype=object)
+    month_labels = np.asarray(month_dates.strftime('%B %Y'), dtype=object)
+
+    table = pd.DataFrame({
+        'SKU': sku_forecast['SKU'].to_numpy(),
+        'Predicted Demand': demand,
+        'Stock Balance': stock,
+        'Lead_Time': sku_forecast['Lead_Time'].to_numpy(),
+        'Reorder Threshold': reorder_threshold,
+        'Reorder Needed': reorder_needed,
+        'Reorder Quantity': reorder_quantity,
+        'Recommended Order Date': order_dates[steps],
+        'Month': month_labels[steps]
+    })
+    if service_level:
+        table.insert(2, quantile_label(service_level), target)
+        table.insert(3, 'Safety Stock', np.maximum(target - demand, 0))
+    return table
+
+
+def order_dates(forecast, lead_time_buffer=7):
+    # Latest date to place each order: Recommended Order Date minus lead time minus the buffer
+    return (
+        pd.to_datetime(forecast['Recommended Order Date'], format='%Y-%m-%d')
+        - pd.to_timedelta(forecast['Lead_Time'] + lead_time_buffer, unit='D')
+    )
+
+
+class ForecastEngine:
+    # Runs the recursive forecast once per (data version, model version, as-of date) and memoizes
+    # the per-month reorder tables built on top of it
+    def __init__(self, max_inferences=4, max_forecasts=64):
+        self.inferences = LRUCache(max_inferences)
+        self.forecasts = LRUCache(max_forecasts)
+
+    def sku_forecast(self, model, data, version, months_ahead, as_of, quantiles=None):
+        # One recursive run per (data, model, as-of date); a cached run covering at least as many months
+        # is reused by slicing its leading steps. For forests the run keeps its per-tree predictions, so
+        # quantile and service-level columns are read off them and changing those never reruns the
+        # forecast; other backends compute their quantiles in the run, so they are part of the key
+        per_tree = has_tree_outputs(model)
+        key = version + (as_of.date(),) + (() if per_tree else (tuple(quantiles or ()),))
+        cached = self.inferences.get(key)
+        if cached is None or cached[0]['Step'].iat[-1] < months_ahead:
+            forecaster = RecursiveForecaster(model)
+            sku_forecast = forecaster.forecast(data, months_ahead, start_date=as_of,
+                                               quantiles=None if per_tree else quantiles, keep_trees=per_tree)
+
+            # Lead time is averaged over each SKU's history
+            with stage("groupby", rows=len(data)):
+                mean_lead_time = data.groupby('SKU')['Lead_Time'].mean()
+            sku_forecast['Lead_Time'] = mean_lead_time.reindex(sku_forecast['SKU']).to_numpy()
+
+            cached = (sku_forecast, forecaster.tree_outputs)
+            self.inferences.put(key, cached)
+
+        sku_forecast, outputs = cached
+        sku_forecast = sku_forecast[sku_forecast['Step'] <= months_ahead]
+        if per_tree and quantiles:
+            # Rows are step-major, like the (steps x SKUs) slices of the per-tree outputs
+            bands = np.quantile(outputs[:months_ahead], quantiles, axis=1)
+            sku_forecast = sku_forecast.copy()
+            for i, q in enumerate(quantiles):
+                sku_forecast.insert(4 + i, quantile_label(q), bands[i].ravel())
+        return sku_forecast
+
+    def forecast(self, model, data, months_ahead=2, threshold=0.3, as_of=None, data_key=None, service_level=None):
+        # Months are counted from the as-of date; data_key must identify the data as of that date,
+        # since Days_Until_Expiry depends on it
+        if as_of is None:
+            raise ValueError("ForecastEngine.forecast needs the as-of date the data was rebased to")
+        as_of = pd.Timestamp(as_of).normalize()
+        version = (data_key or data_version(data), model_version(model))
+        key = version + (months_ahead, threshold, as_of.date(), service_level)
+
+        cached = self.forecasts.get(key)
+        if cached is not None:
+            return cached
+
+        quantiles = (service_level,) if service_level else None
+        sku_forecast = self.sku_forecast(model, data, version, months_ahead, as_of, quantiles)
+
+        with stage("reorder_table", rows=len(sku_forecast)):
+            forecast = reorder_table(sku_forecast, threshold, service_level)
+        self.forecasts.put(key, forecast)
+        return forecast
@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+from dateutil.relativedelta import relativedelta
+from feature_store import MODEL_FEATURES, TARGET, TIME_COLUMN
+from instrumentation import stage
+from quantiles import predict_quantiles, quantile_label, tree_outputs
+
+# Calendar season per month (index 1-12), in the Season encoding used by preprocess.py
+MONTH_SEASONS = np.array([-1, 3, 3, 0, 0, 0, 1, 1, 1, 2, 2, 2, 3])
+
+COL = {name: i for i, name in enumerate(MODEL_FEATURES)}
+
+
+def latest_rows(data):
+    # Most recent row per SKU (by Order Date, ties broken by row order), sorted by SKU
+    sku = data['SKU'].to_numpy()
+    time = data[TIME_COLUMN].to_numpy() if TIME_COLUMN in data.columns else np.arange(len(data))
+    order = np.lexsort((np.arange(len(data)), time, sku))
+    sorted_sku = sku[order]
+    is_last = np.r_[sorted_sku[1:] != sorted_sku[:-1], True]
+    return data.iloc[order[is_last]]
+
+
+class RecursiveForecaster:
+    # Rolls every SKU's latest feature row forward one month at a time: predict all SKUs in one
+    # batch, feed the prediction back into the lags, then advance the calendar features in place
+    def __init__(self, model, lag_scale=None):
+        self.model = model
+        self.lag_scale = lag_scale
+        self.tree_outputs = None
+
+    def estimate_lag_scale(self, data):
+        # The lags hold per-period Stock Out while the target is the export's Demand Forecast;
+        # the ratio of their means maps a prediction back into lag units
+        if TARGET in data.columns and data[TARGET].mean() > 0:
+            return float(data['Moving Average'].mean() / data[TARGET].mean())
+        return 1.0
+
+    def predict(self, X):
+        return self.model.predict(pd.DataFrame(X, columns=MODEL_FEATURES, copy=False))
+
+    def predict_quantiles(self, X, quantiles):
+        return predict_quantiles(self.model, pd.DataFrame(X, columns=MODEL_FEATURES, copy=False), quantiles)
+
+    def forecast(self, data, horizon, start_date, quantiles=None, keep_trees=False):
+        # Months are counted from start_date, the run's as-of date (the data should be rebased to it).
+        # With quantiles, each step also returns the spread of the per-tree predictions
+        # (e.g. P10/P50/P90); the mean is still what is fed back into the lags. With keep_trees (forests
+        # only, see has_tree_outputs) those per-tree predictions are kept in self.tree_outputs as a
+        # (steps x trees x SKUs) array, so other quantiles can be read off without rerunning the forecast
+        if start_date is None:
+            raise ValueError("forecast() needs the as-of date to count months from")
+        lag_scale = self.lag_scale if self.lag_scale is not None else self.estimate_lag_scale(data)
+
+        with stage("latest_rows", rows=len(data)):
+            state = latest_rows(data)
+        n_skus = len(state)
+        X = state[MODEL_FEATURES].to_numpy(dtype=np.float64, copy=True)
+        predicted = np.empty((horizon, n_skus))
+        bands = np.empty((len(quantiles or ()), horizon, n_skus))
+
+        forecast_dates = [start_date + relativedelta(months=offset) for offset in range(1, horizon + 2)]
+        steps = []
+        for step in range(horizon):
+            with stage("model_predict", rows=n_skus):
+                if keep_trees:
+                    outputs = tree_outputs(self.model, pd.DataFrame(X, columns=MODEL_FEATURES, copy=False))
+                    predicted[step] = outputs.sum(axis=0) / outputs.shape[0]
+                    if quantiles:
+                        bands[:, step] = np.quantile(outputs, quantiles, axis=0)
+                    steps.append(outputs)
+                elif quantiles:
+                    predicted[step], bands[:, step] = self.predict_quantiles(X, quantiles)
+                else:
+                    predicted[step] = self.predict(X)
+
+            # Shift the lags and recompute the moving average
+            X[:, COL['Lag_3']] = X[:, COL['Lag_2']]
+            X[:, COL['Lag_2']] = X[:, COL['Lag_1']]
+            X[:, COL['Lag_1']] = predicted[step] * lag_scale
+            X[:, COL['Moving Average']] = X[:, [COL['Lag_1'], COL['Lag_2'], COL['Lag_3']]].mean(axis=1)
+
+            # Advance the calendar by one month
+            X[:, COL['Order_Month']] = X[:, COL['Order_Month']] % 12 + 1
+            X[:, COL['Season']] = MONTH_SEASONS[X[:, COL['Order_Month']].astype(int)]
+            X[:, COL['Days_Until_Expiry']] -= (forecast_dates[step + 1] - forecast_dates[step]).days
+        if keep_trees:
+            self.tree_outputs = np.stack(steps) if steps else np.empty((0, 0, n_skus))
+
+        forecast = pd.DataFrame({
+            'SKU': np.tile(state['SKU'].to_numpy(), horizon),
+            'Step': np.repeat(np.arange(1, horizon + 1), n_skus),
+            'Forecast Date': np.repeat(pd.to_datetime(forecast_dates[:horizon]), n_skus),
+            'Predicted Demand': predicted.ravel(),
+            'Stock Balance': np.tile(state['Stock Balance'].to_numpy(), horizon),
+            'Lead_Time': np.tile(state['Lead_Time'].to_numpy(), horizon)
+        })
+        for i, q in enumerate(quantiles or ()):
+            forecast.insert(4 + i, quantile_label(q), bands[i].ravel())
+        return forecast
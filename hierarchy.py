@@ -0,0 +1,233 @@
+import os
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import scipy.sparse as sp
+from scipy.sparse.linalg import splu
+from feature_store import FEATURE_STORE_PATH, MODEL_FEATURES, TARGET, TIME_COLUMN, load_features, rebase_as_of
+from forecaster import RecursiveForecaster
+from model_backend import load_model
+from preprocess import load_encoders, default_encoder_path
+from instrumentation import stage, export_metrics
+
+HIERARCHY_PATH = "predictions/hierarchy_forecast"
+# Aggregation levels and the columns identifying their series; the last level is the bottom one.
+# Category is a property of the SKU and Country of the distributor, so every bottom series
+# (SKU x distributor) belongs to exactly one node of each level
+LEVELS = [
+    ('total', []),
+    ('country', ['Country']),
+    ('category', ['Category']),
+    ('distributor', ['Distributor ID']),
+    ('sku', ['SKU']),
+    ('sku_distributor', ['SKU', 'Distributor ID'])
+]
+NODE_COLUMNS = ['SKU', 'Distributor ID', 'Country', 'Category']
+METHODS = ('bottom_up', 'ols', 'mint')
+# Output partitions: a level, then a country ('All' for series spanning countries)
+PARTITION_COLUMNS = ['Level', 'Country']
+SES_ALPHA = 0.3
+
+
+class Hierarchy:
+    # Summing structure over the bottom series. `nodes` lists every series, aggregates first and
+    # the bottom level last, and `aggregation` is the sparse 0/1 (aggregates x bottom) matrix A,
+    # so the summing matrix is S = [A; I] without ever building I
+    def __init__(self, bottom):
+        self.bottom = bottom.reset_index(drop=True)
+        n_bottom = len(self.bottom)
+        blocks, nodes = [], []
+        for level, keys in LEVELS[:-1]:
+            if keys:
+                codes, _ = pd.factorize(pd.MultiIndex.from_frame(self.bottom[keys]) if len(keys) > 1
+                                        else self.bottom[keys[0]], sort=True)
+            else:
+                codes = np.zeros(n_bottom, dtype=np.int64)
+            n_nodes = codes.max() + 1 if n_bottom else 0
+            blocks.append(sp.csr_matrix((np.ones(n_bottom), (codes, np.arange(n_bottom))), shape=(n_nodes, n_bottom)))
+            nodes.append(self.node_attributes(level, codes, n_nodes))
+        self.aggregation = sp.vstack(blocks).tocsr() if blocks else sp.csr_matrix((0, n_bottom))
+        nodes.append(self.bottom[NODE_COLUMNS].assign(Level=LEVELS[-1][0]))
+        self.nodes = pd.concat(nodes, ignore_index=True)[['Level'] + NODE_COLUMNS]
+
+    def node_attributes(self, level, codes, n_nodes):
+        # A node keeps an attribute (e.g. a distributor's country) only when all its bottom series share it
+        grouped = self.bottom[NODE_COLUMNS].groupby(codes)
+        first, low, high = grouped.first(), grouped.min(), grouped.max()
+        nodes = first.where(low == high).reindex(range(n_nodes))
+        return nodes.assign(Level=level)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def aggregate(self, bottom_values):
+        # Every node's values (S @ bottom) from the bottom series' values
+        return np.vstack([self.aggregation @ bottom_values, bottom_values])
+
+
+def entity_attributes(data):
+    # Each SKU's latest category and each distributor's latest country
+    category = data.loc[data.groupby('SKU')[TIME_COLUMN].idxmax(), ['SKU', 'Category']].set_index('SKU')['Category']
+    latest = data.groupby('Distributor ID')[TIME_COLUMN].idxmax()
+    country = data.loc[latest, ['Distributor ID', 'Country']].set_index('Distributor ID')['Country']
+    return category, country
+
+
+def bottom_history(data, target=TARGET):
+    # Monthly target totals of every SKU x distributor series as a dense (series x months) array
+    data = data[data[TIME_COLUMN].notna()]
+    category, country = entity_attributes(data)
+    month = data[TIME_COLUMN].dt.year.to_numpy() * 12 + data[TIME_COLUMN].dt.month.to_numpy() - 1
+    first_month = month.min()
+    # Series codes from the two integer codes (factorizing the pairs as a MultiIndex is far slower)
+    sku_codes, skus = pd.factorize(data['SKU'], sort=True)
+    distributor_codes, distributors = pd.factorize(data['Distributor ID'], sort=True)
+    pairs, codes = np.unique(sku_codes.astype(np.int64) * len(distributors) + distributor_codes, return_inverse=True)
+    history = sp.coo_matrix(
+        (data[target].to_numpy(np.float64), (codes, month - first_month)),
+        shape=(len(pairs), month.max() - first_month + 1)
+    ).toarray()  # duplicate (series, month) entries are summed
+    bottom = pd.DataFrame({'SKU': skus[pairs // len(distributors)],
+                           'Distributor ID': distributors[pairs % len(distributors)]})
+    bottom['Country'] = country.reindex(bottom['Distributor ID']).to_numpy()
+    bottom['Category'] = category.reindex(bottom['SKU']).to_numpy()
+    last_month = pd.Period(year=int(month.max() // 12), month=int(month.max() % 12) + 1, freq='M')
+    return bottom, history, last_month
+
+
+def ses(history, alpha=SES_ALPHA):
+    # Simple exponential smoothing of every series at once, looping over months only: the final
+    # level (the flat forecast) and the mean squared one-step-ahead error of each series
+    level = history[:, 0].astype(np.float64)
+    squared_error = np.zeros(len(history))
+    for t in range(1, history.shape[1]):
+        error = history[:, t] - level
+        squared_error += error ** 2
+        level += alpha * error
+    n_errors = max(history.shape[1] - 1, 1)
+    return level, squared_error / n_errors
+
+
+def reconcile(base, hierarchy, method='mint', variance=None):
+    # Coherent forecasts for every node from (nodes x horizon) base forecasts, S G base:
+    #   bottom_up: the bottom base forecasts, summed up
+    #   ols:       G = (S'S)^-1 S'
+    #   mint:      G = (S'W^-1 S)^-1 S'W^-1 with W the diagonal of one-step error variances
+    # The projection is computed in its constraint form,
+    #   bottom = base_b + W_b A' (W_a + A W_b A')^-1 (base_a - A base_b),
+    # which factorizes one sparse (aggregates x aggregates) system instead of a dense bottom x bottom one
+    A = hierarchy.aggregation
+    n_aggregates = A.shape[0]
+    base_aggregates, bottom = base[:n_aggregates], base[n_aggregates:]
+    if method != 'bottom_up' and n_aggregates:
+        if method == 'ols':
+            weights = np.ones(len(base))
+        elif method == 'mint':
+            weights = np.maximum(variance, 1e-9)
+        else:
+            raise ValueError(f"Unknown reconciliation method '{method}' (methods: {', '.join(METHODS)})")
+        w_aggregates, w_bottom = weights[:n_aggregates], weights[n_aggregates:]
+        system = (sp.diags(w_aggregates) + A @ sp.diags(w_bottom) @ A.T).tocsc()
+        correction = splu(system).solve(np.ascontiguousarray(base_aggregates - A @ bottom))
+        bottom = bottom + w_bottom[:, None] * (A.T @ correction)
+    return hierarchy.aggregate(bottom)
+
+
+def forecast_hierarchy(data, model=None, horizon=2, method='mint', alpha=SES_ALPHA, as_of=None):
+    # Base forecasts for every node (exponential smoothing of its aggregated history, with the
+    # model's recursive forecast for the SKU level when a model is given), then reconciliation.
+    # With an as-of date (data rebased to it, see rebase_as_of) months are counted from it, as
+    # predict.py counts them; without one they follow the last month of history
+    with stage("history") as span:
+        bottom, history, last_month = bottom_history(data)
+        hierarchy = Hierarchy(bottom)
+        level, variance = ses(hierarchy.aggregate(history), alpha)
+        span['rows'] = len(hierarchy)
+    base = np.repeat(level[:, None], horizon, axis=1)
+    first_month = pd.Period(as_of, 'M') if as_of is not None else last_month
+    start_date = as_of if as_of is not None else first_month.to_timestamp()
+
+    if model is not None:
+        with stage("model_forecast"):
+            sku_forecast = RecursiveForecaster(model).forecast(data[MODEL_FEATURES + [TARGET, TIME_COLUMN]], horizon,
+                                                               start_date=start_date)
+            by_step = sku_forecast.pivot(index='SKU', columns='Step', values='Predicted Demand')
+            sku_nodes = np.flatnonzero(hierarchy.nodes['Level'].to_numpy() == 'sku')
+            skus = hierarchy.nodes['SKU'].to_numpy()[sku_nodes]
+            known = np.isin(skus, by_step.index)
+            base[sku_nodes[known]] = by_step.reindex(skus[known]).to_numpy()
+
+    with stage("reconcile", rows=len(hierarchy)):
+        reconciled = reconcile(base, hierarchy, method, variance)
+
+    months = [str(first_month + step) for step in range(1, horizon + 1)]
+    frame = hierarchy.nodes.loc[np.repeat(np.arange(len(hierarchy)), horizon)].reset_index(drop=True)
+    frame['Step'] = np.tile(np.arange(1, horizon + 1), len(hierarchy))
+    frame['Month'] = np.tile(months, len(hierarchy))
+    frame['Base Forecast'] = base.ravel()
+    frame['Reconciled Forecast'] = reconciled.ravel()
+    return frame, hierarchy
+
+
+def label_nodes(frame, encoders):
+    # Country, distributor and category codes back to their ERP labels; SKU stays encoded like
+    # every other forecast output
+    frame = frame.copy()
+    for col in ['Country', 'Distributor ID', 'Category']:
+        labels = {code: label for label, code in encoders.get(col, {}).items()}
+        frame[col] = frame[col].map(labels)
+    frame['Country'] = frame['Country'].fillna('All')
+    frame['SKU'] = frame['SKU'].astype('Int32')
+    return frame
+
+
+def write_hierarchy_forecast(frame, path=HIERARCHY_PATH):
+    # One Arrow partition per (level, country): a country's or a distributor's query reads only its own files
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    ds.write_dataset(pa.Table.from_pandas(frame, preserve_index=False), tmp_path, format="ipc",
+                     partitioning=PARTITION_COLUMNS, partitioning_flavor="hive")
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def load_hierarchy_forecast(path=HIERARCHY_PATH, level=None, country=None, distributor=None, category=None, sku=None):
+    # Reads only the partitions a query needs. A distributor's country is looked up in the small
+    # distributor-level partition, so its SKU-level rows are read from that one country's files
+    dataset = ds.dataset(path, format="ipc", partitioning="hive")
+    if distributor is not None and country is None:
+        owner = dataset.to_table(columns=['Country'], filter=(ds.field('Level') == 'distributor') &
+                                 (ds.field('Distributor ID') == distributor)).column('Country').to_pylist()
+        country = owner[0] if owner else None
+    conditions = [ds.field(name) == value for name, value in
+                  [('Level', level), ('Country', country), ('Distributor ID', distributor),
+                   ('Category', category), ('SKU', sku)] if value is not None]
+    condition = None
+    for part in conditions:
+        condition = part if condition is None else condition & part
+    frame = dataset.to_table(filter=condition).to_pandas()
+    return frame[PARTITION_COLUMNS + [col for col in frame.columns if col not in PARTITION_COLUMNS]]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Forecast and reconcile the Country / Distributor / Category hierarchy")
+    parser.add_argument("--store", default=FEATURE_STORE_PATH)
+    parser.add_argument("--model", default=None, help="Model for the SKU-level base forecasts (default: the last trained)")
+    parser.add_argument("--no-model", action="store_true", help="Exponential smoothing only, at every level")
+    parser.add_argument("--output", default=HIERARCHY_PATH)
+    parser.add_argument("--method", choices=METHODS, default="mint")
+    parser.add_argument("--horizon", type=int, default=2, help="Months ahead")
+    parser.add_argument("--as-of", default=None,
+                        help="Date to forecast from, YYYY-MM-DD (default: the date the feature store was built for)")
+    args = parser.parse_args()
+
+    data, as_of = rebase_as_of(load_features(args.store), args.store, args.as_of)
+    model = None if args.no_model else load_model(args.model)
+    frame, hierarchy = forecast_hierarchy(data, model, args.horizon, args.method, as_of=as_of)
+    frame = label_nodes(frame, load_encoders(default_encoder_path(args.store)))
+    write_hierarchy_forecast(frame, args.output)
+    print(f"Reconciled {len(hierarchy)} series ({args.method}) over {args.horizon} months; saved to {args.output}")
+    export_metrics("hierarchy")
@@ -0,0 +1,175 @@
+import numpy as np
+import pandas as pd
+
+# Per-SKU history features derived from the sales series itself rather than trusted from the export
+HISTORY_SOURCE = 'Stock Out'
+HISTORY_PREFIX = 'Sales'
+DEFAULT_LAGS = 3
+DEFAULT_WINDOWS = (3, 6, 12)
+
+
+def sku_order(sku, time):
+    # Rows sorted by SKU, then time, ties kept in row order: a single stable sort of a combined
+    # (SKU, time) integer key, falling back to a lexsort when the key would not fit in 64 bits
+    if not len(sku):
+        return np.zeros(0, dtype=np.int64)
+    if np.issubdtype(time.dtype, np.datetime64):
+        missing = np.isnat(time)
+        time = time.astype('datetime64[s]').view(np.int64)
+    else:
+        missing = np.zeros(len(time), dtype=bool)
+        time = time.astype(np.int64)
+    if missing.all():
+        time = np.zeros(len(time), dtype=np.int64)
+    else:
+        time = np.where(missing, 0, time - time[~missing].min() + 1)  # missing dates sort first
+    sku = sku.astype(np.int64) - sku.min()
+    span = int(time.max()) + 1
+    if (int(sku.max()) + 1) * span < 2 ** 62:
+        return np.argsort(sku * span + time, kind='stable')
+    return np.lexsort((np.arange(len(sku)), time, sku))
+
+
+def group_starts(sorted_sku):
+    # Index of the first row of each row's SKU run in the sorted array
+    n = len(sorted_sku)
+    is_start = np.r_[True, sorted_sku[1:] != sorted_sku[:-1]] if n else np.zeros(0, dtype=bool)
+    return np.maximum.accumulate(np.where(is_start, np.arange(n), 0)) if n else np.zeros(0, dtype=np.int64)
+
+
+def grouped_shift(values, position, k):
+    # values[i - k] within the same SKU, NaN for the first k rows of each SKU
+    shifted = np.full(len(values), np.nan)
+    if k < len(values):
+        shifted[k:] = values[:len(values) - k]
+    shifted[position < k] = np.nan
+    return shifted
+
+
+def range_max(values, start, end):
+    # max(values[start:end]) per row using a sparse table of power-of-two spans, O(n log w)
+    length = end - start
+    result = np.full(len(values), np.nan)
+    valid = length > 0
+    if not valid.any():
+        return result
+    levels = [values]
+    while 2 ** len(levels) <= length.max():
+        half = 2 ** (len(levels) - 1)
+        previous = levels[-1]
+        level = previous.copy()
+        level[:-half] = np.maximum(previous[:-half], previous[half:])
+        levels.append(level)
+    table = np.stack(levels)
+    s, e = start[valid], end[valid]
+    k = np.floor(np.log2(e - s)).astype(int)
+    result[valid] = np.maximum(table[k, s], table[k, e - 2 ** k])
+    return result
+
+
+def window_stats(values, start, end):
+    # Mean and sample std of values[start:end] per row from prefix sums (centred for precision)
+    centre = values.mean() if len(values) else 0.0
+    centred = values - centre
+    sums = np.r_[0.0, np.cumsum(centred)]
+    squares = np.r_[0.0, np.cumsum(centred ** 2)]
+    count = (end - start).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        total = sums[end] - sums[start]
+        mean = total / count + centre
+        variance = (squares[end] - squares[start] - total ** 2 / count) / (count - 1)
+        std = np.sqrt(np.maximum(variance, 0))
+    mean[count == 0] = np.nan
+    std[count < 2] = np.nan
+    return mean, std
+
+
+class HistoryFeatures:
+    # Sorts once by (SKU, Order Date) and derives, per SKU and with array operations only:
+    # the previous `lags` values of the source column, rolling mean/std/max over the preceding
+    # `windows` periods, and the days since the SKU's previous order. The tail of each SKU's
+    # history is carried between calls, so chunks and deltas see the rows that came before them.
+    def __init__(self, lags=DEFAULT_LAGS, windows=DEFAULT_WINDOWS, source=HISTORY_SOURCE,
+                 prefix=HISTORY_PREFIX, time_column='Order Date'):
+        self.lags = lags
+        self.windows = tuple(windows)
+        self.source = source
+        self.prefix = prefix
+        self.time_column = time_column
+        self.depth = max((lags,) + self.windows)
+        self.state = pd.DataFrame({'SKU': pd.Series(dtype=np.int64),
+                                   time_column: pd.Series(dtype='datetime64[ns]'),
+                                   source: pd.Series(dtype=np.float64)})
+
+    @property
+    def columns(self):
+        columns = [f"{self.prefix}_Lag_{k}" for k in range(1, self.lags + 1)]
+        for window in self.windows:
+            columns += [f"{self.prefix}_Mean_{window}", f"{self.prefix}_Std_{window}", f"{self.prefix}_Max_{window}"]
+        return columns
+
+    @classmethod
+    def from_columns(cls, columns, **kwargs):
+        # Same configuration as the history columns already present in a feature store
+        prefix = kwargs.get('prefix', HISTORY_PREFIX)
+        lags = sum(f"{prefix}_Lag_{k}" in columns for k in range(1, len(columns) + 1))
+        windows = sorted(int(col.rsplit('_', 1)[1]) for col in columns if col.startswith(f"{prefix}_Mean_"))
+        return cls(lags=lags, windows=windows, **kwargs)
+
+    def seed(self, history):
+        # Start from rows already processed (e.g. the feature store) instead of an empty history
+        rows = history[['SKU', self.time_column, self.source]]
+        sku = rows['SKU'].to_numpy()
+        order = sku_order(sku, rows[self.time_column].to_numpy())
+        self.state = self.tail(rows, order, sku[order])
+
+    def tail(self, rows, order, sorted_sku):
+        # The last `depth` rows of every SKU, in (SKU, time) order
+        if not len(order):
+            return rows.iloc[:0].reset_index(drop=True)
+        is_end = np.r_[sorted_sku[1:] != sorted_sku[:-1], True]
+        group_end = np.minimum.accumulate(np.where(is_end, np.arange(len(order)), len(order))[::-1])[::-1]
+        keep = group_end - np.arange(len(order)) < self.depth
+        return rows.iloc[order[keep]].reset_index(drop=True)
+
+    def transform(self, df):
+        # Returns the history columns and Days_Since_Last_Order aligned with df's rows
+        n_carried = len(self.state)
+        rows = df[['SKU', self.time_column, self.source]].astype({self.source: np.float64})
+        if n_carried:
+            rows = pd.concat([self.state, rows], ignore_index=True)
+
+        sku = rows['SKU'].to_numpy()
+        time = rows[self.time_column].to_numpy()
+        order = sku_order(sku, time)
+        sorted_sku = sku[order]
+        sorted_time = time[order]
+        values = rows[self.source].to_numpy(dtype=np.float64)[order]
+
+        start_of_sku = group_starts(sorted_sku)
+        index = np.arange(len(order))
+        position = index - start_of_sku
+
+        features = {}
+        for k in range(1, self.lags + 1):
+            features[f"{self.prefix}_Lag_{k}"] = grouped_shift(values, position, k)
+        # Windows cover the preceding periods only (like the lags), so no row sees its own value
+        for window in self.windows:
+            start = np.maximum(index - window, start_of_sku)
+            mean, std = window_stats(values, start, index)
+            features[f"{self.prefix}_Mean_{window}"] = mean
+            features[f"{self.prefix}_Std_{window}"] = std
+            features[f"{self.prefix}_Max_{window}"] = range_max(values, start, index)
+
+        gap = np.zeros(len(order))
+        has_previous = position > 0
+        gap[has_previous] = (sorted_time[has_previous] - sorted_time[index[has_previous] - 1]) / np.timedelta64(1, 'D')
+        features['Days_Since_Last_Order'] = np.nan_to_num(gap)  # no previous order (or no date) counts as 0
+
+        # Gather back from sorted order to row order, dropping the carried rows
+        inverse = np.empty(len(order), dtype=np.int64)
+        inverse[order] = np.arange(len(order))
+        inverse = inverse[n_carried:]
+        self.state = self.tail(rows, order, sorted_sku)
+        return pd.DataFrame({name: values[inverse].astype(np.float32) for name, values in features.items()},
+                            index=df.index)
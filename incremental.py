@@ -0,0 +1,153 @@
+import os
+import argparse
+import joblib
+import pandas as pd
+import pyarrow.dataset as ds
+from preprocess import read_raw, transform_chunk, load_encoders, save_encoders, default_encoder_path
+from feature_store import (FEATURE_STORE_PATH, MODEL_FEATURES, TARGET, TIME_COLUMN, SUMMARY_COLUMNS, load_features,
+                           append_features, feature_columns, default_as_of, rebase_as_of, as_of_date, empty_summary,
+                           summarize, summary_means, store_summary, load_store_state, save_store_state)
+from model_backend import load_model, backend_of, active_model_path
+from forecaster import RecursiveForecaster
+from predict import FORECAST_PATH, build_forecast
+from train import save_model, train_sharded
+from model_registry import load_index
+from history_features import HistoryFeatures
+from instrumentation import stage, export_metrics
+
+
+def ingest_delta(delta_path, store_path=FEATURE_STORE_PATH, encoder_path=None):
+    # Preprocess only the new transactions and append them to the feature store
+    encoder_path = encoder_path or default_encoder_path(store_path)
+    encoders = load_encoders(encoder_path)
+
+    # Lags, rolling windows and Days_Since_Last_Order continue from each SKU's history tail, saved
+    # with the store; only a store without current state is read back (once) to rebuild it
+    history = HistoryFeatures.from_columns(feature_columns(store_path))
+    state = load_store_state(store_path)
+    if state is not None:
+        tail, summary = state
+        history.seed(tail)
+    else:
+        stored = load_features(store_path, columns=['SKU', TIME_COLUMN, 'Stock Out'] + SUMMARY_COLUMNS)
+        history.seed(stored)
+        summary = summarize(stored, empty_summary())
+
+    # New rows count expiry from the same as-of date as the rows already in the store
+    delta = transform_chunk(read_raw(delta_path), encoders, default_as_of(store_path), history)
+    append_features(delta, store_path)
+    save_store_state(history.state, summarize(delta, summary), store_path)
+    save_encoders(encoders, encoder_path)
+    print(f"Appended {len(delta)} rows for {delta['SKU'].nunique()} SKUs to {store_path}")
+    return delta
+
+
+def warm_start_model(model_path=None, store_path=FEATURE_STORE_PATH, n_new_trees=20,
+                     recent_months=3, max_trees=None):
+    # Grow the existing model with trees fit on recent history only, instead of refitting from scratch
+    model_path = model_path or active_model_path()
+    if backend_of(model_path) == 'sharded':
+        # Shards are refit rather than grown, and only those whose SKUs received new rows
+        index = load_index(model_path)
+        train_sharded(store_path, model_path, index['segment_by'], raw_path=index['raw_path'],
+                      n_buckets=index['volume_buckets'], params=index['params'])
+        return load_model(model_path)
+
+    last_order_date = pd.Timestamp(store_summary(store_path)['last_order_date'])
+    cutoff = last_order_date - pd.DateOffset(months=recent_months)
+    recent = load_features(store_path, columns=MODEL_FEATURES + [TARGET, TIME_COLUMN],
+                           filter=ds.field(TIME_COLUMN) >= cutoff)
+
+    if backend_of(model_path) == 'xgboost':
+        # Boosting appends rounds instead; there is no per-round retirement like max_trees
+        from xgboost_backend import warm_start_xgboost
+        return warm_start_xgboost(model_path, recent, n_new_trees)
+
+    model = joblib.load(model_path)
+    model.set_params(warm_start=True, n_estimators=len(model.estimators_) + n_new_trees)
+    model.fit(recent[MODEL_FEATURES], recent[TARGET])
+    model.set_params(warm_start=False)
+
+    # Retire the oldest trees so nightly refreshes do not grow the forest without bound
+    if max_trees and len(model.estimators_) > max_trees:
+        model.estimators_ = model.estimators_[-max_trees:]
+        model.set_params(n_estimators=max_trees)
+
+    print(f"Added {n_new_trees} trees fit on {len(recent)} rows since {cutoff.date()}; "
+          f"forest now has {len(model.estimators_)} trees")
+    save_model(model, model_path)
+    return model
+
+
+def refresh_forecasts(skus, model_path=None, store_path=FEATURE_STORE_PATH,
+                      forecast_path=FORECAST_PATH, forecast_months=(1, 2), as_of=None):
+    # Re-forecast only the given SKUs and splice them into the existing forecast file
+    model = load_model(model_path)
+    skus = list(skus)
+    as_of = as_of_date(as_of) if as_of is not None else default_as_of(store_path)
+
+    existing = pd.read_csv(forecast_path) if os.path.exists(forecast_path) else None
+    if existing is not None:
+        window = {((as_of + pd.DateOffset(months=m)).year, (as_of + pd.DateOffset(months=m)).month)
+                  for m in forecast_months}
+        if set(zip(existing['Order Year'], existing['Order Month'])) != window:
+            # The forecast window moved on since the last run, so every SKU needs a new forecast
+            existing = None
+
+    # The lag scale is a whole-history statistic: a ratio of store-wide means, kept as running sums
+    # with the store's state, so it is estimated on a one-row frame of those means
+    means = pd.DataFrame([summary_means(store_summary(store_path))])
+    lag_scale = RecursiveForecaster(model).estimate_lag_scale(means)
+
+    df = load_features(store_path, columns=MODEL_FEATURES + [TARGET, TIME_COLUMN],
+                       filter=None if existing is None else ds.field('SKU').isin(skus))
+    df, as_of = rebase_as_of(df, store_path, as_of)
+    forecast = build_forecast(model, df, forecast_months, lag_scale=lag_scale, as_of=as_of)
+
+    if existing is not None:
+        kept = existing[~existing['SKU'].isin(skus)]
+        forecast = pd.concat([kept, forecast], ignore_index=True).sort_values(
+            ['Order Year', 'Order Month', 'SKU'], kind='stable', ignore_index=True
+        )
+        print(f"Re-forecast {len(skus)} SKUs into {forecast_path}")
+    else:
+        print(f"Re-forecast all {df['SKU'].nunique()} SKUs into {forecast_path}")
+
+    os.makedirs(os.path.dirname(forecast_path), exist_ok=True)
+    forecast.to_csv(forecast_path, index=False)
+    return forecast
+
+
+def refresh(delta_path, store_path=FEATURE_STORE_PATH, model_path=None, forecast_path=FORECAST_PATH,
+            n_new_trees=20, recent_months=3, max_trees=None):
+    timings = {}
+
+    with stage("ingest") as span:
+        delta = ingest_delta(delta_path, store_path)
+        span['rows'] = len(delta)
+    timings['ingest'] = span['wall_seconds']
+
+    with stage("warm_start") as span:
+        warm_start_model(model_path, store_path, n_new_trees, recent_months, max_trees)
+    timings['warm_start'] = span['wall_seconds']
+
+    with stage("forecast") as span:
+        refresh_forecasts(delta['SKU'].unique(), model_path, store_path, forecast_path)
+    timings['forecast'] = span['wall_seconds']
+
+    print("Incremental refresh: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest a delta of new transactions and refresh the model")
+    parser.add_argument("delta", help="CSV of new transactions, in the raw ERP export format")
+    parser.add_argument("--store", default=FEATURE_STORE_PATH)
+    parser.add_argument("--model", default=None, help="Model to refresh (default: the last trained)")
+    parser.add_argument("--forecast", default=FORECAST_PATH)
+    parser.add_argument("--new-trees", type=int, default=20)
+    parser.add_argument("--recent-months", type=int, default=3, help="History window the new trees are fit on")
+    parser.add_argument("--max-trees", type=int, default=None, help="Drop the oldest trees beyond this count")
+    args = parser.parse_args()
+    refresh(args.delta, args.store, args.model, args.forecast, args.new_trees, args.recent_months, args.max_trees)
+    export_metrics("incremental")
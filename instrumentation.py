@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import time
+import uuid
+import signal
+import cProfile
+import threading
+import functools
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Where metrics and profiles are written, and which profiler (if any) wraps each top-level stage
+METRICS_DIR = os.environ.get("PIPELINE_METRICS_DIR", "metrics")
+PROFILE_MODE = os.environ.get("PIPELINE_PROFILE", "")  # "", "cprofile" or "sampling"
+
+# Spans kept until export_metrics(); long-running processes that never export (service.py) keep only the latest
+MAX_RECORDS = int(os.environ.get("PIPELINE_MAX_RECORDS", "10000"))
+
+RUN_ID = uuid.uuid4().hex[:12]
+_records = deque(maxlen=MAX_RECORDS)
+_records_lock = threading.Lock()
+_local = threading.local()
+
+
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 1024  # bytes on macOS, KiB on Linux
+
+
+class SamplingProfiler:
+    # Samples the main thread's stack on SIGPROF and writes collapsed stacks (flamegraph.pl / speedscope)
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = Counter()
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self.previous = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previous)
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+def _start_profiler(name):
+    if PROFILE_MODE == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler, os.path.join(METRICS_DIR, "profiles", f"{name}-{RUN_ID}.prof")
+    if PROFILE_MODE == "sampling" and hasattr(signal, "setitimer") and \
+            threading.current_thread() is threading.main_thread():
+        profiler = SamplingProfiler()
+        profiler.start()
+        return profiler, os.path.join(METRICS_DIR, "profiles", f"{name}-{RUN_ID}.folded")
+    return None, None
+
+
+def _stop_profiler(profiler, path):
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+    else:
+        profiler.stop()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    profiler.dump_stats(path) if isinstance(profiler, cProfile.Profile) else profiler.dump(path)
+
+
+@contextmanager
+def stage(name, rows=None):
+    # Times a pipeline stage. Nested stages are named after their parents (e.g. preprocess.date_parsing);
+    # set span['rows'] inside the block when the row count is only known at the end.
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    full_name = f"{stack[-1]['stage']}.{name}" if stack else name
+    span = {'stage': full_name, 'rows': rows}
+
+    # Profiles cover whole top-level stages; nested profilers are not supported by cProfile
+    profiler, profile_path = _start_profiler(full_name) if not stack else (None, None)
+
+    stack.append(span)
+    rss_before = current_rss_mb()
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    status = "ok"
+    try:
+        yield span
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        wall = time.perf_counter() - start_wall
+        cpu = time.process_time() - start_cpu
+        stack.pop()
+        if profiler is not None:
+            _stop_profiler(profiler, profile_path)
+        rss_after = current_rss_mb()
+        span.update({
+            'run_id': RUN_ID,
+            'timestamp': datetime.now().isoformat(timespec='milliseconds'),
+            'status': status,
+            'wall_seconds': wall,
+            'cpu_seconds': cpu,
+            'rss_mb': rss_after,
+            'rss_delta_mb': None if rss_before is None or rss_after is None else rss_after - rss_before,
+            # Process high-water mark at the end of the stage (the OS only tracks a lifetime peak)
+            'peak_rss_mb': peak_rss_mb(),
+            'profile': profile_path
+        })
+        with _records_lock:
+            _records.append(span)
+
+
+def instrumented(name):
+    # Decorator form of stage()
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def records():
+    with _records_lock:
+        return list(_records)
+
+
+def prometheus_text(spans, job):
+    # Aggregates spans per stage into node_exporter textfile-collector metrics
+    totals = {}
+    for span in spans:
+        total = totals.setdefault(span['stage'], {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'rows': 0, 'peak': 0.0})
+        total['count'] += 1
+        total['wall'] += span['wall_seconds']
+        total['cpu'] += span['cpu_seconds']
+        total['rows'] += span['rows'] or 0
+        total['peak'] = max(total['peak'], span['peak_rss_mb'] or 0.0)
+
+    metrics = [
+        ('pipeline_stage_runs_total', 'counter', 'Number of times the stage ran', 'count', 1),
+        ('pipeline_stage_wall_seconds', 'gauge', 'Wall-clock seconds spent in the stage', 'wall', 1),
+        ('pipeline_stage_cpu_seconds', 'gauge', 'CPU seconds spent in the stage', 'cpu', 1),
+        ('pipeline_stage_rows', 'gauge', 'Rows processed by the stage', 'rows', 1),
+        ('pipeline_stage_peak_rss_bytes', 'gauge', 'Process peak RSS at the end of the stage', 'peak', 2 ** 20),
+    ]
+    lines = []
+    for metric, kind, description, key, scale in metrics:
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for name, total in sorted(totals.items()):
+            lines.append(f'{metric}{{job="{job}",stage="{name}"}} {total[key] * scale}')
+    lines.append("# HELP pipeline_last_run_timestamp_seconds Unix time the metrics were exported")
+    lines.append("# TYPE pipeline_last_run_timestamp_seconds gauge")
+    lines.append(f'pipeline_last_run_timestamp_seconds{{job="{job}"}} {time.time()}')
+    return "\n".join(lines) + "\n"
+
+
+def export_metrics(job, metrics_dir=None):
+    # Appends this run's spans to the JSON log and rewrites the job's Prometheus textfile.
+    # Exported spans are cleared, so long-lived processes can export repeatedly.
+    metrics_dir = metrics_dir or METRICS_DIR
+    with _records_lock:
+        spans = list(_records)
+        _records.clear()
+    if not spans:
+        return
+    os.makedirs(metrics_dir, exist_ok=True)
+
+    with open(os.path.join(metrics_dir, "pipeline_metrics.jsonl"), "a") as f:
+        for span in spans:
+            f.write(json.dumps({'job': job, **span}) + "\n")
+
+    # Written then renamed, since the textfile collector may read at any moment
+    prom_path = os.path.join(metrics_dir, f"{job}.prom")
+    with open(prom_path + ".tmp", "w") as f:
+        f.write(prometheus_text(spans, job))
+    os.replace(prom_path + ".tmp", prom_path)
@@ -0,0 +1,47 @@
+import os
+import json
+from compiled_forest import MODEL_PATH, load_model as load_forest
+
+BACKENDS = ('forest', 'xgboost')
+XGBOOST_MODEL_PATH = "models/demand_forecasting_xgb.ubj"
+DEFAULT_MODEL_PATHS = {'forest': MODEL_PATH, 'xgboost': XGBOOST_MODEL_PATH}
+# Written next to every trained model, so readers load whichever backend was trained last
+ACTIVE_MODEL_FILE = "active_model.json"
+
+
+def backend_of(model_path):
+    # A directory is a registry of per-segment forests (see model_registry.py); native xgboost
+    # models are .ubj (or .json); everything else is a pickled forest
+    if os.path.isdir(model_path):
+        return 'sharded'
+    return 'xgboost' if os.path.splitext(model_path)[1] in ('.ubj', '.json') else 'forest'
+
+
+def set_active_model(model_path):
+    pointer = os.path.join(os.path.dirname(model_path), ACTIVE_MODEL_FILE)
+    tmp_path = pointer + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({'backend': backend_of(model_path), 'path': model_path}, f, indent=2)
+    os.replace(tmp_path, pointer)
+
+
+def active_model_path(model_dir=os.path.dirname(MODEL_PATH)):
+    # The last trained model in model_dir, falling back to the forest when nothing was recorded
+    pointer = os.path.join(model_dir, ACTIVE_MODEL_FILE)
+    if os.path.exists(pointer):
+        with open(pointer) as f:
+            return json.load(f)['path']
+    return MODEL_PATH
+
+
+def load_model(model_path=None):
+    # Any backend behind the same interface: predict(X), feature_names_in_, a `version`, and
+    # per-tree outputs (forests) or predict_quantiles (xgboost) for the quantile forecasts
+    model_path = model_path or active_model_path()
+    if backend_of(model_path) == 'xgboost':
+        from xgboost_backend import XGBoostModel
+        return XGBoostModel(model_path)
+    if backend_of(model_path) == 'sharded':
+        from model_registry import ShardedModel
+        return ShardedModel(model_path)
+    return load_forest(model_path)
@@ -0,0 +1,163 @@
+import os
+import re
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+from feature_store import FEATURE_STORE_PATH, TARGET, load_features
+from compiled_forest import compiled_path, load_model as load_forest
+from quantiles import predict_quantiles
+
+# Per-segment forests, one directory per segment key (models/shards_category, ...). The index maps
+# every encoded SKU to its segment and records what each shard was fit on
+INDEX_FILE = "index.json"
+RAW_PATH = "original_data/final_medicine_inventory_sales_data.csv"
+# Segment keys: two product attributes, and buckets of equal SKU count by total demand
+SEGMENT_KEYS = ('Category', 'Dosage Form', 'volume')
+VOLUME_BUCKETS = 3
+
+
+def registry_path(segment_by, model_dir="models"):
+    return os.path.join(model_dir, f"shards_{segment_slug(segment_by)}")
+
+
+def segment_slug(name):
+    # 'Dosage Form' -> 'dosage_form', usable as a file name
+    return re.sub(r'[^0-9a-z]+', '_', str(name).lower()).strip('_')
+
+
+def is_registry(path):
+    return os.path.exists(os.path.join(path, INDEX_FILE))
+
+
+def load_index(path):
+    if not is_registry(path):
+        return None
+    with open(os.path.join(path, INDEX_FILE)) as f:
+        return json.load(f)
+
+
+def save_index(index, path):
+    os.makedirs(path, exist_ok=True)
+    index_path = os.path.join(path, INDEX_FILE)
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_path, index_path)
+
+
+def sku_segments(segment_by, store_path=FEATURE_STORE_PATH, raw_path=RAW_PATH, n_buckets=VOLUME_BUCKETS):
+    # Segment of every encoded SKU as a Series indexed by SKU. Forecasts are made per SKU, so an SKU
+    # whose rows carry several categories or dosage forms belongs to the one it is sold under most
+    from preprocess import load_encoders, default_encoder_path
+    if segment_by == 'volume':
+        volume = load_features(store_path, columns=['SKU', TARGET]).groupby('SKU')[TARGET].sum()
+        labels = [f"volume_{i + 1}of{n_buckets}" for i in range(n_buckets)]
+        return pd.qcut(volume.rank(method='first'), n_buckets, labels=labels).astype(str)
+    if segment_by == 'Category':
+        # Encoded in the feature store, like SKU
+        rows = load_features(store_path, columns=['SKU', 'Category'])
+        names = {code: name for name, code in load_encoders(default_encoder_path(store_path))['Category'].items()}
+        rows['Category'] = rows['Category'].map(names)
+    elif segment_by == 'Dosage Form':
+        # Not kept in the feature store, so read from the raw export
+        if not raw_path or not os.path.exists(raw_path):
+            raise ValueError(f"Segmenting by Dosage Form needs the raw export ({raw_path})")
+        rows = pd.read_csv(raw_path, usecols=['SKU', 'Dosage Form'])
+        rows['SKU'] = rows['SKU'].map(load_encoders(default_encoder_path(store_path))['SKU'])
+        rows = rows[rows['SKU'].notna()].astype({'SKU': np.int64})
+    else:
+        raise ValueError(f"Unknown segment key '{segment_by}' (expected one of {', '.join(SEGMENT_KEYS)})")
+    counts = rows.groupby(['SKU', segment_by]).size().rename('rows').reset_index()
+    counts = counts.sort_values(['SKU', 'rows', segment_by], ascending=[True, False, True], kind='stable')
+    return counts.drop_duplicates('SKU').set_index('SKU')[segment_by].astype(str)
+
+
+def segment_digests(data, segments, params, as_of=None):
+    # Content hash of each segment's training rows and the forest parameters: a shard is refit only
+    # when its own rows (or the parameters) change. Days_Until_Expiry is counted from the store's
+    # as-of date, so it is hashed as the expiry day it stands for: moving the as-of date alone
+    # changes no digest
+    if as_of is not None and 'Days_Until_Expiry' in data.columns:
+        data = data.assign(Days_Until_Expiry=data['Days_Until_Expiry'].astype('Int64') + as_of.toordinal())
+    row_hashes = pd.util.hash_pandas_object(data, index=False).to_numpy()
+    segment = segments.reindex(data['SKU']).to_numpy()
+    salt = json.dumps(params, sort_keys=True).encode()
+    digests = {}
+    for name in segments.unique():
+        digest = hashlib.sha1(salt)
+        digest.update(row_hashes[segment == name].tobytes())
+        digests[name] = digest.hexdigest()
+    return digests
+
+
+class ShardedModel:
+    # The shard forests of a registry behind the single-model interface (predict, predict_quantiles,
+    # feature_names_in_, version). Each batch is split by the segment of its SKUs and every shard
+    # predicts its own rows; SKUs outside the index go to the fallback (largest) shard
+    def __init__(self, path):
+        index = load_index(path)
+        if index is None:
+            raise FileNotFoundError(f"No model registry at {path}")
+        self.path = path
+        self.segment_by = index['segment_by']
+        self.names = sorted(index['segments'])
+        self.models = [load_forest(os.path.join(path, index['segments'][name]['path'])) for name in self.names]
+        self.fallback = self.names.index(index['fallback'])
+
+        # Segment code by SKU, as a dense lookup over the encoded SKU range
+        skus = np.array([int(sku) for sku in index['sku_segments']], dtype=np.int64)
+        codes = np.array([self.names.index(name) for name in index['sku_segments'].values()], dtype=np.int64)
+        self.lookup = np.full(skus.max() + 1 if len(skus) else 0, self.fallback, dtype=np.int64)
+        self.lookup[skus] = codes
+
+        self.feature_names_in_ = self.models[0].feature_names_in_
+        self.n_features_in_ = len(self.feature_names_in_)
+        self.sku_column = list(self.feature_names_in_).index('SKU')
+        digest = hashlib.sha1(json.dumps(index['sku_segments'], sort_keys=True).encode())
+        for name, model in zip(self.names, self.models):
+            digest.update(f"{name}={model.version}".encode())
+        self.version = digest.hexdigest()
+
+    def segment_codes(self, X):
+        sku = X['SKU'].to_numpy() if isinstance(X, pd.DataFrame) else np.asarray(X)[:, self.sku_column]
+        sku = sku.astype(np.int64)
+        codes = np.full(len(sku), self.fallback, dtype=np.int64)
+        known = (sku >= 0) & (sku < len(self.lookup))
+        codes[known] = self.lookup[sku[known]]
+        return codes
+
+    def batches(self, X):
+        # (row positions, shard model, rows) for every segment present in X
+        codes = self.segment_codes(X)
+        for code in np.unique(codes):
+            rows = np.flatnonzero(codes == code)
+            yield rows, self.models[code], X.iloc[rows] if isinstance(X, pd.DataFrame) else np.asarray(X)[rows]
+
+    def predict(self, X):
+        out = np.empty(len(X), dtype=np.float64)
+        for rows, model, part in self.batches(X):
+            out[rows] = model.predict(part)
+        return out
+
+    def predict_quantiles(self, X, quantiles):
+        mean = np.empty(len(X), dtype=np.float64)
+        values = np.empty((len(quantiles), len(X)), dtype=np.float64)
+        for rows, model, part in self.batches(X):
+            mean[rows], values[:, rows] = predict_quantiles(model, part, quantiles)
+        return mean, values
+
+
+def shard_path(path, name):
+    # Pickled forest of a segment; its compiled forest is written next to it. Names that slug alike
+    # ('Tablet/Film', 'Tablet Film') are told apart by a short hash of the name itself
+    suffix = hashlib.sha1(str(name).encode()).hexdigest()[:8]
+    return os.path.join(path, f"{segment_slug(name)}-{suffix}.pkl")
+
+
+def remove_shard(path, entry):
+    model_path = os.path.join(path, entry['path'])
+    if os.path.exists(model_path):
+        os.remove(model_path)
+    shutil.rmtree(compiled_path(model_path), ignore_errors=True)
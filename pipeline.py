@@ -0,0 +1,442 @@
+import os
+import ast
+import sys
+import json
+import time
+import shutil
+import hashlib
+import inspect
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import pandas as pd
+from compiled_forest import compiled_path, file_digest
+from model_backend import ACTIVE_MODEL_FILE, DEFAULT_MODEL_PATHS
+from feature_store import FEATURE_STORE_PATH, default_state_path
+from history_features import DEFAULT_LAGS, DEFAULT_WINDOWS
+from quantiles import DEFAULT_QUANTILES
+from model_registry import VOLUME_BUCKETS, registry_path
+from snapshot import SNAPSHOT_PATH, SNAPSHOT_MONTHS, SNAPSHOT_SERVICE_LEVELS
+from instrumentation import stage as timed_stage, export_metrics
+
+PIPELINE_DIR = ".pipeline"
+RAW_PATH = "original_data/final_medicine_inventory_sales_data.csv"
+FORECAST_PATH = "predictions/multi_month_demand_forecast.csv"
+POLICY_PATH = "predictions/inventory_policies.csv"
+HIERARCHY_PATH = "predictions/hierarchy_forecast"
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Builds kept per stage in the artifact cache, most recent first
+ARTIFACTS_KEPT = 3
+
+
+def path_digest(path, known=None):
+    # Content hash of a file, or of every file under a directory (with their relative paths).
+    # `known` maps path -> (size, mtime, digest) from earlier runs, so unchanged files are not re-read
+    if os.path.isdir(path):
+        digest = hashlib.sha1()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                digest.update(os.path.relpath(full, path).encode())
+                digest.update(path_digest(full, known).encode())
+        return digest.hexdigest()
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    cached = (known or {}).get(path)
+    if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+        return cached[2]
+    digest = file_digest(path)
+    if known is not None:
+        known[path] = (stat.st_size, stat.st_mtime_ns, digest)
+    return digest
+
+
+def local_imports(module, seen=None):
+    # The module and every module of this repository it imports, directly or transitively
+    seen = set() if seen is None else seen
+    path = os.path.join(SOURCE_DIR, f"{module}.py")
+    if module in seen or not os.path.exists(path):
+        return seen
+    seen.add(module)
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    for node in ast.walk(tree):
+        names = [alias.name for alias in node.names] if isinstance(node, ast.Import) else \
+            [node.module] if isinstance(node, ast.ImportFrom) and node.module else []
+        for name in names:
+            local_imports(name.split('.')[0], seen)
+    return seen
+
+
+def code_digest(func, modules):
+    # Hash of the stage function's own source and of every local module it runs
+    digest = hashlib.sha1(inspect.getsource(func).encode())
+    for module in sorted(set().union(*(local_imports(m) for m in modules))):
+        digest.update(module.encode())
+        digest.update(file_digest(os.path.join(SOURCE_DIR, f"{module}.py")).encode())
+    return digest.hexdigest()
+
+
+class Stage:
+    # One step of the pipeline: func(**params) reads `inputs` and writes `outputs` (file or
+    # directory paths). `modules` are the repository modules whose code the outputs depend on.
+    def __init__(self, name, func, inputs, outputs, params=None, modules=()):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = dict(params or {})
+        self.modules = list(modules)
+
+    def key(self, digests):
+        # Changes whenever an input's content, the stage's code or one of its parameters changes
+        payload = {
+            'stage': self.name,
+            'inputs': {path: path_digest(path, digests) for path in self.inputs},
+            'code': code_digest(self.func, self.modules),
+            'params': self.params
+        }
+        return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _run_stage(func, params, name):
+    # Runs in a worker process; the stage's timings are exported under its own job name
+    start = time.perf_counter()
+    with timed_stage(f"pipeline.{name}"):
+        func(**params)
+    export_metrics(f"pipeline_{name}")
+    return time.perf_counter() - start
+
+
+class Pipeline:
+    # Stages form a DAG through their files: a stage depends on whichever stages write its inputs.
+    # A stage is skipped when its key (inputs, code, params) matches the last build and its outputs
+    # are still what that build wrote, restored from the artifact cache when a previous build with
+    # the same key is stored there, and run otherwise. Stages whose dependencies are done run in parallel.
+    def __init__(self, stages, cache_dir=PIPELINE_DIR):
+        self.stages = {stage.name: stage for stage in stages}
+        self.cache_dir = cache_dir
+        self.manifest_path = os.path.join(cache_dir, "manifest.json")
+        writers = {path: stage.name for stage in stages for path in stage.outputs}
+        self.dependencies = {
+            stage.name: sorted({writers[path] for path in stage.inputs if path in writers} - {stage.name})
+            for stage in stages
+        }
+
+    def load_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {'stages': {}, 'digests': {}}
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        manifest['digests'] = {path: tuple(entry) for path, entry in manifest.get('digests', {}).items()}
+        return manifest
+
+    def save_manifest(self, manifest):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    def upstream(self, targets):
+        # The targets and everything they depend on, in dependency order
+        order, seen = [], set()
+
+        def visit(name):
+            if name in seen:
+                return
+            seen.add(name)
+            for dependency in self.dependencies[name]:
+                visit(dependency)
+            order.append(name)
+
+        for name in targets or self.stages:
+            if name not in self.stages:
+                raise KeyError(f"Unknown stage '{name}' (stages: {', '.join(self.stages)})")
+            visit(name)
+        return order
+
+    def artifact_dir(self, name, key):
+        return os.path.join(self.cache_dir, "artifacts", name, key)
+
+    def store_artifacts(self, name, key):
+        target = self.artifact_dir(name, key)
+        tmp_dir = target + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for i, path in enumerate(self.stages[name].outputs):
+            copy = os.path.join(tmp_dir, f"{i}_{os.path.basename(path)}")
+            if os.path.isdir(path):
+                shutil.copytree(path, copy)
+            elif os.path.exists(path):
+                shutil.copy2(path, copy)
+        shutil.rmtree(target, ignore_errors=True)
+        os.replace(tmp_dir, target)
+
+        stage_dir = os.path.dirname(target)
+        builds = sorted((entry.path for entry in os.scandir(stage_dir) if entry.is_dir() and not entry.name.endswith(".tmp")),
+                        key=os.path.getmtime, reverse=True)
+        for old in builds[ARTIFACTS_KEPT:]:
+            shutil.rmtree(old, ignore_errors=True)
+
+    def restore_artifacts(self, name, key):
+        source = self.artifact_dir(name, key)
+        if not os.path.isdir(source):
+            return False
+        for i, path in enumerate(self.stages[name].outputs):
+            copy = os.path.join(source, f"{i}_{os.path.basename(path)}")
+            if not os.path.exists(copy):
+                continue
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            if os.path.isdir(copy):
+                shutil.copytree(copy, path)
+            else:
+                shutil.copy2(copy, path)
+        return True
+
+    def up_to_date(self, name, key, manifest):
+        entry = manifest['stages'].get(name)
+        if not entry or entry['key'] != key:
+            return False
+        return all(path_digest(path, manifest['digests']) == digest for path, digest in entry['outputs'].items())
+
+    def status(self, targets=None):
+        # What a run would do with each stage right now, without running anything. Stages downstream
+        # of one that will run are reported as 'pending': their key depends on its new outputs
+        manifest = self.load_manifest()
+        status = {}
+        for name in self.upstream(targets):
+            if any(status[dependency] != 'cached' for dependency in self.dependencies[name]):
+                status[name] = 'pending'
+                continue
+            key = self.stages[name].key(manifest['digests'])
+            if self.up_to_date(name, key, manifest):
+                status[name] = 'cached'
+            elif os.path.isdir(self.artifact_dir(name, key)):
+                status[name] = 'restore'
+            else:
+                status[name] = 'run'
+        return status
+
+    def run(self, targets=None, force=(), workers=1, keep_artifacts=True):
+        # Builds the targets (every stage by default). `force` names stages to rerun regardless of
+        # their key ('all' for every stage). Returns each stage's outcome and wall time
+        order = self.upstream(targets)
+        force = set(order) if 'all' in force else set(force)
+        manifest = self.load_manifest()
+        results = {}
+        remaining = list(order)
+        running = {}
+        pool = ProcessPoolExecutor(max_workers=workers) if workers and workers > 1 else None
+        try:
+            while remaining or running:
+                # Resolve every stage whose dependencies are done: skip, restore, or start it
+                for name in list(remaining):
+                    if any(dependency not in results for dependency in self.dependencies[name]):
+                        continue
+                    remaining.remove(name)
+                    stage = self.stages[name]
+                    key = stage.key(manifest['digests'])
+                    if name not in force and self.up_to_date(name, key, manifest):
+                        results[name] = {'status': 'cached', 'seconds': 0.0}
+                        print(f"[{name}] up to date")
+                        continue
+                    if name not in force and self.restore_artifacts(name, key):
+                        self.finish(name, key, manifest)
+                        results[name] = {'status': 'restored', 'seconds': 0.0}
+                        print(f"[{name}] restored from cache")
+                        continue
+                    print(f"[{name}] running")
+                    if pool is None:
+                        running[name] = (key, _run_stage(stage.func, stage.params, name))
+                    else:
+                        running[name] = (key, pool.submit(_run_stage, stage.func, stage.params, name))
+
+                if not running:
+                    continue
+                if pool is None:
+                    done = list(running)
+                else:
+                    futures = {future: name for name, (key, future) in running.items()}
+                    finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    done = [futures[future] for future in finished]
+                for name in done:
+                    key, outcome = running.pop(name)
+                    seconds = outcome if pool is None else outcome.result()
+                    self.finish(name, key, manifest)
+                    if keep_artifacts:
+                        self.store_artifacts(name, key)
+                    results[name] = {'status': 'ran', 'seconds': seconds}
+                    print(f"[{name}] done in {seconds:.1f}s")
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+            self.save_manifest(manifest)
+        return results
+
+    def finish(self, name, key, manifest):
+        for path in self.stages[name].outputs:
+            manifest['digests'].pop(path, None)  # rewritten: never trust the old size/mtime entry
+        manifest['stages'][name] = {
+            'key': key,
+            'outputs': {path: path_digest(path, manifest['digests']) for path in self.stages[name].outputs},
+            'finished': pd.Timestamp.now().isoformat(timespec='seconds')
+        }
+        self.save_manifest(manifest)
+
+
+# The store is built as of the export's latest order date, so preprocess and train depend on their
+# inputs only. The forecasting stages read the calendar, so the run's as-of date is one of their
+# parameters (and of their keys)
+def run_preprocess(input, output, chunksize, partition_by, lags, windows):
+    from preprocess import preprocess_data
+    preprocess_data(input, output, chunksize, None, partition_by, lags, windows)
+
+
+def run_train(input, output, raw, backend, batch_rows, external_memory, cv, folds, search, n_iter, workers,
+              segment_by, volume_buckets):
+    from train import train_model, train_model_cv, train_sharded
+    if segment_by:
+        train_sharded(input, output, segment_by, None, workers, raw, volume_buckets)
+    elif cv:
+        train_model_cv(input, output, folds, search, n_iter, workers)
+    else:
+        train_model(input, output, backend, batch_rows, external_memory)
+
+
+def run_predict(data_path, model_path, output_path, forecast_months, quantiles, service_level, as_of):
+    from predict import predict
+    predict(data_path, model_path, output_path, tuple(forecast_months), quantiles, service_level, as_of)
+
+
+def run_snapshot(store, model, output, months, service_levels, as_of):
+    from snapshot import write_snapshot
+    write_snapshot(store, model, output, as_of, months, service_levels)
+
+
+def run_policies(model, store, raw, output, policy, paths, weeks, warmup, service_level, seed, as_of):
+    from policy_simulator import build_inputs, optimize_policies
+    inputs = build_inputs(model, store, raw, warmup + weeks, as_of=as_of)
+    policies = optimize_policies(inputs, paths, service_level, policy, seed=seed, warmup=warmup)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    policies.to_csv(output, index=False)
+
+
+def run_hierarchy(model, store, output, method, horizon, use_model, as_of):
+    from hierarchy import forecast_hierarchy, label_nodes, write_hierarchy_forecast
+    from feature_store import load_features, rebase_as_of
+    from model_backend import load_model
+    from preprocess import load_encoders, default_encoder_path
+    data, as_of = rebase_as_of(load_features(store), store, as_of)
+    frame, _ = forecast_hierarchy(data, load_model(model) if use_model else None, horizon, method, as_of=as_of)
+    write_hierarchy_forecast(label_nodes(frame, load_encoders(default_encoder_path(store))), output)
+
+
+# Parameters of the default pipeline, per stage; override with default_pipeline(params=...) or --set stage.name=value
+DEFAULT_PARAMS = {
+    'preprocess': {'chunksize': None, 'partition_by': None, 'lags': DEFAULT_LAGS, 'windows': list(DEFAULT_WINDOWS)},
+    'train': {'backend': 'forest', 'batch_rows': None, 'external_memory': True,
+              'cv': False, 'folds': 4, 'search': 'grid', 'n_iter': 10, 'workers': None,
+              'segment_by': None, 'volume_buckets': VOLUME_BUCKETS},
+    'predict': {'forecast_months': [1, 2], 'quantiles': list(DEFAULT_QUANTILES), 'service_level': None},
+    'snapshot': {'months': SNAPSHOT_MONTHS, 'service_levels': list(SNAPSHOT_SERVICE_LEVELS)},
+    'policies': {'policy': 'sS', 'paths': 1000, 'weeks': 13, 'warmup': 4, 'service_level': 0.95, 'seed': 42},
+    'hierarchy': {'method': 'mint', 'horizon': 2, 'use_model': True}
+}
+
+
+def default_pipeline(raw_path=RAW_PATH, store_path=FEATURE_STORE_PATH, model_path=None,
+                     forecast_path=FORECAST_PATH, policy_path=POLICY_PATH, params=None, cache_dir=PIPELINE_DIR,
+                     hierarchy_path=HIERARCHY_PATH, as_of=None, snapshot_path=SNAPSHOT_PATH):
+    # preprocess -> train -> {predict, snapshot, policies, hierarchy}. Forecasting reads the calendar (days
+    # until expiry, forecast months), so the as-of date is a parameter of those stages only. Without one they
+    # forecast as of the date the store was built for, which the store (one of their inputs) records
+    params = {name: {**defaults, **(params or {}).get(name, {})} for name, defaults in DEFAULT_PARAMS.items()}
+    as_of = pd.Timestamp(as_of).strftime('%Y-%m-%d') if as_of is not None else None
+    encoder_path = os.path.join(os.path.dirname(store_path), "encoders.json")
+    # Preprocessing also saves the history state incremental appends continue from
+    state_path = default_state_path(store_path)
+    # The model files depend on the backend: a pickle plus its compiled forest, one xgboost file, or
+    # a registry directory of per-segment forests
+    backend = params['train']['backend']
+    segment_by = params['train']['segment_by']
+    if params['train']['cv'] and backend != 'forest':
+        raise ValueError("train.cv searches the forest's hyperparameters; use train.backend=forest")
+    if segment_by and (backend != 'forest' or params['train']['cv']):
+        raise ValueError("train.segment_by fits forests with the default parameters; use train.backend=forest")
+    if segment_by:
+        model_path = model_path or registry_path(segment_by)
+        model_files = [model_path]
+    else:
+        model_path = model_path or DEFAULT_MODEL_PATHS[backend]
+        model_files = [model_path, compiled_path(model_path)] if backend == 'forest' else [model_path]
+    # Dosage Form is not in the feature store; its segments are read from the raw export
+    train_inputs = [store_path, raw_path] if segment_by == 'Dosage Form' else [store_path]
+    active_path = os.path.join(os.path.dirname(model_path), ACTIVE_MODEL_FILE)
+    return Pipeline([
+        Stage('preprocess', run_preprocess, [raw_path], [store_path, encoder_path, state_path],
+              {'input': raw_path, 'output': store_path, **params['preprocess']}, ['preprocess']),
+        Stage('train', run_train, train_inputs, model_files + [active_path],
+              {'input': store_path, 'output': model_path, 'raw': raw_path, **params['train']}, ['train']),
+        Stage('predict', run_predict, [store_path] + model_files, [forecast_path],
+              {'data_path': store_path, 'model_path': model_path, 'output_path': forecast_path, 'as_of': as_of,
+               **params['predict']}, ['predict']),
+        Stage('snapshot', run_snapshot, [store_path, encoder_path] + model_files, [snapshot_path],
+              {'store': store_path, 'model': model_path, 'output': snapshot_path, 'as_of': as_of,
+               **params['snapshot']}, ['snapshot']),
+        Stage('policies', run_policies, [store_path, encoder_path, raw_path] + model_files, [policy_path],
+              {'model': model_path, 'store': store_path, 'raw': raw_path, 'output': policy_path, 'as_of': as_of,
+               **params['policies']}, ['policy_simulator']),
+        Stage('hierarchy', run_hierarchy, [store_path, encoder_path] + model_files, [hierarchy_path],
+              {'model': model_path, 'store': store_path, 'output': hierarchy_path, 'as_of': as_of,
+               **params['hierarchy']}, ['hierarchy'])
+    ], cache_dir)
+
+
+def parse_overrides(assignments):
+    # ['train.cv=true', 'predict.quantiles=[0.05,0.95]'] -> {'train': {'cv': True}, 'predict': {...}}
+    params = {}
+    for assignment in assignments or []:
+        key, _, value = assignment.partition('=')
+        stage_name, _, param = key.partition('.')
+        if stage_name not in DEFAULT_PARAMS or param not in DEFAULT_PARAMS[stage_name]:
+            raise ValueError(f"Unknown parameter '{key}'")
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError:
+            pass  # plain strings need no quotes
+        params.setdefault(stage_name, {})[param] = value
+    return params
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the forecasting pipeline, skipping stages whose inputs, code and parameters are unchanged")
+    parser.add_argument("targets", nargs="*", help="Stages to build, with their dependencies (default: all)")
+    parser.add_argument("--set", nargs="+", default=[], metavar="STAGE.PARAM=VALUE",
+                        help="Override a stage parameter, e.g. train.segment_by=Category predict.service_level=0.95")
+    parser.add_argument("--force", nargs="+", default=[], help="Rerun these stages ('all' for every stage)")
+    parser.add_argument("--workers", type=int, default=2, help="Stages run in parallel when independent")
+    parser.add_argument("--status", action="store_true", help="Show what would run, without running anything")
+    parser.add_argument("--raw", default=RAW_PATH)
+    parser.add_argument("--store", default=FEATURE_STORE_PATH)
+    parser.add_argument("--model", default=None,
+                        help="Model path (default: per train.backend, or the train.segment_by registry)")
+    parser.add_argument("--forecast", default=FORECAST_PATH)
+    parser.add_argument("--policies", default=POLICY_PATH)
+    parser.add_argument("--hierarchy", default=HIERARCHY_PATH)
+    parser.add_argument("--snapshot", default=SNAPSHOT_PATH, help="Forecast snapshot the dashboards render from")
+    parser.add_argument("--as-of", default=None, help="Date the run is as of, YYYY-MM-DD (default: the feature store's as-of date)")
+    args = parser.parse_args()
+
+    pipeline = default_pipeline(args.raw, args.store, args.model, args.forecast, args.policies,
+                                parse_overrides(args.set), hierarchy_path=args.hierarchy, as_of=args.as_of,
+                                snapshot_path=args.snapshot)
+    if args.status:
+        for name, state in pipeline.status(args.targets).items():
+            print(f"{name:<12}{state}")
+        sys.exit(0)
+    pipeline.run(args.targets, args.force, args.workers)
@@ -0,0 +1,304 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from feature_store import FEATURE_STORE_PATH, MODEL_FEATURES, TARGET, TIME_COLUMN, load_features, rebase_as_of
+from model_backend import load_model
+from forecaster import RecursiveForecaster, latest_rows
+from preprocess import load_encoders, default_encoder_path
+from instrumentation import stage, export_metrics
+
+POLICY_PATH = "predictions/inventory_policies.csv"
+RAW_PATH = "original_data/final_medicine_inventory_sales_data.csv"
+
+WEEKS_PER_MONTH = 52 / 12
+# z is the safety factor of the reorder point, and k sizes the order (or order-up-to gap) in weeks of demand
+SAFETY_FACTORS = (-0.5, 0.0, 0.5, 1.0, 1.5, 2.0, 2.5, 3.0)
+ORDER_WEEKS = (1, 2, 4, 8)
+# Peak bytes per (path, SKU, week), used to size SKU chunks to the memory budget. The peak is in
+# sample_paths: float64 demand, the int64 lead-time draws, and the float64 lead days plus two float64
+# temporaries while they are rounded to weeks (5 x 8 bytes; tracemalloc measures 40.0). simulate()
+# holds less per week (float32 demand, int16 lead weeks, float64 receipts and pipeline: 22 bytes);
+# its per-(path, SKU) running totals are covered by the 4 extra weeks the chunk size allows for
+BYTES_PER_CELL = 40
+
+
+class PolicyInputs:
+    # Per-SKU arrays the simulator needs: weekly demand mean/sd, bootstrapped lead-time history,
+    # opening stock and its expiry, shelf life of new receipts and unit economics
+    def __init__(self, skus, demand_mean, demand_sd, lead_times, lead_starts, lead_counts, stock,
+                 days_until_expiry, shelf_life, unit_cost, stockout_cost):
+        self.skus = np.asarray(skus)
+        self.demand_mean = np.asarray(demand_mean, dtype=np.float64)  # (weeks x SKUs)
+        self.demand_sd = np.asarray(demand_sd, dtype=np.float64)
+        self.lead_times = np.asarray(lead_times, dtype=np.float64)  # days, SKU-contiguous
+        self.lead_starts = np.asarray(lead_starts)
+        self.lead_counts = np.asarray(lead_counts)
+        self.stock = np.asarray(stock, dtype=np.float64)
+        self.days_until_expiry = np.asarray(days_until_expiry, dtype=np.float64)
+        self.shelf_life = np.asarray(shelf_life, dtype=np.float64)
+        self.unit_cost = np.asarray(unit_cost, dtype=np.float64)
+        self.stockout_cost = np.asarray(stockout_cost, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.skus)
+
+    def chunk(self, start, stop):
+        lead_start, lead_stop = self.lead_starts[start], self.lead_starts[stop - 1] + self.lead_counts[stop - 1]
+        return PolicyInputs(
+            self.skus[start:stop], self.demand_mean[:, start:stop], self.demand_sd[:, start:stop],
+            self.lead_times[lead_start:lead_stop], self.lead_starts[start:stop] - lead_start,
+            self.lead_counts[start:stop], self.stock[start:stop], self.days_until_expiry[start:stop],
+            self.shelf_life[start:stop], self.unit_cost[start:stop], self.stockout_cost[start:stop]
+        )
+
+
+def policy_candidates(policy="sS", safety_factors=SAFETY_FACTORS, order_weeks=ORDER_WEEKS):
+    return [(policy, z, k) for z in safety_factors for k in order_weeks]
+
+
+def sample_paths(inputs, n_paths, rng):
+    # Demand per (week, path, SKU) from a gamma matched to the weekly mean and sd, and the lead
+    # time (in whole weeks, at least one) of an order placed in each week, bootstrapped per SKU
+    n_weeks, n_skus = inputs.demand_mean.shape
+    mean = inputs.demand_mean[:, None, :]
+    variance = np.maximum(inputs.demand_sd ** 2, inputs.demand_mean)[:, None, :]  # at least Poisson noise
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shape = np.where(mean > 0, mean ** 2 / variance, 1.0)
+        scale = np.where(mean > 0, variance / mean, 0.0)
+    size = (n_weeks, n_paths, n_skus)
+    demand = rng.gamma(np.broadcast_to(shape, size), np.broadcast_to(scale, size))
+
+    draws = (rng.random(size) * inputs.lead_counts).astype(np.int64)
+    lead_days = inputs.lead_times[inputs.lead_starts + draws]
+    lead_weeks = np.maximum(np.ceil(lead_days / 7), 1).astype(np.int16)
+    return demand.astype(np.float32), lead_weeks
+
+
+def simulate(inputs, demand, lead_weeks, policy, reorder_point, order_size, holding_cost, order_cost, warmup=0):
+    # Weekly periodic review of one policy for every (path, SKU) at once. Stock is issued FIFO and
+    # tracked as cumulative receipts minus cumulative outflow, so the stock left from any receipt
+    # (and what spoils when it expires) is read off the two running totals without per-batch state
+    n_weeks, n_paths, n_skus = demand.shape
+    max_lead = int(lead_weeks.max()) if lead_weeks.size else 1
+    shelf_weeks = np.maximum(np.round(inputs.shelf_life / 7), 1).astype(np.int64)
+    opening_expiry = np.floor(inputs.days_until_expiry / 7)  # negative: already expired, NaN: never
+
+    received = np.broadcast_to(inputs.stock, (n_paths, n_skus)).astype(np.float64)  # cumulative receipts
+    opening = received.copy()
+    receipts = np.zeros((n_weeks + 1, n_paths, n_skus))  # cumulative receipts after each week's delivery
+    outflow = np.zeros((n_paths, n_skus))  # cumulative units sold or spoiled
+    pipeline = np.zeros((n_weeks + max_lead + 1, n_paths, n_skus))
+    on_order = np.zeros((n_paths, n_skus))
+    totals = {name: np.zeros((n_paths, n_skus)) for name in ['demand', 'lost', 'spoiled', 'holding', 'orders']}
+    path_index = np.arange(n_paths)[:, None]
+    sku_index = np.arange(n_skus)[None, :]
+
+    for week in range(n_weeks):
+        # Deliveries due this week
+        received += pipeline[week]
+        on_order -= pipeline[week]
+        receipts[week] = received
+
+        # Expiry: the opening stock on its own date, then each week's receipt shelf_weeks after it
+        # arrived. FIFO means everything received up to that receipt and still on hand goes with it
+        expired = np.where(opening_expiry <= week, np.maximum(opening - outflow, 0), 0)
+        arrival = week - shelf_weeks
+        arrived = receipts[np.maximum(arrival, 0), path_index, sku_index]
+        expired = expired + np.where(arrival >= 0, np.maximum(arrived - outflow - expired, 0), 0)
+        outflow += expired
+
+        # Demand is met from stock, the rest is lost
+        sold = np.minimum(demand[week], received - outflow)
+        outflow += sold
+        measured = week >= warmup
+        if measured:
+            totals['spoiled'] += expired
+            totals['demand'] += demand[week]
+            totals['lost'] += demand[week] - sold
+            totals['holding'] += received - outflow
+
+        # Review: order when the inventory position is at or below the reorder point
+        position = received - outflow + on_order
+        if policy == "sS":
+            quantity = np.where(position <= reorder_point, reorder_point + order_size - position, 0)
+        else:
+            quantity = np.where(position <= reorder_point,
+                                order_size * np.ceil((reorder_point - position) / order_size + 1e-9), 0)
+        # Each (path, SKU) places at most one order per week, so the scatter into the arrival week has no collisions
+        pipeline[week + lead_weeks[week], path_index, sku_index] += quantity
+        on_order += quantity
+        if measured:
+            totals['orders'] += quantity > 0
+
+    # Per SKU: fill rate over all paths and mean weekly cost per path, after the warm-up
+    n_weeks -= warmup
+    demand_total = totals['demand'].sum(axis=0)
+    fill_rate = np.where(demand_total > 0, 1 - totals['lost'].sum(axis=0) / np.maximum(demand_total, 1e-12), 1.0)
+    costs = {
+        'Holding Cost': holding_cost * totals['holding'].mean(axis=0) / n_weeks,
+        'Ordering Cost': order_cost * totals['orders'].mean(axis=0) / n_weeks,
+        'Stockout Cost': inputs.stockout_cost * totals['lost'].mean(axis=0) / n_weeks,
+        'Spoilage Cost': inputs.unit_cost * totals['spoiled'].mean(axis=0) / n_weeks
+    }
+    return {
+        'Fill Rate': fill_rate,
+        'Weekly Cost': sum(costs.values()),
+        **costs,
+        'Orders': totals['orders'].mean(axis=0),
+        'Spoiled Units': totals['spoiled'].mean(axis=0)
+    }
+
+
+def best_policies(inputs, n_paths=1000, service_level=0.95, candidates=None, holding_rate=0.25, order_cost=50.0,
+                  seed=42, warmup=0):
+    # Every candidate runs on the same sampled paths; the cheapest one meeting the fill-rate
+    # target wins, or the one with the best fill rate when none does. The first `warmup` weeks
+    # are simulated from today's stock but left out of the scores, so a stock-out no policy could
+    # prevent before its first delivery does not decide the policy
+    candidates = candidates or policy_candidates()
+    rng = np.random.default_rng([seed, int(inputs.skus[0]) if len(inputs) else 0])
+    demand, lead_weeks = sample_paths(inputs, n_paths, rng)
+
+    weekly_mean = inputs.demand_mean.mean(axis=0)
+    weekly_sd = np.sqrt(np.maximum(inputs.demand_sd ** 2, inputs.demand_mean).mean(axis=0))
+    mean_lead_weeks = lead_weeks.mean(axis=(0, 1))
+    protection_mean = weekly_mean * (mean_lead_weeks + 1)  # lead time plus one review period
+    protection_sd = weekly_sd * np.sqrt(mean_lead_weeks + 1)
+    holding_cost = inputs.unit_cost * holding_rate / 52
+
+    best = None
+    for policy, z, k in candidates:
+        reorder_point = np.maximum(protection_mean + z * protection_sd, 0)
+        order_size = np.maximum(k * weekly_mean, 1)
+        result = simulate(inputs, demand, lead_weeks, policy, reorder_point, order_size, holding_cost, order_cost,
+                          warmup)
+        result.update({'Policy': np.full(len(inputs), policy, dtype=object), 'Safety Factor': np.full(len(inputs), z),
+                       'Reorder Point': reorder_point, 'Order Size': order_size})
+        if best is None:
+            best = result
+            continue
+        meets, best_meets = result['Fill Rate'] >= service_level, best['Fill Rate'] >= service_level
+        better = np.where(meets & best_meets, result['Weekly Cost'] < best['Weekly Cost'],
+                          np.where(meets | best_meets, meets, result['Fill Rate'] > best['Fill Rate']))
+        for name in best:
+            best[name] = np.where(better, result[name], best[name])
+
+    table = pd.DataFrame({'SKU': inputs.skus, **best})
+    table['Meets Target'] = table['Fill Rate'] >= service_level
+    return table
+
+
+def _run_chunk(args):
+    inputs, kwargs = args
+    return best_policies(inputs, **kwargs)
+
+
+def optimize_policies(inputs, n_paths=1000, service_level=0.95, policy="sS", holding_rate=0.25, order_cost=50.0,
+                      seed=42, max_memory_mb=512, workers=1, warmup=0):
+    # SKUs are simulated in chunks sized so the sampled paths fit the memory budget; each chunk
+    # seeds its own generator from its first SKU, so results do not depend on the worker count
+    n_weeks = inputs.demand_mean.shape[0]
+    chunk_skus = max(1, int(max_memory_mb * 2 ** 20 // (BYTES_PER_CELL * n_paths * (n_weeks + 4))))
+    kwargs = {'n_paths': n_paths, 'service_level': service_level, 'candidates': policy_candidates(policy),
+              'holding_rate': holding_rate, 'order_cost': order_cost, 'seed': seed, 'warmup': warmup}
+    chunks = [(inputs.chunk(start, min(start + chunk_skus, len(inputs))), kwargs)
+              for start in range(0, len(inputs), chunk_skus)]
+    print(f"Simulating {len(kwargs['candidates'])} policies x {n_paths} paths x {n_weeks} weeks "
+          f"for {len(inputs)} SKUs in {len(chunks)} chunks")
+
+    with stage("simulate", rows=len(inputs)):
+        if workers and workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                tables = list(pool.map(_run_chunk, chunks))
+        else:
+            tables = [_run_chunk(chunk) for chunk in chunks]
+    return pd.concat(tables, ignore_index=True)
+
+
+def sku_attributes(raw_path, encoders):
+    # Unit cost, selling price and shelf life at delivery per encoded SKU, from the raw ERP export
+    raw = pd.read_csv(raw_path, usecols=['SKU', 'Unit Cost', 'Selling Price', 'Expiration Date', 'Delivery Date'],
+                      parse_dates=['Expiration Date', 'Delivery Date'])
+    raw['SKU'] = raw['SKU'].map(encoders['SKU'])
+    raw['Shelf Life'] = (raw['Expiration Date'] - raw['Delivery Date']).dt.days
+    return raw.groupby('SKU').agg(unit_cost=('Unit Cost', 'mean'), price=('Selling Price', 'mean'),
+                                  shelf_life=('Shelf Life', 'median'))
+
+
+def build_inputs(model_path=None, store_path=FEATURE_STORE_PATH, raw_path=RAW_PATH, n_weeks=13,
+                 default_shelf_life=365, default_unit_cost=1.0, as_of=None):
+    # Weekly demand mean/sd from the recursive forecast's P10-P90 spread, lead times from each SKU's
+    # order history, and opening stock and expiry from its latest row, all as of the given date
+    # (default: the date the store was built for)
+    with stage("build_inputs"):
+        data = load_features(store_path, columns=MODEL_FEATURES + [TARGET, TIME_COLUMN])
+        data, as_of = rebase_as_of(data, store_path, as_of)
+        model = load_model(model_path)
+        n_months = int(np.ceil(n_weeks / WEEKS_PER_MONTH))
+        forecast = RecursiveForecaster(model).forecast(data, n_months, start_date=as_of, quantiles=(0.1, 0.9))
+
+        skus = np.sort(data['SKU'].unique())
+        steps = forecast.pivot(index='Step', columns='SKU', values=['Predicted Demand', 'P10', 'P90'])
+        monthly = steps['Predicted Demand'][skus].to_numpy()
+        monthly_sd = (steps['P90'] - steps['P10'])[skus].to_numpy() / (2 * 1.2816)  # P10-P90 of a normal spans 2.56 sd
+        month_of_week = np.minimum((np.arange(n_weeks) / WEEKS_PER_MONTH).astype(int), n_months - 1)
+        demand_mean = np.maximum(monthly[month_of_week], 0) / WEEKS_PER_MONTH
+        demand_sd = monthly_sd[month_of_week] / np.sqrt(WEEKS_PER_MONTH)
+
+        history = data[['SKU', 'Lead_Time']].dropna().sort_values('SKU', kind='stable')
+        lead_counts = history.groupby('SKU').size().reindex(skus, fill_value=0).to_numpy()
+        lead_times = history['Lead_Time'].to_numpy(dtype=np.float64)
+        if (lead_counts == 0).any():
+            # SKUs without lead-time history borrow the overall median
+            missing = np.repeat(np.median(lead_times) if len(lead_times) else 7.0, (lead_counts == 0).sum())
+            order = np.argsort(np.r_[history['SKU'].to_numpy(), skus[lead_counts == 0]], kind='stable')
+            lead_times = np.r_[lead_times, missing][order]
+            lead_counts = np.maximum(lead_counts, 1)
+        lead_starts = np.r_[0, np.cumsum(lead_counts)[:-1]]
+
+        latest = latest_rows(data).set_index('SKU').reindex(skus)
+        attributes = pd.DataFrame(np.nan, index=skus, columns=['unit_cost', 'price', 'shelf_life'])
+        if raw_path and os.path.exists(raw_path):
+            attributes = sku_attributes(raw_path, load_encoders(default_encoder_path(store_path))).reindex(skus)
+        unit_cost = attributes['unit_cost'].fillna(default_unit_cost).to_numpy()
+        margin = (attributes['price'] - attributes['unit_cost']).clip(lower=0).to_numpy()
+        margin = np.where(np.isnan(margin), unit_cost, margin)
+        shelf_life = attributes['shelf_life'].fillna(default_shelf_life).to_numpy()
+
+    return PolicyInputs(
+        skus, demand_mean, demand_sd, lead_times, lead_starts, lead_counts,
+        latest['Stock Balance'].fillna(0).clip(lower=0).to_numpy(), latest['Days_Until_Expiry'].to_numpy(),
+        shelf_life, unit_cost, stockout_cost=unit_cost + margin  # the lost margin plus goodwill valued at cost
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find the cheapest inventory policy per SKU by Monte Carlo simulation")
+    parser.add_argument("--model", default=None, help="Model to forecast with (default: the last trained)")
+    parser.add_argument("--store", default=FEATURE_STORE_PATH)
+    parser.add_argument("--raw", default=RAW_PATH, help="Raw ERP export with unit costs, prices and expiry dates")
+    parser.add_argument("--output", default=POLICY_PATH)
+    parser.add_argument("--policy", choices=["sS", "rQ"], default="sS", help="(s, S) or reorder point / fixed quantity")
+    parser.add_argument("--paths", type=int, default=1000, help="Sampled demand and lead-time paths per SKU")
+    parser.add_argument("--weeks", type=int, default=13, help="Scored horizon, in weekly review periods")
+    parser.add_argument("--warmup", type=int, default=4, help="Weeks simulated before scoring starts")
+    parser.add_argument("--service-level", type=float, default=0.95, help="Target fill rate")
+    parser.add_argument("--holding-rate", type=float, default=0.25, help="Annual holding cost as a share of unit cost")
+    parser.add_argument("--order-cost", type=float, default=50.0, help="Fixed cost per purchase order")
+    parser.add_argument("--max-memory-mb", type=int, default=512, help="Memory budget per SKU chunk")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--as-of", default=None,
+                        help="Date to simulate from, YYYY-MM-DD (default: the date the feature store was built for)")
+    args = parser.parse_args()
+
+    inputs = build_inputs(args.model, args.store, args.raw, args.warmup + args.weeks, as_of=args.as_of)
+    policies = optimize_policies(inputs, args.paths, args.service_level, args.policy, args.holding_rate,
+                                 args.order_cost, args.seed, args.max_memory_mb, args.workers, args.warmup)
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    policies.to_csv(args.output, index=False)
+    print(f"{policies['Meets Target'].mean():.1%} of SKUs meet the {args.service_level:.0%} fill rate; "
+          f"policies saved to {args.output}")
+    export_metrics("policy_simulator")
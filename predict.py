@@ -1,74 +1,117 @@
 import pandas as pd
-import joblib
 import numpy as np
 import os
-from datetime import datetime
-
-# Load preprocessed data
-df = pd.read_csv("processed_data/medicine_inventory_cleaned.csv")
-
-# Load trained model
-model = joblib.load("models/demand_forecasting_rf.pkl")
+import argparse
+from feature_store import (FEATURE_STORE_PATH, MODEL_FEATURES, TARGET, TIME_COLUMN, load_features, as_of_date,
+                           rebase_as_of)
+from model_backend import load_model
+from forecaster import RecursiveForecaster
+from quantiles import DEFAULT_QUANTILES, quantile_label
+from instrumentation import stage, instrumented, export_metrics
 
 # Define features (excluding target column)
-features = [
-    'SKU', 'Stock In', 'Stock Out', 'Stock Balance', 'Days_Until_Expiry', 'Lead_Time',
-    'Season', 'Holiday', 'Promotion', 'Lag_1', 'Lag_2', 'Lag_3', 
-    'Moving Average', 'Order_Day', 'Order_Month', 'Order_Weekday', 'Days_Since_Last_Order'
-]
-
-# Predict demand for each SKU
-df['Predicted Demand'] = model.predict(df[features])
-
-# Generate forecasts for May (Next Month) and June (Next+1 Month)
-forecast_months = [1, 2]  # Forecast for the next 2 months
-
-all_forecasts = []
-
-for month_offset in forecast_months:
-    forecast_date = pd.to_datetime('today') + pd.DateOffset(months=month_offset)
-    forecast_month = forecast_date.month
-    forecast_year = forecast_date.year
-
-    df['Order Month'] = forecast_month
-    df['Order Year'] = forecast_year  # Ensure correct year handling
-
-    monthly_forecast = df.groupby(['SKU', 'Order Month', 'Order Year']).agg({
-        'Predicted Demand': 'sum',  # Sum demand at monthly level
-        'Stock Balance': 'last'  # Latest stock balance
-    }).reset_index()
-
-    # Define reorder threshold
-    reorder_threshold = 50  
-
-    # Determine if an order is needed
-    monthly_forecast['Reorder Needed'] = monthly_forecast['Stock Balance'] < reorder_threshold
-
-    # Calculate reorder quantity
-    monthly_forecast['Reorder Quantity'] = np.where(
-        monthly_forecast['Reorder Needed'], 
-        np.maximum(0, monthly_forecast['Predicted Demand'] - monthly_forecast['Stock Balance']),
-        0
-    )
-
-    # Set recommended order date (custom placeholder when no order is needed)
-    monthly_forecast['Recommended Order Date'] = np.where(
-        monthly_forecast['Reorder Needed'], 
-        forecast_date.strftime('%Y-%m-01'), 
-        "No Order Needed"
-    )
-
-    all_forecasts.append(monthly_forecast)
-
-# Combine both months into one DataFrame
-final_forecast = pd.concat(all_forecasts, ignore_index=True)
-
-# **Ensure the predictions directory exists**
-output_dir = "predictions"
-os.makedirs(output_dir, exist_ok=True)
-
-# Save predictions to CSV
-output_path = os.path.join(output_dir, "multi_month_demand_forecast.csv")
-final_forecast.to_csv(output_path, index=False)
-
-print(f"Multi-month demand forecast saved to {output_path}")
+features = MODEL_FEATURES
+
+FORECAST_PATH = "predictions/multi_month_demand_forecast.csv"
+
+
+def build_forecast(model, df, forecast_months=(1, 2), lag_scale=None, quantiles=DEFAULT_QUANTILES, service_level=None,
+                   as_of=None):
+    # Predict demand for each SKU, rolling the lag features forward month by month, with the
+    # requested quantiles of the demand distribution (and the service level's, when ordering to one).
+    # Forecast months are counted from the as-of date, so the same inputs always give the same output
+    as_of = as_of_date(as_of)
+    quantiles = sorted(set(quantiles or ()) | ({service_level} if service_level else set()))
+    with stage("forecast", rows=len(df)):
+        sku_forecast = RecursiveForecaster(model, lag_scale).forecast(
+            df, horizon=max(forecast_months), start_date=as_of, quantiles=quantiles
+        )
+    return monthly_reorders(sku_forecast, forecast_months, quantiles, service_level, as_of)
+
+
+def monthly_reorders(sku_forecast, forecast_months=(1, 2), quantiles=DEFAULT_QUANTILES, service_level=None, as_of=None):
+    # The forecast file's rows (one per SKU and month, with reorder decisions) from a RecursiveForecaster output
+    as_of = as_of_date(as_of)
+    quantiles = sorted(set(quantiles or ()) | ({service_level} if service_level else set()))
+    quantile_columns = [quantile_label(q) for q in quantiles]
+    all_forecasts = []
+
+    for month_offset in forecast_months:
+        forecast_date = as_of + pd.DateOffset(months=month_offset)
+        forecast_month = forecast_date.month
+        forecast_year = forecast_date.year
+
+        monthly_forecast = sku_forecast.loc[
+            sku_forecast['Step'] == month_offset, ['SKU', 'Predicted Demand'] + quantile_columns + ['Stock Balance']
+        ].reset_index(drop=True)
+        monthly_forecast.insert(1, 'Order Month', forecast_month)
+        monthly_forecast.insert(2, 'Order Year', forecast_year)  # Ensure correct year handling
+
+        # Define reorder threshold
+        reorder_threshold = 50
+
+        # Determine if an order is needed
+        monthly_forecast['Reorder Needed'] = monthly_forecast['Stock Balance'] < reorder_threshold
+
+        # Calculate reorder quantity (up to the service-level quantile of demand when one is set)
+        target = monthly_forecast[quantile_label(service_level) if service_level else 'Predicted Demand']
+        monthly_forecast['Reorder Quantity'] = np.where(
+            monthly_forecast['Reorder Needed'],
+            np.maximum(0, target - monthly_forecast['Stock Balance']),
+            0
+        )
+
+        # Set recommended order date (custom placeholder when no order is needed)
+        monthly_forecast['Recommended Order Date'] = np.where(
+            monthly_forecast['Reorder Needed'],
+            forecast_date.strftime('%Y-%m-01'),
+            "No Order Needed"
+        )
+
+        all_forecasts.append(monthly_forecast)
+
+    # Combine all months into one DataFrame
+    return pd.concat(all_forecasts, ignore_index=True)
+
+
+@instrumented("predict")
+def predict(data_path=FEATURE_STORE_PATH, model_path=None,
+            output_path=FORECAST_PATH, forecast_months=(1, 2), quantiles=DEFAULT_QUANTILES, service_level=None,
+            as_of=None):
+    # Load preprocessed data (the model features, plus what the forecaster needs to order and scale history),
+    # as of the given date or, by default, the date the store was built for
+    with stage("load") as span:
+        df = load_features(data_path, columns=features + [TARGET, TIME_COLUMN])
+        df, as_of = rebase_as_of(df, data_path, as_of)
+        span['rows'] = len(df)
+
+    # Load trained model (the last one trained unless a path is given; forests load compiled when available)
+    with stage("load_model"):
+        model = load_model(model_path)
+
+    final_forecast = build_forecast(model, df, forecast_months, quantiles=quantiles, service_level=service_level,
+                                    as_of=as_of)
+
+    # **Ensure the predictions directory exists**
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    # Save predictions to CSV
+    with stage("csv_write", rows=len(final_forecast)):
+        final_forecast.to_csv(output_path, index=False)
+
+    print(f"Multi-month demand forecast as of {as_of.date()} saved to {output_path}")
+    return final_forecast
+
+
+# Generate forecasts for the next 2 months
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Forecast demand and reorders per SKU")
+    parser.add_argument("--quantiles", type=float, nargs="*", default=list(DEFAULT_QUANTILES),
+                        help="Demand quantiles to report, e.g. 0.1 0.5 0.9 (none for point forecasts only)")
+    parser.add_argument("--service-level", type=float, default=None,
+                        help="Size reorders to this demand quantile (e.g. 0.95) instead of the point forecast")
+    parser.add_argument("--as-of", default=None,
+                        help="Date to forecast from, YYYY-MM-DD (default: the date the feature store was built for)")
+    args = parser.parse_args()
+    predict(quantiles=args.quantiles, service_level=args.service_level, as_of=args.as_of)
+    export_metrics("predict")
@@ -1,59 +1,219 @@
 import os
+import json
+import argparse
 import pandas as pd
-from sklearn.preprocessing import LabelEncoder
 import numpy as np
+from feature_store import (FEATURE_STORE_PATH, HIERARCHY_COLUMNS, FeatureStoreWriter, as_of_date, empty_summary,
+                           summarize, save_store_state)
+from history_features import HistoryFeatures, DEFAULT_LAGS, DEFAULT_WINDOWS
+from instrumentation import stage, export_metrics
 
-def preprocess_data(input_path, output_path):
-    # Ensure the output directory exists
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    
-    # Load the dataset
-    df = pd.read_csv(input_path)
-    
+# Raw export columns used by the pipeline, with explicit dtypes so pandas never has to infer them
+RAW_DTYPES = {
+    'SKU': str, 'Season': str,
+    'Country': str, 'Distributor ID': str, 'Distributor Type': str, 'Category': str,
+    'Stock In': 'int32', 'Stock Out': 'int32', 'Stock Balance': 'int32',
+    'Holiday': 'int8', 'Promotion': 'int8',
+    'Lag_1': 'int32', 'Lag_2': 'int32', 'Lag_3': 'int32',
+    'Moving Average': 'float64', 'Demand Forecast': 'int32'
+}
+DATE_COLUMNS = ['Manufacturing Date', 'Expiration Date', 'Order Date', 'Delivery Date', 'Shipping Date']
+DATE_FORMAT = '%Y-%m-%d'
+
+SEASON_MAPPING = {'Spring': 0, 'Summer': 1, 'Autumn': 2, 'Winter': 3}
+
+FINAL_COLUMNS = [
+    'SKU', 'Stock In', 'Stock Out', 'Stock Balance', 'Days_Until_Expiry', 'Lead_Time',
+    'Season', 'Holiday', 'Promotion', 'Lag_1', 'Lag_2', 'Lag_3',
+    'Moving Average', 'Demand Forecast', 'Order_Day', 'Order_Month', 'Order_Weekday', 'Days_Since_Last_Order',
+    'Country', 'Distributor ID', 'Distributor Type', 'Category', 'Order Date'
+]
+
+
+def default_encoder_path(output_path):
+    return os.path.join(os.path.dirname(output_path), "encoders.json")
+
+
+def load_encoders(encoder_path):
+    # Load the persisted SKU / Season / hierarchy code mappings, or start fresh
+    if encoder_path and os.path.exists(encoder_path):
+        with open(encoder_path) as f:
+            return json.load(f)
+    return {'SKU': {}, 'Season': dict(SEASON_MAPPING)}
+
+
+def save_encoders(encoders, encoder_path):
+    # Write to a temp file first so a crashed run never leaves a half-written sidecar
+    tmp_path = encoder_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(encoders, f, indent=2)
+    os.replace(tmp_path, encoder_path)
+
+
+def encode_labels(values, mapping):
+    # Unseen labels get the next free codes in sorted order (of the values given), which matches
+    # LabelEncoder on a fresh run
+    new_labels = sorted(set(values.dropna().unique()) - mapping.keys())
+    next_code = max(mapping.values(), default=-1) + 1
+    for offset, label in enumerate(new_labels):
+        mapping[label] = next_code + offset
+    return values.map(mapping).fillna(-1).astype(int)
+
+
+def scan_raw(input_path, encoders, chunksize=None):
+    # One pass over the label and order date columns only. Codes every SKU and hierarchy label up front,
+    # in sorted order over the whole file (otherwise each chunk would code its own new labels and the
+    # codes would depend on the chunk size), and returns the latest order date
+    label_columns = ['SKU'] + HIERARCHY_COLUMNS
+    seen = {col: set() for col in label_columns}
+    latest = []
+    with stage("raw_scan"):
+        chunks = pd.read_csv(input_path, usecols=lambda col: col in seen or col == 'Order Date', dtype=str,
+                             chunksize=chunksize)
+        for chunk in chunks if chunksize else [chunks]:
+            for col in label_columns:
+                if col in chunk.columns:
+                    seen[col].update(chunk[col].dropna().unique())
+            if 'Order Date' in chunk.columns:
+                latest.append(pd.to_datetime(chunk['Order Date'], format=DATE_FORMAT, errors='coerce').max())
+    for col in label_columns:
+        if seen[col]:
+            encode_labels(pd.Series(sorted(seen[col])), encoders.setdefault(col, {}))
+    latest = pd.Series(latest, dtype='datetime64[ns]').max()
+    return None if pd.isna(latest) else latest
+
+
+def transform_chunk(df, encoders, as_of, history=None):
     # Convert date columns to datetime format
-    date_columns = ['Manufacturing Date', 'Expiration Date', 'Order Date', 'Delivery Date', 'Shipping Date']
-    for col in date_columns:
-        df[col] = pd.to_datetime(df[col], errors='coerce')
-    
-    # Encode SKU column
-    le = LabelEncoder()
-    df['SKU'] = le.fit_transform(df['SKU'])
-    
-    # Convert Season column to numerical values
-    season_mapping = {'Spring': 0, 'Summer': 1, 'Autumn': 2, 'Winter': 3}
-    df['Season'] = df['Season'].map(season_mapping).fillna(-1).astype(int)
-    
-    # Feature Engineering - Order Date based features
-    df['Order_Day'] = df['Order Date'].dt.day
-    df['Order_Month'] = df['Order Date'].dt.month
-    df['Order_Weekday'] = df['Order Date'].dt.weekday  # Monday=0, Sunday=6
-
-    # Calculate Days Since Last Order
-    df['Days_Since_Last_Order'] = (df['Order Date'] - df['Order Date'].shift(1)).dt.days.fillna(0)
-    
-    # Feature Engineering - Expiry & Lead Time
-    df['Days_Until_Expiry'] = (df['Expiration Date'] - pd.to_datetime('today')).dt.days
-    df['Lead_Time'] = (df['Delivery Date'] - df['Order Date']).dt.days
-
-    # Adjust stock values before selecting columns
-    df['Stock In'] = np.where(df['Stock Balance'] < 0, abs(df['Stock Balance']), df['Stock In'])
-    df['Stock Balance'] = df['Stock In'] - df['Stock Out']
-    df['Stock Balance'] = df['Stock Balance'].clip(lower=0)
-
-    # Select relevant columns
-    final_columns = [
-        'SKU', 'Stock In', 'Stock Out', 'Stock Balance', 'Days_Until_Expiry', 'Lead_Time',
-        'Season', 'Holiday', 'Promotion', 'Lag_1', 'Lag_2', 'Lag_3', 
-        'Moving Average', 'Demand Forecast', 'Order_Day', 'Order_Month', 'Order_Weekday', 'Days_Since_Last_Order'
-    ]
-    
+    with stage("date_parsing", rows=len(df)):
+        for col in DATE_COLUMNS:
+            if col in df.columns:
+                df[col] = pd.to_datetime(df[col], format=DATE_FORMAT, errors='coerce')
+
+    with stage("encoding", rows=len(df)):
+        # Encode SKU column
+        df['SKU'] = encode_labels(df['SKU'], encoders['SKU'])
+
+        # Encode the planning hierarchy the same way (older encoder files start these mappings empty)
+        for col in HIERARCHY_COLUMNS:
+            if col in df.columns:
+                df[col] = encode_labels(df[col], encoders.setdefault(col, {}))
+
+        # Convert Season column to numerical values
+        df['Season'] = df['Season'].map(encoders['Season']).fillna(-1).astype(int)
+
+    with stage("feature_engineering", rows=len(df)):
+        # Feature Engineering - Order Date based features
+        df['Order_Day'] = df['Order Date'].dt.day
+        df['Order_Month'] = df['Order Date'].dt.month
+        df['Order_Weekday'] = df['Order Date'].dt.weekday  # Monday=0, Sunday=6
+
+        # Feature Engineering - Expiry & Lead Time
+        df['Days_Until_Expiry'] = (df['Expiration Date'] - as_of).dt.days
+        df['Lead_Time'] = (df['Delivery Date'] - df['Order Date']).dt.days
+
+        # Adjust stock values before selecting columns
+        df['Stock In'] = np.where(df['Stock Balance'] < 0, abs(df['Stock Balance']), df['Stock In'])
+        df['Stock Balance'] = df['Stock In'] - df['Stock Out']
+        df['Stock Balance'] = df['Stock Balance'].clip(lower=0)
+
+    # Per-SKU history (carried over from earlier chunks by the HistoryFeatures instance)
+    history = history if history is not None else HistoryFeatures()
+    with stage("history_features", rows=len(df)):
+        derived = history.transform(df)
+
+        # Lags are derived from each SKU's own Stock Out series; the export's values only cover
+        # a SKU's first periods, before there is history to derive them from
+        for k in range(1, min(history.lags, 3) + 1):
+            lag = derived[f"{history.prefix}_Lag_{k}"]
+            df[f'Lag_{k}'] = lag.fillna(df[f'Lag_{k}']) if f'Lag_{k}' in df.columns else lag
+        if all(f'Lag_{k}' in df.columns for k in range(1, 4)):
+            df['Moving Average'] = df[['Lag_1', 'Lag_2', 'Lag_3']].mean(axis=1)
+
+        # Days Since Last Order, per SKU
+        df['Days_Since_Last_Order'] = derived['Days_Since_Last_Order']
+        df[history.columns] = derived[history.columns]
+
     # Ensure all required columns exist before filtering
-    df = df[[col for col in final_columns if col in df.columns]]
-    
-    # Save processed data
-    df.to_csv(output_path, index=False)
-    print(f"Preprocessing complete. Data saved to {output_path}")
+    return df[[col for col in FINAL_COLUMNS + history.columns if col in df.columns]]
+
+
+def read_raw(input_path, chunksize=None):
+    # Only parse the columns the pipeline uses
+    return pd.read_csv(
+        input_path,
+        usecols=lambda col: col in RAW_DTYPES or col in DATE_COLUMNS,
+        dtype=RAW_DTYPES,
+        chunksize=chunksize
+    )
+
+
+def timed_reads(chunks):
+    # Records each CSV read as a csv_load stage
+    chunks = iter(chunks)
+    while True:
+        with stage("csv_load") as span:
+            chunk = next(chunks, None)
+            span['rows'] = 0 if chunk is None else len(chunk)
+        if chunk is None:
+            return
+        yield chunk
+
+
+def preprocess_data(input_path, output_path, chunksize=None, encoder_path=None, partition_cols=None,
+                    lags=DEFAULT_LAGS, windows=DEFAULT_WINDOWS, as_of=None):
+    # Ensure the output directory exists
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+    encoder_path = encoder_path or default_encoder_path(output_path)
+    encoders = load_encoders(encoder_path)
+    # Days_Until_Expiry is counted from the as-of date, which the store records. By default it is the
+    # latest order date in the export, so the same export always builds the same store; forecasts
+    # move it to their own date with rebase_as_of
+    latest = scan_raw(input_path, encoders, chunksize) if chunksize or as_of is None else None
+    as_of = as_of_date(as_of if as_of is not None else latest)
+
+    # Load the dataset, either whole or as a stream of chunks so peak memory stays flat
+    chunks = read_raw(input_path, chunksize) if chunksize else (read_raw(input_path) for _ in range(1))
+
+    # Write to the typed Arrow feature store, or to CSV when a .csv path is given
+    store = None if output_path.endswith(".csv") else FeatureStoreWriter(output_path, partition_cols, as_of)
+
+    history = HistoryFeatures(lags, windows)
+    summary = empty_summary()
+    rows = 0
+    with stage("preprocess") as span:
+        for i, chunk in enumerate(timed_reads(chunks)):
+            chunk = transform_chunk(chunk, encoders, as_of, history)
+            with stage("write", rows=len(chunk)):
+                if store is not None:
+                    store.write(chunk)
+                else:
+                    chunk.to_csv(output_path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+            summary = summarize(chunk, summary)
+            rows += len(chunk)
+        if store is not None:
+            store.close()
+            # Deltas appended later continue from each SKU's tail instead of rereading the store
+            save_store_state(history.state, summary, output_path)
+        span['rows'] = rows
+
+    save_encoders(encoders, encoder_path)
+    print(f"Preprocessing complete. {rows} rows as of {as_of.date()} saved to {output_path}")
 
 # Run preprocessing
 if __name__ == "__main__":
-    preprocess_data("original_data/final_medicine_inventory_sales_data.csv", "processed_data/medicine_inventory_cleaned.csv")
+    parser = argparse.ArgumentParser(description="Preprocess the raw ERP export")
+    parser.add_argument("--input", default="original_data/final_medicine_inventory_sales_data.csv")
+    parser.add_argument("--output", default=FEATURE_STORE_PATH, help="Feature store path (.arrow file or partition directory) or a .csv file")
+    parser.add_argument("--chunksize", type=int, default=None, help="Stream the input in chunks of this many rows")
+    parser.add_argument("--encoders", default=None, help="Path of the SKU/Season encoder sidecar")
+    parser.add_argument("--partition-by", nargs="+", default=None, help="Partition the feature store by these columns")
+    parser.add_argument("--lags", type=int, default=DEFAULT_LAGS, help="Per-SKU Stock Out lags to derive")
+    parser.add_argument("--windows", type=int, nargs="+", default=list(DEFAULT_WINDOWS),
+                        help="Rolling window lengths (in periods) for the per-SKU mean/std/max features")
+    parser.add_argument("--as-of", default=None, help="Date expiry is counted from, YYYY-MM-DD (default: the latest order date)")
+    args = parser.parse_args()
+    preprocess_data(args.input, args.output, args.chunksize, args.encoders, args.partition_by, args.lags, args.windows,
+                    args.as_of)
+    export_metrics("preprocess")
@@ -0,0 +1,57 @@
+import weakref
+import numpy as np
+import pandas as pd
+
+DEFAULT_QUANTILES = (0.1, 0.5, 0.9)
+
+# Leaf values of each sklearn tree padded into one (trees x nodes) matrix, built once per model
+_leaf_values = weakref.WeakKeyDictionary()
+
+
+def quantile_label(q):
+    # 0.1 -> 'P10', 0.975 -> 'P97.5'
+    return f"P{q * 100:g}"
+
+
+def leaf_value_matrix(model):
+    values = _leaf_values.get(model)
+    if values is None:
+        trees = [estimator.tree_ for estimator in model.estimators_]
+        values = np.zeros((len(trees), max(tree.node_count for tree in trees)))
+        for i, tree in enumerate(trees):
+            values[i, :tree.node_count] = tree.value[:, 0, 0]
+        _leaf_values[model] = values
+    return values
+
+
+def has_tree_outputs(model):
+    # Forests whose quantiles are read off their per-tree outputs (other backends bring their own)
+    return hasattr(model, 'predict_trees') or (hasattr(model, 'estimators_') and not hasattr(model, 'predict_quantiles'))
+
+
+def tree_outputs(model, X):
+    # Every tree's prediction for every row as one (trees x rows) array: the compiled forest
+    # produces it directly; a fitted sklearn forest maps all rows to leaves in one apply() call
+    if hasattr(model, 'predict_trees'):
+        return model.predict_trees(X)
+    leaves = model.apply(X)  # (rows x trees) leaf node ids
+    values = leaf_value_matrix(model)
+    return values[np.arange(values.shape[0])[:, None], leaves.T]
+
+
+def predict_quantiles(model, X, quantiles=DEFAULT_QUANTILES):
+    # Point forecast (the forest mean, identical to model.predict) and the requested quantiles of
+    # the per-tree predictions as a (quantiles x rows) array. Backends without per-tree outputs
+    # (boosting) provide their own predict_quantiles
+    if hasattr(model, 'predict_quantiles'):
+        return model.predict_quantiles(X, quantiles)
+    outputs = tree_outputs(model, X)
+    mean = outputs.sum(axis=0) / outputs.shape[0]
+    return mean, np.quantile(outputs, quantiles, axis=0)
+
+
+def quantile_frame(model, X, quantiles=DEFAULT_QUANTILES):
+    mean, values = predict_quantiles(model, X, quantiles)
+    frame = pd.DataFrame(values.T, columns=[quantile_label(q) for q in quantiles])
+    frame.insert(0, 'Predicted Demand', mean)
+    return frame
@@ -0,0 +1,226 @@
+import os
+import json
+import uuid
+import asyncio
+from datetime import datetime
+from contextlib import asynccontextmanager
+from typing import List, Optional
+import pandas as pd
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from model_backend import load_model
+from feature_store import FEATURE_STORE_PATH, load_features, store_version, rebase_as_of
+from forecast_engine import ForecastEngine, reorder_table, order_dates
+from forecaster import RecursiveForecaster, latest_rows
+from preprocess import load_encoders
+
+ENCODER_PATH = "processed_data/encoders.json"
+ORDERS_PATH = "predictions/purchase_orders.ndjson"
+STREAM_CHUNK_ROWS = 10000
+
+
+class MicroBatcher:
+    # Coalesces concurrent single-SKU requests into one batched forecast call: the first request
+    # opens a batch which is flushed after max_wait_ms or once max_batch requests have queued
+    def __init__(self, handler, max_batch=1024, max_wait_ms=5):
+        self.handler = handler
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, request):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            requests = [request for request, _ in batch]
+            try:
+                results = await run_in_threadpool(self.handler, requests)
+            except Exception as exc:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+
+class ForecastService:
+    # Model, feature store and per-SKU state, loaded once at startup
+    def __init__(self, model_path=None, data_path=FEATURE_STORE_PATH, encoder_path=ENCODER_PATH, as_of=None):
+        self.model = load_model(model_path)
+        # Forecasts are as of a fixed date (by default the one the store was built for), not the wall clock
+        self.data, self.as_of = rebase_as_of(load_features(data_path), data_path, as_of)
+        self.data_key = f"{store_version(data_path)}@{self.as_of:%Y-%m-%d}"
+        self.engine = ForecastEngine()
+        self.forecaster = RecursiveForecaster(self.model)
+        self.forecaster.lag_scale = self.forecaster.estimate_lag_scale(self.data)
+
+        self.latest = latest_rows(self.data)
+        self.latest.index = self.latest['SKU'].to_numpy()
+        self.mean_lead_time = self.data.groupby('SKU')['Lead_Time'].mean()
+
+        sku_codes = load_encoders(encoder_path)['SKU']
+        self.sku_codes = sku_codes
+        self.sku_labels = {code: label for label, code in sku_codes.items()}
+        self.batcher = MicroBatcher(self.forecast_batch)
+        self.orders_lock = asyncio.Lock()
+
+    def resolve_sku(self, sku):
+        # Accepts either the ERP SKU label (e.g. SKU_12) or its encoded integer
+        code = self.sku_codes.get(sku)
+        if code is None and sku.lstrip('-').isdigit():
+            code = int(sku)
+        if code is None or code not in self.latest.index:
+            raise HTTPException(status_code=404, detail=f"Unknown SKU {sku}")
+        return code
+
+    def forecast_batch(self, requests):
+        # One recursive forecast over every distinct SKU in the batch, up to the longest horizon
+        codes = list(dict.fromkeys(code for code, _, _ in requests))
+        horizon = max(months for _, months, _ in requests)
+        sku_forecast = self.forecaster.forecast(self.latest.loc[codes], horizon, start_date=self.as_of)
+        sku_forecast['Lead_Time'] = self.mean_lead_time.reindex(sku_forecast['SKU']).to_numpy()
+
+        # Reorder tables once per distinct threshold; each SKU's rows are in step order
+        tables = {}
+        for threshold in {threshold for _, _, threshold in requests}:
+            table = reorder_table(sku_forecast, threshold)
+            tables[threshold] = (table, table.groupby('SKU', sort=False).indices)
+
+        results = []
+        for code, months, threshold in requests:
+            table, positions = tables[threshold]
+            results.append(table.iloc[positions[code][:months]])
+        return results
+
+    def bulk_forecast(self, months, threshold):
+        return self.engine.forecast(self.model, self.data, months, threshold, as_of=self.as_of, data_key=self.data_key)
+
+    def forecast_records(self, forecast, lead_time_buffer):
+        # Rows in the format documented in the dashboard's integration details
+        records = pd.DataFrame({
+            'sku': forecast['SKU'].map(self.sku_labels).fillna(forecast['SKU'].astype(str)),
+            'month': forecast['Month'],
+            'current_stock': forecast['Stock Balance'],
+            'predicted_demand': forecast['Predicted Demand'].round(2),
+            'reorder_needed': forecast['Reorder Needed'],
+            'reorder_quantity': forecast['Reorder Quantity'].round(2),
+            'order_date': order_dates(forecast, lead_time_buffer).dt.strftime('%Y-%m-%d')
+        })
+        return records
+
+    def inventory_records(self, latest):
+        return pd.DataFrame({
+            'sku': latest['SKU'].map(self.sku_labels).fillna(latest['SKU'].astype(str)),
+            'current_stock': latest['Stock Balance'],
+            'stock_in': latest['Stock In'],
+            'stock_out': latest['Stock Out'],
+            'days_until_expiry': latest['Days_Until_Expiry'],
+            'lead_time': self.mean_lead_time.reindex(latest['SKU']).round(2).to_numpy()
+        })
+
+
+def ndjson_stream(records):
+    # Streams a DataFrame as newline-delimited JSON, a chunk of rows at a time
+    for start in range(0, len(records), STREAM_CHUNK_ROWS):
+        yield records.iloc[start:start + STREAM_CHUNK_ROWS].to_json(orient='records', lines=True) + "\n"
+
+
+class PurchaseOrder(BaseModel):
+    sku: str
+    quantity: float
+    order_date: Optional[str] = None
+    expected_delivery: Optional[str] = None
+
+
+@asynccontextmanager
+async def lifespan(app):
+    app.state.service = ForecastService()
+    app.state.service.batcher.start()
+    yield
+    await app.state.service.batcher.stop()
+
+
+app = FastAPI(title="ForeSight.AI Forecast Service", lifespan=lifespan)
+
+
+@app.get("/api/inventory")
+async def get_inventory(sku: Optional[str] = None):
+    service = app.state.service
+    if sku is not None:
+        latest = service.latest.loc[[service.resolve_sku(sku)]]
+        return service.inventory_records(latest).to_dict(orient='records')[0]
+    return StreamingResponse(ndjson_stream(service.inventory_records(service.latest)),
+                             media_type="application/x-ndjson")
+
+
+@app.get("/api/forecasts")
+async def get_forecasts(sku: Optional[str] = None,
+                        months: int = Query(2, ge=1, le=24),
+                        threshold: float = Query(0.3, ge=0),
+                        lead_time_buffer: int = Query(7, ge=0)):
+    service = app.state.service
+    if sku is not None:
+        forecast = await service.batcher.submit((service.resolve_sku(sku), months, threshold))
+        return service.forecast_records(forecast, lead_time_buffer).to_dict(orient='records')
+
+    forecast = await run_in_threadpool(service.bulk_forecast, months, threshold)
+    return StreamingResponse(ndjson_stream(service.forecast_records(forecast, lead_time_buffer)),
+                             media_type="application/x-ndjson")
+
+
+@app.post("/api/orders", status_code=201)
+async def create_orders(orders: List[PurchaseOrder]):
+    service = app.state.service
+    created_at = datetime.now().isoformat(timespec='seconds')
+    created = []
+    for order in orders:
+        service.resolve_sku(order.sku)
+        created.append({'po_id': uuid.uuid4().hex[:12], 'created_at': created_at, **order.model_dump()})
+
+    # Appended under a lock so concurrent requests never interleave lines
+    async with service.orders_lock:
+        os.makedirs(os.path.dirname(ORDERS_PATH), exist_ok=True)
+        lines = "".join(json.dumps(po) + "\n" for po in created)
+        await run_in_threadpool(_append, ORDERS_PATH, lines)
+    return {'created': len(created), 'orders': created}
+
+
+def _append(path, text):
+    with open(path, "a") as f:
+        f.write(text)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 8000)))
@@ -0,0 +1,63 @@
+import numpy as np
+
+
+class SkuIndex:
+    # Lookup index over the distinct SKUs of a table, built once per table: sorted keys for prefix
+    # search, a trigram inverted index for substring search, and each SKU's rows in the table
+    def __init__(self, skus):
+        skus = np.asarray(skus)
+        self.order = np.argsort(skus, kind='stable')  # row positions grouped by SKU
+        sorted_skus = skus[self.order]
+        is_start = np.r_[True, sorted_skus[1:] != sorted_skus[:-1]] if len(skus) else np.zeros(0, dtype=bool)
+        self.starts = np.flatnonzero(is_start)
+        self.ends = np.r_[self.starts[1:], len(skus)]
+        self.skus = sorted_skus[self.starts]
+
+        # Case-insensitive search keys, plus a sorted copy for binary-search prefix lookups
+        self.keys = np.char.lower(self.skus.astype(str))
+        self.key_order = np.argsort(self.keys, kind='stable')
+        self.sorted_keys = self.keys[self.key_order]
+
+        postings = {}
+        for position, key in enumerate(self.keys):
+            for gram in {key[i:i + 3] for i in range(len(key) - 2)}:
+                postings.setdefault(gram, []).append(position)
+        self.trigrams = {gram: np.array(positions) for gram, positions in postings.items()}
+
+    def __len__(self):
+        return len(self.skus)
+
+    def prefix(self, text):
+        # Positions (into self.skus) of the SKUs starting with text
+        text = text.lower()
+        low = np.searchsorted(self.sorted_keys, text, side='left')
+        high = np.searchsorted(self.sorted_keys, text + '\U0010ffff', side='left')
+        return np.sort(self.key_order[low:high])
+
+    def substring(self, text):
+        # Positions of the SKUs containing text: trigram postings narrow the candidates,
+        # which are then checked directly (short queries scan the distinct keys)
+        text = text.lower()
+        if len(text) < 3:
+            candidates = np.arange(len(self.keys))
+        else:
+            grams = [text[i:i + 3] for i in range(len(text) - 2)]
+            postings = sorted((self.trigrams.get(gram, np.zeros(0, dtype=int)) for gram in set(grams)), key=len)
+            candidates = postings[0]
+            for posting in postings[1:]:
+                candidates = np.intersect1d(candidates, posting, assume_unique=True)
+                if not len(candidates):
+                    break
+        return candidates[np.char.find(self.keys[candidates], text) >= 0]
+
+    def search(self, text, mode="substring"):
+        if not text:
+            return np.arange(len(self.skus))
+        return self.prefix(text) if mode == "prefix" else self.substring(text)
+
+    def rows(self, positions):
+        # Table row positions (in table order) of the given SKUs
+        positions = np.asarray(positions, dtype=int)
+        lengths = self.ends[positions] - self.starts[positions]
+        offsets = np.repeat(self.starts[positions] - np.r_[0, np.cumsum(lengths)[:-1]], lengths)
+        return np.sort(self.order[offsets + np.arange(lengths.sum())])
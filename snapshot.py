@@ -0,0 +1,132 @@
+import os
+import json
+import shutil
+import argparse
+from datetime import datetime
+import pyarrow as pa
+import pyarrow.feather as feather
+
+# Precomputed forecasts the dashboards render from without loading the model or the feature store.
+# Only pyarrow is imported here; the pipeline modules are imported by write_snapshot alone
+SNAPSHOT_PATH = "predictions/snapshot"
+META_FILE = "snapshot.json"
+# The dashboard's longest horizon, and the service levels it can size orders to without the model
+SNAPSHOT_MONTHS = 6
+SNAPSHOT_SERVICE_LEVELS = (0.8, 0.85, 0.9, 0.95, 0.975, 0.99)
+FORECAST_PATH_NAME = "forecast.arrow"  # RecursiveForecaster output for every SKU and step
+REORDERS_PATH_NAME = "reorders.arrow"  # predict.py's forecast file
+SKUS_PATH_NAME = "skus.arrow"  # SKU labels, hierarchy and latest stock
+
+
+class Snapshot:
+    # A snapshot directory: its metadata, and its tables memory-mapped on first use
+    def __init__(self, path=SNAPSHOT_PATH):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.tables = {}
+
+    @property
+    def version(self):
+        return self.meta['created_at']
+
+    def table(self, name):
+        if name not in self.tables:
+            self.tables[name] = feather.read_table(os.path.join(self.path, name), memory_map=True)
+        return self.tables[name]
+
+    def frame(self, name):
+        return self.table(name).to_pandas()
+
+    def covers(self, as_of, months_ahead, service_level=None):
+        # Whether a forecast can be served from the snapshot rather than rerun with the model
+        return (str(as_of)[:10] == self.meta['as_of'] and months_ahead <= self.meta['months']
+                and (not service_level or round(service_level, 4) in self.meta['service_levels']))
+
+
+def load_snapshot(path=SNAPSHOT_PATH):
+    # None when no snapshot has been written yet
+    return Snapshot(path) if os.path.exists(os.path.join(path, META_FILE)) else None
+
+
+def write_table(frame, path):
+    # Float columns are stored as float32: the snapshot is for display and reorder arithmetic
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    table = table.cast(pa.schema([
+        pa.field(field.name, pa.float32() if pa.types.is_floating(field.type) else field.type) for field in table.schema
+    ]))
+    feather.write_feather(table, path, compression="uncompressed")
+
+
+def write_snapshot(store_path=None, model_path=None, path=SNAPSHOT_PATH, as_of=None, months=SNAPSHOT_MONTHS,
+                   service_levels=SNAPSHOT_SERVICE_LEVELS, forecast_months=(1, 2)):
+    # One recursive forecast over every SKU, with the point forecast, the default quantiles and the
+    # snapshot's service levels, then the tables derived from it
+    from feature_store import FEATURE_STORE_PATH, HIERARCHY_COLUMNS, load_features, rebase_as_of, store_version
+    from forecast_engine import model_version
+    from forecaster import RecursiveForecaster, latest_rows
+    from model_backend import load_model
+    from predict import monthly_reorders
+    from preprocess import load_encoders, default_encoder_path
+    from quantiles import DEFAULT_QUANTILES
+    from instrumentation import stage
+
+    store_path = store_path or FEATURE_STORE_PATH
+    with stage("load") as span:
+        data, as_of = rebase_as_of(load_features(store_path), store_path, as_of)
+        model = load_model(model_path)
+        span['rows'] = len(data)
+    quantiles = sorted(set(DEFAULT_QUANTILES) | set(service_levels))
+    with stage("forecast", rows=len(data)):
+        sku_forecast = RecursiveForecaster(model).forecast(data, months, start_date=as_of, quantiles=quantiles)
+
+    with stage("snapshot_tables", rows=len(sku_forecast)):
+        reorders = monthly_reorders(sku_forecast, forecast_months, DEFAULT_QUANTILES, None, as_of)
+        # Lead time is averaged over each SKU's history, as the forecast engine does
+        mean_lead_time = data.groupby('SKU')['Lead_Time'].mean()
+        sku_forecast['Lead_Time'] = mean_lead_time.reindex(sku_forecast['SKU']).to_numpy()
+
+        latest = latest_rows(data)
+        labels = {code: label for label, code in load_encoders(default_encoder_path(store_path))['SKU'].items()}
+        skus = latest[['SKU', 'Stock Balance', 'Days_Until_Expiry'] +
+                      [col for col in HIERARCHY_COLUMNS if col in latest.columns]].reset_index(drop=True)
+        skus.insert(1, 'SKU Label', latest['SKU'].map(lambda code: labels.get(code, str(code))).to_numpy())
+        skus['Lead_Time'] = mean_lead_time.reindex(skus['SKU']).to_numpy()
+
+    # Written next to the old snapshot and swapped in, so readers never see a partial one
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    write_table(sku_forecast, os.path.join(tmp_path, FORECAST_PATH_NAME))
+    write_table(reorders, os.path.join(tmp_path, REORDERS_PATH_NAME))
+    write_table(skus, os.path.join(tmp_path, SKUS_PATH_NAME))
+    meta = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'as_of': as_of.strftime('%Y-%m-%d'),
+        'months': months,
+        'service_levels': [round(level, 4) for level in service_levels],
+        'forecast_months': list(forecast_months),
+        'skus': int(len(skus)),
+        'store_version': store_version(store_path),
+        'model_version': model_version(model)
+    }
+    with open(os.path.join(tmp_path, META_FILE), "w") as f:
+        json.dump(meta, f, indent=2)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    print(f"Snapshot of {len(skus)} SKUs x {months} months as of {meta['as_of']} saved to {path}")
+    return meta
+
+
+if __name__ == "__main__":
+    from instrumentation import export_metrics
+    parser = argparse.ArgumentParser(description="Precompute the forecast snapshot the dashboards render from")
+    parser.add_argument("--store", default=None, help="Feature store (default: processed_data/...arrow)")
+    parser.add_argument("--model", default=None, help="Model to forecast with (default: the last trained)")
+    parser.add_argument("--output", default=SNAPSHOT_PATH)
+    parser.add_argument("--as-of", default=None, help="Date to forecast from (default: the store's as-of date)")
+    parser.add_argument("--months", type=int, default=SNAPSHOT_MONTHS)
+    parser.add_argument("--service-levels", type=float, nargs="*", default=list(SNAPSHOT_SERVICE_LEVELS))
+    args = parser.parse_args()
+    write_snapshot(args.store, args.model, args.output, args.as_of, args.months, args.service_levels)
+    export_metrics("snapshot")
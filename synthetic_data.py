@@ -0,0 +1,175 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+# Column order of the raw ERP export (original_data/final_medicine_inventory_sales_data.csv)
+EXPORT_COLUMNS = [
+    'SKU', 'Product Name', 'Category', 'Dosage Form', 'Strength', 'Package Size', 'Batch Number',
+    'Manufacturing Date', 'Expiration Date', 'Unit Cost', 'Selling Price', 'Stock In', 'Stock Out',
+    'Stock Balance', 'Distributor ID', 'Distributor Name', 'Country', 'Distributor Type', 'Order Date',
+    'Quantity Ordered', 'Total Order Cost', 'Order Status', 'Payment Status', 'Shipping Date',
+    'Delivery Date', 'Transaction Date', 'Season', 'Holiday', 'Promotion', 'Lag_1', 'Lag_2', 'Lag_3',
+    'Moving Average', 'Demand Forecast'
+]
+
+CATEGORIES = np.array(['Antibiotic', 'Antifungal', 'Analgesic', 'Antiviral'])
+DOSAGE_FORMS = np.array(['Tablet', 'Syrup', 'Capsule', 'Injection'])
+COUNTRIES = np.array(['Germany', 'Japan', 'USA', 'India', 'Brazil', 'UK'])
+DISTRIBUTOR_TYPES = np.array(['Pharmacy', 'Wholesale', 'Hospital', 'Retail'])
+ORDER_STATUSES = np.array(['Pending', 'Delivered', 'Shipped', 'Cancelled'])
+PAYMENT_STATUSES = np.array(['Paid', 'Unpaid', 'Partial'])
+MONTH_SEASONS = np.array(['', 'Winter', 'Winter', 'Spring', 'Spring', 'Spring', 'Summer', 'Summer',
+                          'Summer', 'Autumn', 'Autumn', 'Autumn', 'Winter'])
+
+# Longest calendar span generated; beyond it a SKU gets several order streams per month
+MAX_MONTHS = 240
+N_DISTRIBUTORS = 50
+
+
+def date_strings(days):
+    return np.datetime_as_string(days.astype('datetime64[D]'), unit='D')
+
+
+class SyntheticExport:
+    # Schema-compatible synthetic ERP export: one row per (SKU, order stream, month) with
+    # per-SKU base demand, yearly seasonality and promotion lift
+    def __init__(self, n_rows, n_skus, start='2020-01', seed=42):
+        self.n_rows = n_rows
+        self.n_skus = n_skus
+        self.rng = np.random.default_rng(seed)
+        n_periods = -(-n_rows // n_skus)
+        self.streams_per_sku = -(-n_periods // MAX_MONTHS)
+        self.n_months = -(-n_periods // self.streams_per_sku)
+        self.start = np.datetime64(start, 'M')
+
+        rng = self.rng
+        n_streams = n_skus * self.streams_per_sku
+        self.sku_ids = np.tile(np.arange(1, n_skus + 1), self.streams_per_sku)
+        sku = self.sku_ids - 1
+
+        # Static product attributes, per SKU
+        self.base_demand = rng.gamma(4.0, 12.0, n_skus)
+        self.season_amplitude = rng.uniform(0.0, 0.6, n_skus)
+        self.season_phase = rng.uniform(0, 12, n_skus)
+        self.promotion_rate = rng.uniform(0.05, 0.3, n_skus)
+        self.category = CATEGORIES[rng.integers(0, len(CATEGORIES), n_skus)]
+        self.dosage_form = DOSAGE_FORMS[rng.integers(0, len(DOSAGE_FORMS), n_skus)]
+        self.strength = np.char.add(rng.integers(5, 500, n_skus).astype(str), 'mg')
+        self.package_size = np.char.add(rng.integers(10, 500, n_skus).astype(str), 'ml')
+        self.unit_cost = np.round(rng.uniform(1, 50, n_skus), 2)
+
+        # Per order stream: distributor and rolling state carried from month to month
+        self.stream_sku = sku
+        self.distributor = rng.integers(1, N_DISTRIBUTORS + 1, n_streams)
+        self.lags = np.repeat(np.round(self.base_demand[sku])[None, :], 3, axis=0)
+        self.balance = np.round(self.base_demand[sku] * 2)
+
+    def month(self, index):
+        rng = self.rng
+        sku = self.stream_sku
+        n = len(sku)
+        month_start = self.start + index
+        calendar_month = month_start.astype(int) % 12 + 1
+
+        seasonality = 1 + self.season_amplitude[sku] * np.sin(2 * np.pi * (calendar_month + self.season_phase[sku]) / 12)
+        promotion = rng.random(n) < self.promotion_rate[sku]
+        expected = self.base_demand[sku] * seasonality * np.where(promotion, 1.4, 1.0)
+        stock_out = np.maximum(0, rng.poisson(expected))
+
+        # Restock whenever the balance falls below about two months of demand
+        restock = self.balance < expected * 2
+        stock_in = np.where(restock, np.round(expected * rng.uniform(2, 4, n)), 0).astype(int)
+        self.balance = self.balance + stock_in - stock_out
+        lag_1, lag_2, lag_3 = self.lags
+        moving_average = (lag_1 + lag_2 + lag_3) / 3
+
+        first_day = month_start.astype('datetime64[D]')
+        order_day = first_day + rng.integers(0, 28, n)
+        shipping_day = order_day + rng.integers(1, 6, n)
+        delivery_day = shipping_day + rng.integers(3, 12, n)
+        manufacturing_day = order_day - rng.integers(100, 800, n)
+        expiration_day = manufacturing_day + rng.integers(365, 1100, n)
+        transaction_day = (month_start + 1).astype('datetime64[D]') - 1
+
+        quantity = rng.integers(10, 201, n)
+        selling_price = np.round(self.unit_cost[sku] * rng.uniform(1.2, 2.0, n), 2)
+        sku_labels = np.char.add('SKU_', self.sku_ids.astype(str))
+        distributor_ids = np.char.add('DIST_', self.distributor.astype(str))
+
+        frame = pd.DataFrame({
+            'SKU': sku_labels,
+            'Product Name': np.char.add('Medicine_', sku_labels),
+            'Category': self.category[sku],
+            'Dosage Form': self.dosage_form[sku],
+            'Strength': self.strength[sku],
+            'Package Size': self.package_size[sku],
+            'Batch Number': np.char.add('BN', rng.integers(1000, 10000, n).astype(str)),
+            'Manufacturing Date': date_strings(manufacturing_day),
+            'Expiration Date': date_strings(expiration_day),
+            'Unit Cost': self.unit_cost[sku],
+            'Selling Price': selling_price,
+            'Stock In': stock_in,
+            'Stock Out': stock_out,
+            'Stock Balance': self.balance.astype(int),
+            'Distributor ID': distributor_ids,
+            'Distributor Name': np.char.add('Distributor_', distributor_ids),
+            'Country': COUNTRIES[self.distributor % len(COUNTRIES)],
+            'Distributor Type': DISTRIBUTOR_TYPES[self.distributor % len(DISTRIBUTOR_TYPES)],
+            'Order Date': date_strings(order_day),
+            'Quantity Ordered': quantity,
+            'Total Order Cost': np.round(quantity * selling_price, 2),
+            'Order Status': ORDER_STATUSES[rng.integers(0, len(ORDER_STATUSES), n)],
+            'Payment Status': PAYMENT_STATUSES[rng.integers(0, len(PAYMENT_STATUSES), n)],
+            'Shipping Date': date_strings(shipping_day),
+            'Delivery Date': date_strings(delivery_day),
+            'Transaction Date': np.datetime_as_string(transaction_day, unit='D'),
+            'Season': MONTH_SEASONS[calendar_month],
+            'Holiday': (rng.random(n) < 0.1).astype(int),
+            'Promotion': promotion.astype(int),
+            'Lag_1': lag_1.astype(int),
+            'Lag_2': lag_2.astype(int),
+            'Lag_3': lag_3.astype(int),
+            'Moving Average': moving_average,
+            'Demand Forecast': np.round(moving_average * 3).astype(int)
+        }, columns=EXPORT_COLUMNS)
+
+        self.lags = np.stack([stock_out, lag_1, lag_2])
+        return frame
+
+    def chunks(self, chunk_rows=1_000_000):
+        # Months are generated in order and grouped into chunks of roughly chunk_rows rows
+        emitted = 0
+        pending = []
+        pending_rows = 0
+        for index in range(self.n_months):
+            frame = self.month(index)
+            frame = frame.iloc[:self.n_rows - emitted]
+            emitted += len(frame)
+            pending.append(frame)
+            pending_rows += len(frame)
+            if pending_rows >= chunk_rows or emitted >= self.n_rows:
+                yield pd.concat(pending, ignore_index=True)
+                pending, pending_rows = [], 0
+            if emitted >= self.n_rows:
+                return
+
+
+def generate_dataset(n_rows, n_skus, output_path, seed=42, chunk_rows=1_000_000):
+    # Streams the export to CSV so memory stays bounded at any scale
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    export = SyntheticExport(n_rows, n_skus, seed=seed)
+    for i, chunk in enumerate(export.chunks(chunk_rows)):
+        chunk.to_csv(output_path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+    print(f"Generated {n_rows} rows for {n_skus} SKUs over {export.n_months} months to {output_path}")
+    return output_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic ERP export at a given scale")
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--skus", type=int, default=1_000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="original_data/synthetic_export.csv")
+    args = parser.parse_args()
+    generate_dataset(args.rows, args.skus, args.output, args.seed)
@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import RandomForestRegressor
+from compiled_forest import CompiledForest, export_forest
+
+
+def fitted_forest(rng, n_rows=400, n_features=5):
+    X = pd.DataFrame(rng.normal(size=(n_rows, n_features)), columns=[f"f{i}" for i in range(n_features)])
+    y = X['f0'] * 3 - X['f1'] ** 2 + rng.normal(scale=0.1, size=n_rows)
+    # Missing values in training too, so splits learn which side missing rows go to
+    X = X.mask(rng.random(X.shape) < 0.1)
+    return RandomForestRegressor(n_estimators=20, max_depth=8, random_state=0).fit(X, y), X
+
+
+def test_compiled_forest_matches_sklearn(tmp_path):
+    rng = np.random.default_rng(0)
+    model, X = fitted_forest(rng)
+    forest = CompiledForest(export_forest(model, str(tmp_path / "model.forest")))
+
+    rows = pd.DataFrame(rng.normal(size=(300, X.shape[1])), columns=X.columns)
+    rows.iloc[::7, 0] = np.nan
+    rows.iloc[::11, 2] = np.nan
+    rows.iloc[5] = np.nan
+
+    assert np.array_equal(forest.predict(rows), model.predict(rows))
+    assert np.array_equal(forest.predict(X), model.predict(X))
+    assert np.array_equal(forest.predict(rows.iloc[:1]), model.predict(rows.iloc[:1]))
@@ -1,45 +1,339 @@
 import pandas as pd
+import numpy as np
 import os
+import json
+import time
+import argparse
 import joblib
-from sklearn.model_selection import train_test_split
+import pyarrow.dataset as ds
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sklearn.model_selection import train_test_split, ParameterGrid, ParameterSampler
 from sklearn.ensemble import RandomForestRegressor
 from sklearn.metrics import mean_absolute_error, mean_squared_error
+from feature_store import FEATURE_STORE_PATH, MODEL_FEATURES, TARGET, TIME_COLUMN, load_features, store_as_of
+from compiled_forest import compiled_path, export_forest
+from model_backend import BACKENDS, DEFAULT_MODEL_PATHS, set_active_model
+from model_registry import (RAW_PATH, SEGMENT_KEYS, VOLUME_BUCKETS, registry_path, sku_segments, segment_digests,
+                            load_index, save_index, shard_path, remove_shard)
+from instrumentation import stage, instrumented, export_metrics
 
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Hyperparameter space searched by the cross-validated training mode
+PARAM_GRID = {
+    'n_estimators': [100, 200],
+    'max_depth': [10, 20, None],
+    'min_samples_leaf': [1, 5],
+    'max_features': [1.0, 'sqrt']
+}
+# The forest train_model fits, used for every shard unless other parameters are given
+SHARD_PARAMS = {'n_estimators': 100, 'max_depth': 10}
+
+
+def save_model(model, model_output_path):
+    # Ensure the output directory exists
+    os.makedirs(os.path.dirname(model_output_path), exist_ok=True)
+
+    # Save the trained model
+    with stage("save"):
+        joblib.dump(model, model_output_path)
+        print(f"Model training complete. Model saved to {model_output_path}")
+
+        # Export the flat-array version used for fast loading and inference
+        export_forest(model, compiled_path(model_output_path), source_path=model_output_path)
+        set_active_model(model_output_path)
+
+
+@instrumented("train")
+def train_model(input_path, model_output_path, backend='forest', batch_rows=None, external_memory=True):
+    if backend == 'xgboost':
+        # Streams the store in batches instead of loading it whole (see xgboost_backend.py)
+        from xgboost_backend import BATCH_ROWS, train_xgboost
+        return train_xgboost(input_path, model_output_path, batch_rows or BATCH_ROWS, external_memory)
 
-def train_model(input_path, model_output_path):
     # Load preprocessed data
-    df = pd.read_csv(input_path)
-    
+    with stage("load") as span:
+        df = load_features(input_path)
+        span['rows'] = len(df)
+
     # Define features and target variable
-    X = df.drop(columns=['Demand Forecast'])  # Features
-    y = df['Demand Forecast']  # Target
-    
+    X = df[MODEL_FEATURES]  # Features
+    y = df[TARGET]  # Target
+
     # Split data into training and testing sets
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
-    
+
     # Train Random Forest model
     model = RandomForestRegressor(n_estimators=100, max_depth=10, random_state=42)
-    model.fit(X_train, y_train)
-    
+    with stage("fit", rows=len(X_train)):
+        model.fit(X_train, y_train)
+
     # Predictions
-    y_pred = model.predict(X_test)
-    
+    with stage("predict", rows=len(X_test)):
+        y_pred = model.predict(X_test)
+
     # Evaluate model
     mae = mean_absolute_error(y_test, y_pred)
     mse = mean_squared_error(y_test, y_pred)
     rmse = mse ** 0.5  # Manually computing RMSE
 
     print(f'Model Evaluation:\nMAE: {mae}\nMSE: {mse}\nRMSE: {rmse}')
-    
-    # Ensure the output directory exists
-    os.makedirs(os.path.dirname(model_output_path), exist_ok=True)
-    
-    # Save the trained model
-    joblib.dump(model, model_output_path)
-    print(f"Model training complete. Model saved to {model_output_path}")
+
+    save_model(model, model_output_path)
+
+
+def rolling_origin_splits(df, n_splits):
+    # Expanding-window folds over whole months of history: fold i trains on the first i+1
+    # blocks of months and tests on the block right after, so no future rows leak into training
+    if TIME_COLUMN in df.columns:
+        periods = df[TIME_COLUMN].to_numpy().astype('datetime64[M]')
+    else:
+        periods = np.arange(len(df))  # rows are stored in export (time) order
+    blocks = np.array_split(np.unique(periods), n_splits + 1)
+    splits = []
+    for i in range(n_splits):
+        cutoff = blocks[i][-1]
+        test_end = blocks[i + 1][-1]
+        train_idx = np.flatnonzero(periods <= cutoff)
+        test_idx = np.flatnonzero((periods > cutoff) & (periods <= test_end))
+        splits.append((train_idx, test_idx, str(cutoff)))
+    return splits
+
+
+# Per-worker state, loaded once in each pool process instead of being pickled per task
+_worker_data = {}
+
+
+def _init_worker(input_path, max_memory_mb):
+    if max_memory_mb and resource is not None:
+        limit = max_memory_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    df = load_features(input_path, columns=MODEL_FEATURES + [TARGET])
+    _worker_data['X'] = df[MODEL_FEATURES]
+    _worker_data['y'] = df[TARGET].to_numpy()
+
+
+def _fit_fold(config_id, params, fold, train_idx, test_idx):
+    X, y = _worker_data['X'], _worker_data['y']
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    model = RandomForestRegressor(random_state=42, n_jobs=1, **params)
+    model.fit(X.iloc[train_idx], y[train_idx])
+    y_pred = model.predict(X.iloc[test_idx])
+    return {
+        'config_id': config_id,
+        'fold': fold,
+        'mae': mean_absolute_error(y[test_idx], y_pred),
+        'rmse': mean_squared_error(y[test_idx], y_pred) ** 0.5,
+        'wall_seconds': time.perf_counter() - start_wall,
+        'cpu_seconds': time.process_time() - start_cpu
+    }
+
+
+@instrumented("train_cv")
+def train_model_cv(input_path, model_output_path, n_splits=4, search='grid', n_iter=10,
+                   workers=None, max_worker_memory_mb=None, report_path=None):
+    with stage("load") as span:
+        df = load_features(input_path)
+        span['rows'] = len(df)
+    splits = rolling_origin_splits(df, n_splits)
+
+    if search == 'random':
+        configs = list(ParameterSampler(PARAM_GRID, n_iter=n_iter, random_state=42))
+    else:
+        configs = list(ParameterGrid(PARAM_GRID))
+    workers = workers or os.cpu_count()
+    print(f"Evaluating {len(configs)} configurations x {len(splits)} folds on {workers} workers")
+
+    # Every (configuration, fold) pair is an independent single-core fit
+    results = []
+    start = time.perf_counter()
+    with stage("search", rows=len(configs) * len(splits)), ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(input_path, max_worker_memory_mb)) as pool:
+        futures = [
+            pool.submit(_fit_fold, config_id, params, fold, train_idx, test_idx)
+            for config_id, params in enumerate(configs)
+            for fold, (train_idx, test_idx, _) in enumerate(splits)
+        ]
+        for future in as_completed(futures):
+            results.append(future.result())
+    search_seconds = time.perf_counter() - start
+
+    # Average the folds of each configuration
+    scores = pd.DataFrame(results).groupby('config_id').agg(
+        mae=('mae', 'mean'), rmse=('rmse', 'mean'),
+        wall_seconds=('wall_seconds', 'sum'), cpu_seconds=('cpu_seconds', 'sum')
+    ).sort_values('rmse')
+    scores['params'] = [configs[i] for i in scores.index]
+    print(scores.to_string())
+
+    best_params = configs[scores.index[0]]
+    print(f"Best configuration: {best_params}")
+
+    # Refit the best configuration on the full history using every core
+    start = time.perf_counter()
+    model = RandomForestRegressor(random_state=42, n_jobs=-1, **best_params)
+    with stage("fit", rows=len(df)):
+        model.fit(df[MODEL_FEATURES], df[TARGET])
+    model.set_params(n_jobs=None)
+    refit_seconds = time.perf_counter() - start
+
+    report = {
+        'folds': [{'cutoff': cutoff, 'train_rows': len(train_idx), 'test_rows': len(test_idx)}
+                  for train_idx, test_idx, cutoff in splits],
+        'configurations': scores.reset_index().to_dict(orient='records'),
+        'best_params': best_params,
+        'search_seconds': search_seconds,
+        'refit_seconds': refit_seconds
+    }
+    report_path = report_path or os.path.join(os.path.dirname(model_output_path), "cv_report.json")
+    os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"Search took {search_seconds:.1f}s, refit {refit_seconds:.1f}s. Report saved to {report_path}")
+
+    save_model(model, model_output_path)
+    return report
+
+
+def _fit_shard(input_path, output_path, segment, skus, params):
+    # One segment's forest, fit and scored like train_model on that segment's SKUs only. The worker
+    # reads just these rows from the store, so no training data is pickled between processes
+    start_wall, start_cpu = time.perf_counter(), time.process_time()
+    df = load_features(input_path, columns=MODEL_FEATURES + [TARGET], filter=ds.field('SKU').isin(skus))
+    X_train, X_test, y_train, y_test = train_test_split(df[MODEL_FEATURES], df[TARGET], test_size=0.2,
+                                                        random_state=42)
+    model = RandomForestRegressor(random_state=42, n_jobs=1, **params)
+    model.fit(X_train, y_train)
+    y_pred = model.predict(X_test)
+
+    joblib.dump(model, output_path)
+    export_forest(model, compiled_path(output_path), source_path=output_path)
+    return {
+        'segment': segment,
+        'rows': len(df),
+        'mae': mean_absolute_error(y_test, y_pred),
+        'rmse': mean_squared_error(y_test, y_pred) ** 0.5,
+        'wall_seconds': time.perf_counter() - start_wall,
+        'cpu_seconds': time.process_time() - start_cpu
+    }
+
+
+@instrumented("train_sharded")
+def train_sharded(input_path, registry=None, segment_by='Category', segments=None, workers=None,
+                  raw_path=RAW_PATH, n_buckets=VOLUME_BUCKETS, params=None):
+    # One forest per segment (see model_registry.py), fit in parallel single-core workers. A shard is
+    # only refit when its rows or the parameters changed since it was fit, or when it is one of
+    # `segments`; every other shard is kept as it is
+    params = {**SHARD_PARAMS, **(params or {})}
+    registry = registry or registry_path(segment_by)
+    with stage("load") as span:
+        df = load_features(input_path, columns=MODEL_FEATURES + [TARGET])
+        span['rows'] = len(df)
+    assignments = sku_segments(segment_by, input_path, raw_path, n_buckets)
+    assignments = assignments.reindex(np.sort(df['SKU'].unique())).dropna()
+    digests = segment_digests(df, assignments, params, store_as_of(input_path))
+    unknown = set(segments or ()) - set(digests)
+    if unknown:
+        raise ValueError(f"Unknown segments {sorted(unknown)}; {segment_by} has {sorted(digests)}")
+
+    index = load_index(registry)
+    previous = index['segments'] if index else {}
+    reusable = previous if index and index['segment_by'] == segment_by else {}
+    entries, todo = {}, []
+    for name, digest in digests.items():
+        entry = reusable.get(name)
+        current = entry is not None and entry['digest'] == digest and \
+            os.path.exists(os.path.join(registry, entry['path']))
+        if name in (segments or ()) or (segments is None and not current):
+            todo.append(name)
+        elif entry is not None:
+            entries[name] = entry
+
+    # Largest shards first, so the pool does not end up waiting on one big fit
+    rows = df['SKU'].map(assignments).value_counts()
+    todo.sort(key=lambda name: -rows.get(name, 0))
+    workers = max(1, min(workers or os.cpu_count(), len(todo)))
+    os.makedirs(registry, exist_ok=True)
+    tasks = [(input_path, shard_path(registry, name), name, assignments.index[assignments == name].tolist(), params)
+             for name in todo]
+    results = []
+    start = time.perf_counter()
+    with stage("fit_shards", rows=int(rows.reindex(todo).sum())):
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for future in as_completed([pool.submit(_fit_shard, *task) for task in tasks]):
+                    results.append(future.result())
+        else:
+            results = [_fit_shard(*task) for task in tasks]
+    fit_seconds = time.perf_counter() - start
+
+    trained_at = datetime.now().isoformat(timespec='seconds')
+    for result in results:
+        name = result.pop('segment')
+        entries[name] = {'path': os.path.basename(shard_path(registry, name)), 'digest': digests[name],
+                         'skus': int((assignments == name).sum()), 'trained_at': trained_at, **result}
+    for name, entry in previous.items():
+        if name not in entries or entries[name]['path'] != entry['path']:
+            remove_shard(registry, entry)
+
+    index = {
+        'segment_by': segment_by,
+        'params': params,
+        'raw_path': raw_path,
+        'volume_buckets': n_buckets,
+        'updated_at': trained_at,
+        'fallback': max(entries, key=lambda name: entries[name]['rows']),
+        'segments': dict(sorted(entries.items())),
+        'sku_segments': {str(sku): name for sku, name in assignments.items() if name in entries}
+    }
+    save_index(index, registry)
+    set_active_model(registry)
+
+    if todo:
+        print(pd.DataFrame({name: entries[name] for name in todo}).T[['skus', 'rows', 'mae', 'rmse', 'wall_seconds']])
+    print(f"Fit {len(results)} of {len(digests)} {segment_by} segments on {workers} workers in {fit_seconds:.1f}s "
+          f"({len(digests) - len(results)} unchanged). Registry saved to {registry}")
+    return index
 
 
 # Run training
 if __name__ == "__main__":
-    train_model("processed_data/medicine_inventory_cleaned.csv", "models/demand_forecasting_rf.pkl")
-
+    parser = argparse.ArgumentParser(description="Train the demand forecasting model")
+    parser.add_argument("--input", default=FEATURE_STORE_PATH)
+    parser.add_argument("--output", default=None,
+                        help="Model path (default: per backend, .pkl forest or .ubj xgboost; a directory with --segment-by)")
+    parser.add_argument("--backend", choices=BACKENDS, default="forest")
+    parser.add_argument("--batch-rows", type=int, default=None, help="Rows per batch streamed to the xgboost backend")
+    parser.add_argument("--in-memory", action="store_true",
+                        help="Keep xgboost's quantized matrix in memory instead of paging it to disk")
+    parser.add_argument("--cv", action="store_true", help="Rolling-origin CV with a parallel hyperparameter search")
+    parser.add_argument("--folds", type=int, default=4)
+    parser.add_argument("--search", choices=["grid", "random"], default="grid")
+    parser.add_argument("--n-iter", type=int, default=10, help="Configurations sampled by the random search")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: all cores)")
+    parser.add_argument("--max-worker-memory-mb", type=int, default=None, help="Address-space cap per worker")
+    parser.add_argument("--segment-by", choices=SEGMENT_KEYS, default=None,
+                        help="Fit one forest per segment in parallel, into a model registry (default: one global forest)")
+    parser.add_argument("--segments", nargs="+", default=None,
+                        help="Refit only these segments (default: those whose rows changed)")
+    parser.add_argument("--volume-buckets", type=int, default=VOLUME_BUCKETS, help="Buckets for --segment-by volume")
+    parser.add_argument("--raw", default=RAW_PATH, help="Raw ERP export, for --segment-by 'Dosage Form'")
+    args = parser.parse_args()
+    output = args.output or DEFAULT_MODEL_PATHS[args.backend]
+    if args.segment_by:
+        if args.cv or args.backend != 'forest':
+            parser.error("--segment-by fits forests with the default parameters; drop --cv and --backend")
+        train_sharded(args.input, args.output, args.segment_by, args.segments, args.workers, args.raw,
+                      args.volume_buckets)
+    elif args.cv:
+        if args.backend != 'forest':
+            parser.error("--cv searches the forest's hyperparameters; use --backend forest")
+        train_model_cv(args.input, output, args.folds, args.search, args.n_iter,
+                       args.workers, args.max_worker_memory_mb)
+    else:
+        train_model(args.input, output, args.backend, args.batch_rows, not args.in_memory)
+    export_metrics("train")
@@ -0,0 +1,165 @@
+import os
+import json
+import tempfile
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from compiled_forest import file_digest
+from feature_store import MODEL_FEATURES, TARGET, iter_features
+from model_backend import set_active_model
+from instrumentation import stage
+
+XGBOOST_PARAMS = {
+    'objective': 'reg:squarederror',
+    'tree_method': 'hist',
+    'max_depth': 12,
+    'eta': 0.1,
+    'max_bin': 1024,  # finer histograms than the default 256: the stock and lag features span wide ranges
+    'min_child_weight': 1
+}
+NUM_BOOST_ROUND = 500
+EARLY_STOPPING_ROUNDS = 20
+VALID_FRACTION = 0.2
+BATCH_ROWS = 1_000_000
+# Held-out residual quantiles stored with the model, from which any demand quantile is read
+RESIDUAL_GRID = np.linspace(0, 1, 201)
+MAX_RESIDUAL_SAMPLE = 1_000_000
+
+
+def holdout_mask(n_rows, batch_index, valid_fraction=VALID_FRACTION, seed=42):
+    # Same rows every pass over the store: the split is seeded by the batch position
+    return np.random.default_rng([seed, batch_index]).random(n_rows) < valid_fraction
+
+
+class FeatureBatches(xgb.DataIter):
+    # Feeds the feature store to xgboost one batch at a time (the training or the held-out rows).
+    # With a cache_prefix xgboost keeps the quantized pages on disk (external memory); without one
+    # only the quantized matrix is held in memory, never the raw DataFrame
+    def __init__(self, path, holdout=False, batch_rows=BATCH_ROWS, valid_fraction=VALID_FRACTION, cache_prefix=None):
+        self.path = path
+        self.holdout = holdout
+        self.batch_rows = batch_rows
+        self.valid_fraction = valid_fraction
+        self.batches = None
+        super().__init__(cache_prefix=cache_prefix)
+
+    def reset(self):
+        self.batches = None
+
+    def next(self, input_data):
+        if self.batches is None:
+            self.batches = enumerate(iter_features(self.path, MODEL_FEATURES + [TARGET], self.batch_rows))
+        for i, df in self.batches:
+            mask = holdout_mask(len(df), i, self.valid_fraction) == self.holdout
+            if mask.any():
+                input_data(data=df[MODEL_FEATURES].to_numpy(np.float32)[mask],
+                           label=df[TARGET].to_numpy(np.float32)[mask])
+                return True
+        return False
+
+
+class XGBoostModel:
+    # A native xgboost booster behind the same interface as the forests
+    def __init__(self, path, nthread=None):
+        self.booster = xgb.Booster(params={'nthread': nthread or os.cpu_count()}, model_file=path)
+        self.feature_names_in_ = np.asarray(self.booster.feature_names, dtype=object)
+        self.n_features_in_ = len(self.feature_names_in_)
+        self.residual_quantiles = np.asarray(json.loads(self.booster.attr('residual_quantiles') or '[]'))
+        self.version = file_digest(path)
+
+    def _as_array(self, X):
+        if isinstance(X, pd.DataFrame):
+            X = X[list(self.feature_names_in_)]
+        return np.asarray(X, dtype=np.float32)
+
+    def predict(self, X):
+        return self.booster.inplace_predict(self._as_array(X)).astype(np.float64)
+
+    def predict_quantiles(self, X, quantiles):
+        # Boosted trees are additive, so there is no per-tree spread to take quantiles of; the
+        # point forecast is shifted by the held-out residual quantiles instead
+        mean = self.predict(X)
+        offsets = np.interp(quantiles, RESIDUAL_GRID, self.residual_quantiles) if len(self.residual_quantiles) \
+            else np.zeros(len(quantiles))
+        return mean, np.maximum(mean[None, :] + np.asarray(offsets)[:, None], 0)
+
+
+def evaluate(booster, input_path, batch_rows, valid_fraction):
+    # Streams the held-out rows once: MAE/MSE and a bounded sample of the residuals
+    abs_error = squared_error = 0.0
+    n_rows = 0
+    sample, stride = [], 1
+    for i, df in enumerate(iter_features(input_path, MODEL_FEATURES + [TARGET], batch_rows)):
+        mask = holdout_mask(len(df), i, valid_fraction)
+        if not mask.any():
+            continue
+        y = df[TARGET].to_numpy(np.float64)[mask]
+        residuals = y - booster.inplace_predict(df[MODEL_FEATURES].to_numpy(np.float32)[mask])
+        abs_error += np.abs(residuals).sum()
+        squared_error += (residuals ** 2).sum()
+        n_rows += len(residuals)
+        sample.append(residuals[::stride])
+        if sum(len(part) for part in sample) > MAX_RESIDUAL_SAMPLE:
+            sample, stride = [np.concatenate(sample)[::2]], stride * 2  # thin evenly to stay bounded
+    mae, mse = abs_error / max(n_rows, 1), squared_error / max(n_rows, 1)
+    residuals = np.concatenate(sample) if sample else np.zeros(1)
+    return mae, mse, np.quantile(residuals, RESIDUAL_GRID)
+
+
+def save_booster(booster, model_output_path):
+    os.makedirs(os.path.dirname(model_output_path) or ".", exist_ok=True)
+    root, ext = os.path.splitext(model_output_path)
+    tmp_path = f"{root}.tmp{ext}"  # xgboost picks the format from the extension
+    booster.save_model(tmp_path)
+    os.replace(tmp_path, model_output_path)
+    set_active_model(model_output_path)
+    print(f"Model training complete. Model saved to {model_output_path}")
+
+
+def train_xgboost(input_path, model_output_path, batch_rows=BATCH_ROWS, external_memory=True, params=None,
+                  num_boost_round=NUM_BOOST_ROUND, early_stopping_rounds=EARLY_STOPPING_ROUNDS,
+                  valid_fraction=VALID_FRACTION, cache_dir=None):
+    # Histogram boosting trained from the store batch by batch, on all cores, with early stopping
+    # on the held-out rows. External-memory pages go to a scratch directory next to the model
+    # (not /tmp, which may be RAM-backed) and are removed afterwards.
+    params = {**XGBOOST_PARAMS, 'nthread': os.cpu_count(), **(params or {})}
+    cache_dir = cache_dir or os.path.dirname(model_output_path) or "."
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix="xgb-cache-", dir=cache_dir) as scratch:
+        with stage("quantize") as span:
+            make_matrix = xgb.ExtMemQuantileDMatrix if external_memory else xgb.QuantileDMatrix
+            cache = (lambda name: os.path.join(scratch, name)) if external_memory else (lambda name: None)
+            train = make_matrix(FeatureBatches(input_path, False, batch_rows, valid_fraction, cache('train')),
+                                max_bin=params['max_bin'], nthread=params['nthread'])
+            valid = make_matrix(FeatureBatches(input_path, True, batch_rows, valid_fraction, cache('valid')),
+                                ref=train, max_bin=params['max_bin'], nthread=params['nthread'])
+            span['rows'] = train.num_row() + valid.num_row()
+        with stage("fit", rows=train.num_row()):
+            booster = xgb.train(params, train, num_boost_round, evals=[(valid, 'valid')],
+                                early_stopping_rounds=early_stopping_rounds, verbose_eval=False)
+        del train, valid
+    booster = booster[:booster.best_iteration + 1]
+    booster.feature_names = list(MODEL_FEATURES)
+
+    with stage("predict"):
+        mae, mse, residual_quantiles = evaluate(booster, input_path, batch_rows, valid_fraction)
+    print(f'Model Evaluation:\nMAE: {mae}\nMSE: {mse}\nRMSE: {np.sqrt(mse)}')
+    print(f"Boosted {booster.num_boosted_rounds()} rounds")
+    booster.set_attr(residual_quantiles=json.dumps(residual_quantiles.tolist()))
+
+    with stage("save"):
+        save_booster(booster, model_output_path)
+    return booster
+
+
+def warm_start_xgboost(model_path, recent, n_new_rounds=20, params=None):
+    # Appends boosting rounds fitted on recent rows to the saved booster
+    model = XGBoostModel(model_path)
+    params = {**XGBOOST_PARAMS, 'nthread': os.cpu_count(), **(params or {})}
+    recent_matrix = xgb.DMatrix(recent[MODEL_FEATURES].to_numpy(np.float32), label=recent[TARGET].to_numpy(np.float32),
+                                feature_names=list(MODEL_FEATURES))
+    booster = xgb.train(params, recent_matrix, n_new_rounds, xgb_model=model.booster)
+    print(f"Warm start: boosted {n_new_rounds} rounds on {len(recent)} recent rows, "
+          f"model now has {booster.num_boosted_rounds()} rounds")
+    save_booster(booster, model_path)
+    return booster